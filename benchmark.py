@@ -0,0 +1,310 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import socket
+import threading
+import time
+
+from distributed_kv_store import Client, LatencyHistogram, Replica, load_config
+
+config, config_settings = load_config()
+benchmark_settings = config_settings.get("benchmark", {})
+
+logging.basicConfig(filename="./logs/benchmark.log",
+                    filemode='a',
+                    format='%(asctime)s,%(msecs)d %(filename)s %(levelname)s: %(message)s',
+                    datefmt='%H:%M:%S',
+                    encoding="utf-8",
+                    level=benchmark_settings.get("log_level", "WARNING"))
+
+# YCSB core workloads: A is update heavy, B is read mostly and C is read only
+WORKLOADS = {
+    "a": {"read_ratio": 0.5},
+    "b": {"read_ratio": 0.95},
+    "c": {"read_ratio": 1.0},
+}
+
+
+# Draws ranks from 0 to n - 1 with the Zipfian distribution YCSB uses, where rank 0 is the most popular.
+# Keys are hashed onto replica groups, so popular keys are already spread out without YCSB's scrambling
+class ZipfianGenerator:
+    def __init__(self, n, theta):
+        self.n = n
+        self.theta = theta
+        self.zetan = sum(1 / i ** theta for i in range(1, n + 1))
+        zeta2 = 1 + 0.5 ** theta
+
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / n) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+
+    def next(self, rng):
+        u = rng.random()
+        uz = u * self.zetan
+
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5 ** self.theta:
+            return 1
+
+        return min(int(self.n * (self.eta * u - self.eta + 1) ** self.alpha), self.n - 1)
+
+
+class UniformGenerator:
+    def __init__(self, n):
+        self.n = n
+
+    def next(self, rng):
+        return rng.randrange(self.n)
+
+
+def key_name(rank):
+    return f"user{rank:010d}"
+
+
+# Start every replica of the cluster on its own thread; the benchmark runs this in a separate process
+# so each scheme starts from a fresh cluster and stops when the process is terminated
+def serve_replicas(scheme, replica_addresses, sequencer_address, simulated_latency):
+    for i, (ip, port) in enumerate(replica_addresses):
+        replica = Replica(f"replica_{i}", ip, port, scheme,
+                          replica_addresses, sequencer_address)
+
+        # Linear writes would otherwise spend most of their time in the artificial acknowledgement delay
+        replica.simulated_latency = simulated_latency
+        threading.Thread(target=replica.start, daemon=True).start()
+
+    threading.Event().wait()
+
+
+# Serve one worker of a replica that is split between several processes
+def serve_worker(id, ip, port, scheme, replica_addresses, sequencer_address, simulated_latency, worker, workers):
+    replica = Replica(id, ip, port, scheme, replica_addresses,
+                      sequencer_address, worker, workers)
+    replica.simulated_latency = simulated_latency
+    replica.start()
+
+
+# Run operations against the cluster for duration seconds and put the client's histograms on results.
+# A closed-loop client sends its next operation as soon as the last one completes; an open-loop client
+# sends them at a fixed rate and measures each from when it was due, so a slow cluster cannot hide its queueing
+def run_client(index, options, start_time, results):
+    client = Client(f"benchmark_{index}", config_settings["client"]["ip"],
+                    config_settings["client"]["port"] + index)
+    rng = random.Random(options["seed"] + index)
+
+    if options["distribution"] == "zipfian":
+        keys = ZipfianGenerator(options["record_count"], options["zipf_constant"])
+    else:
+        keys = UniformGenerator(options["record_count"])
+
+    value = "x" * options["value_size"]
+    interval = options["clients"] / options["rate"] if options["mode"] == "open" else 0
+    histograms = {"read": LatencyHistogram(), "write": LatencyHistogram()}
+    errors = 0
+    operations = 0
+
+    end_time = start_time + options["duration"]
+    time.sleep(max(start_time - time.time(), 0))
+
+    while True:
+        due = start_time + operations * interval if interval else time.time()
+
+        if due >= end_time:
+            break
+
+        time.sleep(max(due - time.time(), 0))
+        key = key_name(keys.next(rng))
+
+        if rng.random() < options["read_ratio"]:
+            operation = "read"
+            response = client.get(None, key)
+            failed = response != value and response != "Key does not exist"
+        else:
+            operation = "write"
+            response = client.set(None, key, value)
+            failed = not response.startswith("Key-value pair")
+
+        histograms[operation].record(time.time() - due)
+        errors += failed
+        operations += 1
+
+    results.put(({name: histogram.counts for name, histogram in histograms.items()}, errors))
+
+
+class Benchmark:
+    def __init__(self, options):
+        self.options = options
+        self.num_replicas = config_settings["num_replicas"]
+
+        # Clients route keys with the shard map in the config, so the cluster uses the configured replica addresses
+        self.replica_addresses = [(config_settings["replica"]["ip"],
+                                   config_settings["replica"]["port"] + i) for i in range(self.num_replicas)]
+        self.sequencer_address = self.replica_addresses[0]
+
+    def run(self):
+        results = []
+
+        for scheme in self.options["schemes"]:
+            print(f"Benchmarking {scheme} consistency...")
+            result = self.run_scheme(scheme)
+            results.append(result)
+
+            print(f"  {result['throughput']:.0f} ops/s, p50 {result['latency']['p50_ms']} ms, "
+                  f"p99 {result['latency']['p99_ms']} ms, p999 {result['latency']['p999_ms']} ms, "
+                  f"{result['errors']} errors")
+
+        report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "num_replicas": self.num_replicas,
+                  "options": self.options,
+                  "results": results}
+
+        with open(self.options["output"], "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+        print(f"\nResults written to {self.options['output']}")
+
+    def run_scheme(self, scheme):
+        workers = self.options["workers"]
+
+        if workers > 1:
+            replica_processes = [multiprocessing.Process(target=serve_worker,
+                                                         args=(f"replica_{i}", ip, port, scheme, self.replica_addresses,
+                                                               self.sequencer_address, self.options["simulated_latency"],
+                                                               worker, workers))
+                                 for i, (ip, port) in enumerate(self.replica_addresses) for worker in range(workers)]
+        else:
+            replica_processes = [multiprocessing.Process(target=serve_replicas,
+                                                         args=(scheme, self.replica_addresses, self.sequencer_address,
+                                                               self.options["simulated_latency"]))]
+
+        for replica_process in replica_processes:
+            replica_process.start()
+
+        try:
+            self.wait_for_replicas()
+            self.load()
+
+            results = multiprocessing.Queue()
+            start_time = time.time() + 1
+            clients = [multiprocessing.Process(target=run_client, args=(i, self.options, start_time, results))
+                       for i in range(self.options["clients"])]
+
+            for client in clients:
+                client.start()
+
+            histograms = {"read": LatencyHistogram(), "write": LatencyHistogram()}
+            errors = 0
+
+            for _ in clients:
+                counts, client_errors = results.get()
+                errors += client_errors
+
+                for name, histogram in histograms.items():
+                    histogram.merge(LatencyHistogram(counts[name]))
+
+            for client in clients:
+                client.join()
+        finally:
+            for replica_process in replica_processes:
+                replica_process.terminate()
+                replica_process.join()
+
+        latency = LatencyHistogram()
+
+        for histogram in histograms.values():
+            latency.merge(histogram)
+
+        logging.info(f"Benchmarked {scheme} consistency: {latency.summary()}")
+
+        return {"scheme": scheme,
+                "operations": latency.count(),
+                "throughput": latency.count() / self.options["duration"],
+                "errors": errors,
+                "latency": latency.summary(),
+                "read_latency": histograms["read"].summary(),
+                "write_latency": histograms["write"].summary()}
+
+    # Wait until every replica, and every worker of each replica, accepts connections
+    def wait_for_replicas(self, timeout=30):
+        deadline = time.time() + timeout
+        addresses = list(self.replica_addresses)
+
+        if self.options["workers"] > 1:
+            offset = config_settings["replica"].get("worker_port_offset", 1000)
+            addresses += [(ip, port + offset * (worker + 1)) for ip, port in self.replica_addresses
+                          for worker in range(self.options["workers"])]
+
+        for address in addresses:
+            while True:
+                try:
+                    socket.create_connection(address, timeout=1).close()
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise
+
+                    time.sleep(0.1)
+
+    # Write every record before the clients start, so reads find their keys
+    def load(self):
+        client = Client("benchmark_loader", config_settings["client"]["ip"],
+                        config_settings["client"]["port"])
+        value = "x" * self.options["value_size"]
+        batch_size = 1000
+
+        for start in range(0, self.options["record_count"], batch_size):
+            pairs = [(key_name(rank), value)
+                     for rank in range(start, min(start + batch_size, self.options["record_count"]))]
+            response = client.mset(None, pairs)
+
+            if not response.startswith("Key-value pairs"):
+                logging.warning(f"Loading records failed: {response}")
+
+
+# Options come from the benchmark section of the config, and any given on the command line replace them
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Measure throughput and latency of each consistency scheme")
+    parser.add_argument("--schemes", nargs="+",
+                        default=benchmark_settings.get("schemes", config_settings["consistency_schemes"]))
+    parser.add_argument("--workload", choices=sorted(WORKLOADS),
+                        default=benchmark_settings.get("workload", "b"))
+    parser.add_argument("--read-ratio", type=float,
+                        default=benchmark_settings.get("read_ratio"))
+    parser.add_argument("--distribution", choices=["zipfian", "uniform"],
+                        default=benchmark_settings.get("distribution", "zipfian"))
+    parser.add_argument("--zipf-constant", type=float,
+                        default=benchmark_settings.get("zipf_constant", 0.99))
+    parser.add_argument("--record-count", type=int,
+                        default=benchmark_settings.get("record_count", 10000))
+    parser.add_argument("--value-size", type=int,
+                        default=benchmark_settings.get("value_size", 100))
+    parser.add_argument("--clients", type=int,
+                        default=benchmark_settings.get("clients", 8))
+    parser.add_argument("--mode", choices=["closed", "open"],
+                        default=benchmark_settings.get("mode", "closed"))
+    parser.add_argument("--rate", type=float,
+                        default=benchmark_settings.get("rate", 1000))
+    parser.add_argument("--duration", type=float,
+                        default=benchmark_settings.get("duration", 10))
+    parser.add_argument("--simulated-latency", type=float,
+                        default=benchmark_settings.get("simulated_latency", 0))
+    parser.add_argument("--workers", type=int,
+                        default=benchmark_settings.get("workers", config_settings["replica"].get("server_workers", 1)))
+    parser.add_argument("--seed", type=int,
+                        default=benchmark_settings.get("seed", 0))
+    parser.add_argument("--output",
+                        default=benchmark_settings.get("output", "results/benchmark.json"))
+
+    options = vars(parser.parse_args())
+
+    # An explicit read ratio replaces the workload's
+    if options["read_ratio"] is None:
+        options["read_ratio"] = WORKLOADS[options["workload"]]["read_ratio"]
+
+    return options
+
+
+if __name__ == "__main__":
+    Benchmark(parse_options()).run()
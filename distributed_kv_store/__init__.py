@@ -1,4 +1,13 @@
-from .client import Client
-from .replica import Replica
+from .client import Client, Pipeline
+from .replica import Replica, start_replica_workers
 from .kvstore import KeyValueStore, EventualConsistencyKVStore, LinearConsistencyKVStore, SequentialConsistencyKVStore, CausalConsistencyKVStore
-from .utils import load_config, send, read_commands_from_file, get_replica_address, output_dict_to_file
+from .utils import load_config, send, send_batch, send_message, recv_message, ConnectionPool, StripedLock, read_commands_from_file, get_replica_address, output_dict_to_file, load_dict_from_file
+from .wal import WriteAheadLog
+from .protocol import encode_command, decode_command, encode_response, decode_response, pack_fields, unpack_fields, send_command, send_commands
+from .index import SortedKeys
+from .storage import LRUEngine, create_engine
+from .lsm import LSMEngine
+from .sharding import ShardMap, shard_map_from_config
+from .metrics import LatencyHistogram, Metrics
+from .hints import HintQueue, HintedHandoff
+from .expiry import TimerWheel
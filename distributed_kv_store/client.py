@@ -1,22 +1,228 @@
+import json
 import logging
+import random
 import socket
 import time
 
-from .utils import load_config, send, read_commands_from_file, get_replica_address
+from .protocol import combine_mset_responses, send_commands
+from .sharding import shard_map_from_config
+from .utils import load_config, send, send_batch, recv_message, send_message, read_commands_from_file, get_replica_address
 
 config, config_settings = load_config()
 
 
+# Parsers get the fields of a response, one per line in the text protocol
+
+# One value per requested key
+def parse_values(fields):
+    return fields
+
+
+# The key the next page starts at ("" after the last page) and the pairs in this page
+def parse_page(fields):
+    if len(fields) % 2 == 0:
+        logging.error(f"Invalid page: {fields[0] if fields else ''}")
+        return "", []
+
+    return fields[0], list(zip(fields[1::2], fields[2::2]))
+
+
+# Queue commands for one replica and send them together over a single connection
+class Pipeline:
+    # The binary protocol lets keys and values contain spaces, newlines and arbitrary bytes
+    def __init__(self, address, protocol=None):
+        self.address = address
+        self.protocol = protocol or config_settings["client"].get(
+            "protocol", "binary")
+        self.commands = []
+
+        # Session tokens that writes were answered with, by key
+        self.tokens = {}
+
+    # With a session token the replica answers once it has every write the token covers
+    def get(self, key, token=None):
+        self.commands.append(
+            (["get", key] + ([token] if token else []), None))
+        return self
+
+    # With a ttl the key expires that many seconds after it is written
+    def set(self, key, value, ttl=None):
+        self.commands.append((["set", key, value] + ([str(ttl)] if ttl else []),
+                              lambda fields: self.write_response([key], fields)))
+        return self
+
+    def mget(self, keys):
+        self.commands.append((["mget"] + list(keys), parse_values))
+        return self
+
+    # Atomic operations run on the replica in one round trip: incr answers with the new value,
+    # cas with whether it swapped the value, and append with the new value's length
+    def incr(self, key, amount=1):
+        self.commands.append((["incr", key, str(amount)], None))
+        return self
+
+    def cas(self, key, expected, new):
+        self.commands.append((["cas", key, expected, new], None))
+        return self
+
+    def append(self, key, suffix):
+        self.commands.append((["append", key, suffix], None))
+        return self
+
+    def mset(self, pairs):
+        pairs = pairs.items() if isinstance(pairs, dict) else pairs
+        pairs = list(pairs)
+        self.commands.append((["mset"] + [field for pair in pairs for field in pair],
+                              lambda fields: self.write_response([key for key, _ in pairs], fields)))
+        return self
+
+    # Keep the session tokens a write was answered with, one per key, and return its response
+    def write_response(self, keys, fields):
+        self.tokens.update([(key, token)
+                           for key, token in zip(keys, fields[1:]) if token])
+        return fields[0]
+
+    # Pairs with start <= key < end (no upper bound if end is empty), starting at cursor if it is given.
+    # Text commands cannot carry an empty field, so an open bound is sent as "-"
+    def scan(self, start, end, limit, cursor=None):
+        if self.protocol == "text":
+            start, end = start or "-", end or "-"
+
+        self.commands.append((["scan", start, end, str(limit)] +
+                              ([cursor] if cursor else []), parse_page))
+        return self
+
+    def prefix(self, prefix, limit, cursor=None):
+        self.commands.append((["prefix", prefix, str(limit)] +
+                              ([cursor] if cursor else []), parse_page))
+        return self
+
+    # The replica's metrics, replication state and storage size, as a dict
+    def stats(self):
+        self.commands.append((["stats"], lambda fields: json.loads(fields[0])))
+        return self
+
+    # Send every queued command in one write and return the responses in order
+    def execute(self):
+        commands, self.commands = self.commands, []
+
+        if self.protocol == "binary":
+            responses = send_commands(
+                self.address, [fields for fields, _ in commands])
+
+            # Binary responses are already split into fields
+            return [parse(response) if parse else response[0]
+                    for (_, parse), response in zip(commands, responses)]
+
+        responses = send_batch(self.address, [" ".join([str(field) for field in fields])
+                                              for fields, _ in commands])
+
+        return [parse(response.split("\n")) if parse else response
+                for (_, parse), response in zip(commands, responses)]
+
+
 class Client:
     def __init__(self, id, host, port):
         self.id = id
         self.host = host
         self.port = port
         self.command_file = config_settings["client"]["command_file"]
+        self.command_interval = config_settings["client"].get(
+            "command_interval", 1)
+        self.shard_map = shard_map_from_config(config_settings)
+
+        # The newest session token of each key this client has written, so its reads see its own writes on any replica
+        self.session_tokens = {}
 
         logging.debug(
             f"{self.id} initialized at {self.host}:{self.port}")
 
+    def address(self, replica_id):
+        return get_replica_address(replica_id, config_settings["replica"])
+
+    # Return the address of a replica in the group that owns key
+    def route(self, key):
+        return random.choice(self.shard_map.owners(key))
+
+    # Commands without a replica_id go straight to a replica that owns the key
+    def get(self, replica_id, key):
+        address = self.address(replica_id) if replica_id else self.route(key)
+        return Pipeline(address).get(key, self.session_tokens.get(key)).execute()[0]
+
+    def set(self, replica_id, key, value, ttl=None):
+        address = self.address(replica_id) if replica_id else self.route(key)
+        return self.execute(Pipeline(address).set(key, value, ttl))[0]
+
+    # Return the values of several keys in one round trip (one per owning group without a replica_id)
+    def mget(self, replica_id, keys):
+        if replica_id:
+            return self.pipeline(replica_id).mget(keys).execute()[0]
+
+        values = {}
+
+        for group_keys in self.shard_map.split(keys).values():
+            values.update(zip(group_keys, Pipeline(
+                self.route(group_keys[0])).mget(group_keys).execute()[0]))
+
+        return [values.get(key) for key in keys]
+
+    # Set several key-value pairs in one round trip (one per owning group without a replica_id)
+    def mset(self, replica_id, pairs):
+        if replica_id:
+            return self.execute(self.pipeline(replica_id).mset(pairs))[0]
+
+        pairs = list(pairs.items()) if isinstance(pairs, dict) else pairs
+        responses = [self.execute(Pipeline(self.route(group_pairs[0][0])).mset(group_pairs))[0]
+                     for group_pairs in self.shard_map.split(pairs, key=lambda pair: pair[0]).values()]
+
+        return combine_mset_responses(responses)
+
+    def incr(self, replica_id, key, amount=1):
+        address = self.address(replica_id) if replica_id else self.route(key)
+        return Pipeline(address).incr(key, amount).execute()[0]
+
+    def cas(self, replica_id, key, expected, new):
+        address = self.address(replica_id) if replica_id else self.route(key)
+        return Pipeline(address).cas(key, expected, new).execute()[0]
+
+    def append(self, replica_id, key, suffix):
+        address = self.address(replica_id) if replica_id else self.route(key)
+        return Pipeline(address).append(key, suffix).execute()[0]
+
+    # Yield every pair with start <= key < end in key order, fetching limit pairs per round trip.
+    # Without a replica_id the scan goes to any replica, which collects the pairs from every group
+    def scan(self, replica_id, start, end="", limit=100):
+        yield from self.pages(replica_id, start,
+                              lambda pipeline, cursor: pipeline.scan(start, end, limit, cursor))
+
+    def prefix(self, replica_id, prefix, limit=100):
+        yield from self.pages(replica_id, prefix,
+                              lambda pipeline, cursor: pipeline.prefix(prefix, limit, cursor))
+
+    def pages(self, replica_id, key, queue_page):
+        address = self.address(replica_id) if replica_id else self.route(key)
+        cursor = None
+
+        while True:
+            cursor, pairs = queue_page(Pipeline(address), cursor).execute()[0]
+            yield from pairs
+
+            if not cursor:
+                break
+
+    def stats(self, replica_id):
+        return Pipeline(self.address(replica_id)).stats().execute()[0]
+
+    def pipeline(self, replica_id):
+        return Pipeline(self.address(replica_id))
+
+    # Execute a pipeline and add the session tokens of its writes to this client's session
+    def execute(self, pipeline):
+        responses = pipeline.execute()
+        self.session_tokens.update(pipeline.tokens)
+
+        return responses
+
     # Send client commands to replicas
     def execute_commands(self):
         commands = read_commands_from_file(self.command_file)
@@ -33,13 +239,19 @@ class Client:
                 logging.info(
                     f"{self.id} sending command \"{data}\" to {replica_id}")
 
-                response = send(
-                    get_replica_address(replica_id, config_settings["replica"]), data)
+                # Reads and writes carry this client's session, so a read sees its earlier writes on any replica
+                if cmd[0] == "get" and len(cmd) == 2:
+                    response = self.get(replica_id, cmd[1])
+                elif cmd[0] == "set" and len(cmd) in (3, 4):
+                    response = self.set(replica_id, cmd[1], cmd[2],
+                                        cmd[3] if len(cmd) == 4 else None)
+                else:
+                    response = send(self.address(replica_id), data)
 
                 logging.info(
                     f"{self.id} received response \"{response}\" from {replica_id}")
 
-                time.sleep(1)
+                time.sleep(self.command_interval)
 
     def run(self):
         # Notify the main node that the client is running
@@ -58,11 +270,14 @@ class Client:
 
         while cmd != "run":
             conn, addr = sock.accept()
-            cmd = conn.recv(1024).decode()
 
-            if cmd == "run":
-                response = f"{self.id} running"
-                conn.send(response.encode())
+            with conn:
+                message = recv_message(conn)
+                cmd = message.decode() if message else ""
+
+                if cmd == "run":
+                    response = f"{self.id} running"
+                    send_message(conn, response)
 
         logging.debug(f"{self.id} received run command")
 
@@ -0,0 +1,79 @@
+import math
+import threading
+import time
+
+
+# Return the wall-clock deadline of a write that expires ttl seconds from now, or None if it never expires.
+# Deadlines are replicated with the write, so every replica expires the key at the same time
+def deadline_after(ttl):
+    if ttl is None:
+        return None
+
+    if not 0 < ttl < math.inf:
+        raise ValueError(f"Invalid time to live: {ttl}")
+
+    return time.time() + ttl
+
+
+# Deadlines are sent as a field of each replicated write, empty for keys that never expire
+def format_deadline(deadline):
+    return "" if deadline is None else repr(deadline)
+
+
+def parse_deadline(field):
+    return float(field) if field else None
+
+
+# Hashed timer wheel: each key waits in the slot of the tick its deadline falls in, so scheduling, cancelling and
+# expiring a key are all O(1). Deadlines more than one turn of the wheel away stay in their slot until their turn comes
+class TimerWheel:
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+
+        # The tick each scheduled key is due at, and the last tick that has been processed
+        self.ticks = {}
+        self.current = int(time.time() / tick)
+        self.lock = threading.Lock()
+
+    # Schedule key to be returned by advance once deadline has passed, replacing any earlier schedule
+    def schedule(self, key, deadline):
+        with self.lock:
+            self.discard(key)
+
+            # A deadline that has already passed is due on the next tick
+            tick = max(math.ceil(deadline / self.tick), self.current + 1)
+            self.ticks[key] = tick
+            self.slots[tick % len(self.slots)][key] = tick
+
+    def cancel(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def discard(self, key):
+        tick = self.ticks.pop(key, None)
+
+        if tick is not None:
+            del self.slots[tick % len(self.slots)][key]
+
+    # Return the keys that have become due by now. After a pause longer than a turn of the wheel every slot is visited once
+    def advance(self, now):
+        due = []
+
+        with self.lock:
+            target = int(now / self.tick)
+
+            for tick in range(max(self.current + 1, target - len(self.slots) + 1), target + 1):
+                slot = self.slots[tick % len(self.slots)]
+
+                for key in [key for key, key_tick in slot.items() if key_tick <= target]:
+                    del slot[key]
+                    del self.ticks[key]
+                    due.append(key)
+
+            self.current = max(self.current, target)
+
+        return due
+
+    def __len__(self):
+        return len(self.ticks)
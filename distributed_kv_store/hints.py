@@ -0,0 +1,191 @@
+import logging
+import os
+import threading
+
+from .protocol import decode_response, encode_command, send_command
+from .utils import HEADER, exchange, frame
+
+# Hints are replayed in batches of about this many bytes, each sent over one connection in a single write
+REPLAY_BYTES = 1 << 20
+
+
+# Durable queue of commands that could not be sent to one peer. Commands are appended to a file and replayed in
+# order once the peer is back, retrying with exponential backoff while it is down. The file never grows beyond
+# max_bytes; commands that do not fit are dropped and counted
+class HintQueue:
+    def __init__(self, filename, address, max_bytes, retry_interval, max_retry_interval, recover):
+        self.filename = filename
+        self.address = address
+        self.max_bytes = max_bytes
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+
+        # Hints from a previous run are only replayed when the replica recovers its store
+        if not recover and os.path.exists(filename):
+            os.remove(filename)
+
+        self.file = open(filename, "a+b", buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        # Hints before offset have been delivered; the file is emptied once all of them have
+        self.offset = 0
+        self.delivered = 0
+        self.dropped = 0
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        if self.size:
+            self.wakeup.set()
+
+        threading.Thread(target=self.delivery_thread, daemon=True).start()
+
+    def pending(self):
+        return self.size > self.offset
+
+    # Store a command for the peer, returning False if the queue is full
+    def add(self, command):
+        record = frame(encode_command(command))
+
+        with self.lock:
+            if self.size + len(record) > self.max_bytes:
+                self.dropped += 1
+                return False
+
+            was_empty = not self.pending()
+            self.file.write(record)
+            os.fsync(self.file.fileno())
+            self.size += len(record)
+
+        # Later hints wait for the retry schedule rather than each trying a peer that is down
+        if was_empty:
+            self.wakeup.set()
+
+        return True
+
+    # Return the next batch of undelivered commands and the offset after them
+    def read(self):
+        messages = []
+        batch_bytes = 0
+
+        with self.lock:
+            offset = self.offset
+
+            while offset < self.size and batch_bytes < REPLAY_BYTES:
+                (length,) = HEADER.unpack(os.pread(
+                    self.file.fileno(), HEADER.size, offset))
+                messages.append(os.pread(self.file.fileno(),
+                                length, offset + HEADER.size))
+                offset += HEADER.size + length
+                batch_bytes += length
+
+        return messages, offset
+
+    # Mark the hints up to offset as delivered, emptying the file once all of them are, or dropping the delivered
+    # ones once they take up half of it
+    def acknowledge(self, offset, count):
+        with self.lock:
+            self.offset = offset
+            self.delivered += count
+
+            if not self.pending():
+                self.file.truncate(0)
+                self.size = self.offset = 0
+            elif self.offset > self.max_bytes // 2:
+                self.compact()
+
+    def compact(self):
+        temp_filename = f"{self.filename}.tmp"
+
+        with open(temp_filename, "wb") as f:
+            f.write(os.pread(self.file.fileno(),
+                    self.size - self.offset, self.offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_filename, self.filename)
+        self.file.close()
+        self.file = open(self.filename, "a+b", buffering=0)
+        self.size -= self.offset
+        self.offset = 0
+
+    # Send a batch of commands, returning whether the peer applied all of them; replaying one twice is harmless
+    def deliver(self, messages):
+        try:
+            replies = exchange(self.address, messages)
+        except Exception as e:
+            logging.debug(
+                f"Could not deliver hints to {self.address[0]}:{self.address[1]}: {e}")
+            return False
+
+        return all(decode_response(reply) == ["Update successful"] for reply in replies)
+
+    # Send batches of hints until there are none left or the peer stops applying them, returning how many were delivered
+    def replay(self):
+        delivered = 0
+
+        while self.pending():
+            messages, offset = self.read()
+
+            if not self.deliver(messages):
+                break
+
+            self.acknowledge(offset, len(messages))
+            delivered += len(messages)
+
+        return delivered
+
+    def delivery_thread(self):
+        interval = self.retry_interval
+
+        while True:
+            self.wakeup.wait(interval if self.pending() else None)
+            self.wakeup.clear()
+
+            try:
+                delivered = self.replay()
+            except OSError as e:
+                logging.error(f"Error replaying hints from {self.filename}: {e}")
+                delivered = 0
+
+            if delivered:
+                logging.info(
+                    f"Delivered {delivered} hinted commands to {self.address[0]}:{self.address[1]}")
+
+            # Wait twice as long before each retry while the peer stays down
+            if self.pending():
+                interval = min(interval * 2, self.max_retry_interval)
+            else:
+                interval = self.retry_interval
+
+    def stats(self):
+        with self.lock:
+            return {"pending_bytes": self.size - self.offset,
+                    "delivered": self.delivered, "dropped": self.dropped}
+
+
+# One hint queue for each peer of a replica, kept in a directory next to its store
+class HintedHandoff:
+    def __init__(self, replica, peers):
+        directory = f"{replica.storage_location}_hints"
+        os.makedirs(directory, exist_ok=True)
+
+        self.queues = {address: HintQueue(f"{directory}/{address[0]}_{address[1]}.hints", address,
+                                          replica.hint_max_bytes, replica.hint_retry_interval,
+                                          replica.hint_max_retry_interval, replica.recover_on_startup)
+                       for address in peers}
+
+    # Send command to a peer, or queue it as a hint if the peer cannot be reached or still has hints waiting,
+    # so the peer receives commands in the order they were sent. Returns whether the peer applied it now
+    def send(self, address, command):
+        hints = self.queues[address]
+
+        if not hints.pending() and send_command(address, command) == ["Update successful"]:
+            return True
+
+        hints.add(command)
+
+        return False
+
+    def stats(self):
+        return {f"{host}:{port}": hints.stats() for (host, port), hints in self.queues.items()}
@@ -0,0 +1,92 @@
+import bisect
+import threading
+
+# Target length of each sublist; a sublist is split in two once it grows to twice this
+SUBLIST_LENGTH = 1000
+
+
+# Sorted set of keys kept as a list of short sorted sublists, so an insert or delete only shifts one sublist
+class SortedKeys:
+    def __init__(self, keys=()):
+        keys = sorted(set(keys))
+
+        self.sublists = [keys[i:i + SUBLIST_LENGTH]
+                         for i in range(0, len(keys), SUBLIST_LENGTH)]
+        # The largest key of each sublist, used to find the sublist a key belongs in
+        self.maxes = [sublist[-1] for sublist in self.sublists]
+        self.length = len(keys)
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            if not self.sublists:
+                self.sublists.append([key])
+                self.maxes.append(key)
+                self.length += 1
+                return
+
+            # Keys larger than every other key go at the end of the last sublist
+            i = min(bisect.bisect_left(self.maxes, key), len(self.maxes) - 1)
+            sublist = self.sublists[i]
+            j = bisect.bisect_left(sublist, key)
+
+            if j < len(sublist) and sublist[j] == key:
+                return
+
+            sublist.insert(j, key)
+            self.maxes[i] = sublist[-1]
+            self.length += 1
+
+            if len(sublist) >= 2 * SUBLIST_LENGTH:
+                self.sublists[i:i + 1] = [sublist[:SUBLIST_LENGTH],
+                                          sublist[SUBLIST_LENGTH:]]
+                self.maxes[i:i + 1] = [sublist[SUBLIST_LENGTH - 1], sublist[-1]]
+
+    def discard(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, key)
+
+            if i == len(self.maxes):
+                return
+
+            sublist = self.sublists[i]
+            j = bisect.bisect_left(sublist, key)
+
+            if sublist[j] != key:
+                return
+
+            del sublist[j]
+            self.length -= 1
+
+            if sublist:
+                self.maxes[i] = sublist[-1]
+            else:
+                del self.sublists[i]
+                del self.maxes[i]
+
+    # Return up to count keys from start onwards, in order
+    def range(self, start, count):
+        keys = []
+
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, start)
+
+            if i < len(self.sublists):
+                sublist = self.sublists[i]
+                keys += sublist[bisect.bisect_left(sublist, start):][:count]
+
+            for sublist in self.sublists[i + 1:]:
+                if len(keys) >= count:
+                    break
+
+                keys += sublist[:count - len(keys)]
+
+        return keys
+
+    # Return every key in order, without sorting
+    def keys(self):
+        with self.lock:
+            return [key for sublist in self.sublists for key in sublist]
+
+    def __len__(self):
+        return self.length
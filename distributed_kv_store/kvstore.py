@@ -1,71 +1,398 @@
 import logging
+import queue
 import random
 import threading
 import time
 
-from .utils import load_config, output_dict_to_file, send, simulate_latency
+from .expiry import TimerWheel, deadline_after, format_deadline, parse_deadline
+from .hints import HintedHandoff
+from .index import SortedKeys
+from .merkle import MerkleTree
+from .protocol import encode_field, pack_fields, send_command, send_commands
+from .utils import Batcher, StripedLock, load_config, load_dict_from_file, output_dict_to_file, simulate_latency
+from .wal import read_log
 
 config, config_settings = load_config()
 
 
+# Return the value an atomic operation writes to a key whose value is current (None if it has none), or None if it
+# writes nothing, and the operation's response
+def apply_operation(action, current, args):
+    if action == "incr":
+        # incr key amount adds amount to an integer value, starting from 0
+        try:
+            value = str(int(current or "0") + int(args[0]))
+        except ValueError:
+            return None, "Value is not an integer"
+
+        return value, value
+    elif action == "cas":
+        # cas key expected new writes new only if the value is expected
+        if current != args[0]:
+            return None, "Value did not match"
+
+        return args[1], "Value swapped"
+    elif action == "append":
+        # append key suffix answers with the length of the new value
+        value = (current or "") + args[0]
+
+        return value, str(len(value))
+
+    raise ValueError(f"Unknown operation: {action}")
+
+
 class KeyValueStore:
+    # Commands that wait on other replicas and must not run on an event loop
+    blocking_commands = set()
+
     def __init__(self):
+        # Storage engine chosen by the replica; a dict keeps every key in memory
         self.store = {}
+        # Every key in order, for range scans and snapshots
+        self.index = SortedKeys()
+
+        # Writes to a key hold its lock, so the store, index and log always agree on the key's last write
+        self.key_locks = StripedLock(
+            config_settings["replica"].get("lock_stripes", 64))
+
+        # Reads with a session token wait on this until the replica has caught up with the token
+        self.progress = threading.Condition()
+        self.session_waiters = 0
         self.vector_clock = {}
 
+        # Write-ahead log attached by the replica; None keeps the store in memory only
+        self.wal = None
+        self.save_lock = threading.Lock()
+
+        # While the store is copied from a peer, the keys written since the copy began, whose copied values are older
+        self.bootstrap_writes = None
+
+        # Wall-clock deadlines of keys written with a time to live, removed a tick of the timer wheel after they pass
+        self.deadlines = {}
+        self.expiry = TimerWheel(config_settings["replica"].get("expiry_tick", 100) / 1000,
+                                 config_settings["replica"].get("expiry_wheel_slots", 512))
+        threading.Thread(target=self.expiry_thread, daemon=True).start()
+
         # Initialize the vector clock
         for i in range(config_settings["num_replicas"]):
             replica_id = f"replica_{i}"
             self.vector_clock[replica_id] = 0
 
+    # One lookup, since a storage engine may have to read the key from disk. Keys past their deadline read as
+    # missing even before the expiry thread removes them
     def get(self, key):
-        if key in self.store:
-            return self.store[key]
-        else:
+        if self.deadlines and self.is_expired(key):
             return "Key does not exist"
 
-    def set(self, key, value, replica_id=None, vector_clock=None):
+        return self.store.get(key, "Key does not exist")
+
+    def is_expired(self, key):
+        deadline = self.deadlines.get(key)
+
+        return deadline is not None and deadline <= time.time()
+
+    # The value and deadline of key, or None for both if it is missing or has expired
+    def current(self, key):
+        if self.is_expired(key):
+            return None, None
+
+        return self.store.get(key), self.deadlines.get(key)
+
+    # Apply an atomic operation to key and return its response. The new value keeps the key's deadline
+    def atomic(self, action, key, args):
+        with self.key_locks.lock(key):
+            current, deadline = self.current(key)
+            value, response = apply_operation(action, current, args)
+
+            if value is not None:
+                self.put(key, value, deadline)
+
+        return response
+
+    # A ttl makes the key expire that many seconds after it is written
+    def set(self, key, value, replica_id=None, vector_clock=None, ttl=None):
+        deadline = deadline_after(ttl)
+
         # If a replica ID or vector clock are not provided, update the key-value pair
         if replica_id is None or vector_clock is None:
-            self.store[key] = value
+            self.put(key, value, deadline)
         # If they are provided, only update the key-value pair if the vector clock is greater than the current vector clock
         elif replica_id not in self.vector_clock or self.vector_clock[replica_id] <= vector_clock:
-            self.store[key] = value
+            self.put(key, value, deadline)
 
             # Update the vector clock
-            self.vector_clock[replica_id] = vector_clock
+            self.set_clock(replica_id, vector_clock)
 
         return "Key-value pair added"
 
     def delete(self, key):
         if key in self.store:
-            del self.store[key]
+            self.remove(key)
             return "Key deleted"
         else:
             return "Key does not exist"
 
-    def update(self, updates):
-        for i in range(0, len(updates), 4):
-            key = updates[i]
-            value = updates[i + 1]
-            replica_id = updates[i + 2] if i + 2 < len(updates) else None
-            vector_clock = int(updates[i + 3]) if i + \
-                3 < len(updates) else None
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def mset(self, pairs):
+        for key, value in pairs:
+            self.set(key, value)
+
+        return "Key-value pairs added"
+
+    # Return up to limit pairs from start onwards that are before end (if end is not empty) and start with prefix,
+    # in key order, and the key the next page starts at ("" when there are no more)
+    def scan(self, start, end, limit, prefix=""):
+        keys = []
+
+        # Keys with the same prefix are next to each other, so the page ends at the first one without it
+        for key in self.index.range(start, limit + 1):
+            if (end and key >= end) or not key.startswith(prefix):
+                break
+
+            keys.append(key)
+
+        pairs = []
+
+        for key in keys[:limit]:
+            value = self.store.get(key)
+
+            if value is not None and not self.is_expired(key):
+                pairs.append((key, value))
+
+        return (keys[limit] if len(keys) > limit else ""), pairs
+
+    # Return one chunk of the store for a replica copying it: the key the next chunk starts at ("" after the last),
+    # the replication position the copy continues from, taken with the first chunk, and the entries of up to limit keys.
+    # The position is taken before any key is read, so every copied value is at least as new as it
+    def snapshot(self, cursor, limit):
+        position = "" if cursor else self.snapshot_position()
+        keys = self.index.range(cursor, limit + 1)
+        entries = []
+
+        for key in keys[:limit]:
+            value = self.store.get(key)
+
+            if value is not None:
+                entries.extend(self.snapshot_entry(key, value))
+
+        return [keys[limit] if len(keys) > limit else "", position] + entries
+
+    # How far this replica has applied replication, as sent with a snapshot; empty when there is nothing to track
+    def snapshot_position(self):
+        return ""
+
+    def snapshot_entry(self, key, value):
+        return (key, value, format_deadline(self.deadlines.get(key)))
+
+    # Start copying the store from a peer; writes and replication keep being applied meanwhile
+    def begin_bootstrap(self):
+        self.bootstrap_writes = set()
+
+    # Load one chunk of a peer's store, keeping keys written since the copy began, and return how many keys it held
+    def load_snapshot(self, entries):
+        for i in range(0, len(entries) - 2, 3):
+            with self.key_locks.lock(entries[i]):
+                if entries[i] not in self.bootstrap_writes:
+                    self.put(entries[i], entries[i + 1],
+                             parse_deadline(entries[i + 2]))
+                    # A copy from another peer, if this one fails, may still replace it
+                    self.bootstrap_writes.discard(entries[i])
+
+        return len(entries) // 3
+
+    # Continue replicating from the position the copy was taken at
+    def finish_bootstrap(self, position):
+        self.bootstrap_writes = None
 
-            # If a replica ID or vector clock are not provided, update the key-value pair
-            if replica_id is None or vector_clock is None:
-                self.store[key] = value
-            # If they are provided, only update the key-value pair if the vector clock is greater than the current vector clock
-            elif replica_id not in self.vector_clock or self.vector_clock[replica_id] < vector_clock:
-                self.store[key] = value
+    # Return a token that a read of key on any replica can wait for, so it sees this replica's latest write to key.
+    # An empty token means reads never have to wait
+    def session_token(self, key):
+        return ""
 
-                # Update the vector clock
-                self.vector_clock[replica_id] = vector_clock
+    # Return whether this replica has applied every write that token covers
+    def caught_up(self, key, token):
+        return True
+
+    # Return the address of a replica that is sure to have applied every write that token covers
+    def session_source(self, token):
+        return None
+
+    # Wait up to timeout seconds for this replica to catch up with token, returning whether it did
+    def wait_for_session(self, key, token, timeout):
+        with self.progress:
+            self.session_waiters += 1
+
+            try:
+                return self.progress.wait_for(lambda: self.caught_up(key, token), timeout)
+            finally:
+                self.session_waiters -= 1
+
+    # Wake reads waiting for a session token; called after the state they check has changed
+    def notify_progress(self):
+        if self.session_waiters:
+            with self.progress:
+                self.progress.notify_all()
+
+    # Storage size and replication state reported by the stats command; engines that have more to say define stats()
+    def stats(self):
+        storage = {"engine": type(self.store).__name__, "keys": len(self.index),
+                   "expiring_keys": len(self.deadlines)}
+
+        if hasattr(self.store, "stats"):
+            storage.update(self.store.stats())
+
+        return {"storage": storage,
+                "unsnapshotted_log_records": self.wal.records if self.wal else 0}
+
+    # Apply updates formatted as key value deadline
+    def update(self, updates):
+        for i in range(0, len(updates) - 2, 3):
+            self.put(updates[i], updates[i + 1],
+                     parse_deadline(updates[i + 2]))
 
         return "Update successful"
 
+    # Write a key-value pair to the store, expiring at deadline if it is not None, and record it in the write-ahead log
+    def put(self, key, value, deadline=None):
+        with self.key_locks.lock(key):
+            # The store and index are written first so a concurrent snapshot can never miss a logged write
+            self.store[key] = value
+            self.index.add(key)
+            self.set_deadline(key, deadline)
+
+            if self.bootstrap_writes is not None:
+                self.bootstrap_writes.add(key)
+
+            if self.wal is not None:
+                self.wal.append(["set", key, value] if deadline is None else ["set", key, value, deadline])
+
+    def remove(self, key):
+        with self.key_locks.lock(key):
+            self.store.pop(key, None)
+            self.index.discard(key)
+            self.set_deadline(key, None)
+
+            if self.wal is not None:
+                self.wal.append(["delete", key])
+
+    # A write without a deadline replaces the deadline of the one before it
+    def set_deadline(self, key, deadline):
+        if deadline is not None:
+            self.deadlines[key] = deadline
+            self.expiry.schedule(key, deadline)
+        elif self.deadlines.pop(key, None) is not None:
+            self.expiry.cancel(key)
+
+    # Remove keys whose deadline has passed, one tick of the timer wheel at a time
+    def expiry_thread(self):
+        while True:
+            time.sleep(self.expiry.tick)
+
+            for key in self.expiry.advance(time.time()):
+                try:
+                    self.expire(key)
+                except Exception as e:
+                    logging.error(f"Error expiring {key}: {e}")
+
+    # Each replica removes a key once the deadline it was written with has passed, so the removal is not replicated.
+    # Return whether the key was removed
+    def expire(self, key):
+        with self.key_locks.lock(key):
+            deadline = self.deadlines.get(key)
+
+            # The key was written again without a deadline
+            if deadline is None:
+                return False
+
+            # The deadline falls later in the tick that has just begun
+            if deadline > time.time():
+                self.expiry.schedule(key, deadline)
+                return False
+
+            self.remove(key)
+
+        return True
+
+    def set_clock(self, replica_id, vector_clock):
+        self.vector_clock[replica_id] = vector_clock
+
+        if self.wal is not None:
+            self.wal.append(["clock", replica_id, vector_clock])
+
+    # Apply a write-ahead log record without logging it again
+    def apply_record(self, record):
+        action = record[0]
+
+        if action == "set":
+            self.store[record[1]] = record[2]
+
+            if len(record) > 3:
+                self.deadlines[record[1]] = record[3]
+            else:
+                self.deadlines.pop(record[1], None)
+        elif action == "delete":
+            self.store.pop(record[1], None)
+            self.deadlines.pop(record[1], None)
+        elif action == "deadlines":
+            self.deadlines.update(record[1])
+        elif action == "clock":
+            self.vector_clock[record[1]] = record[2]
+        elif action == "clocks":
+            self.vector_clock.update(record[1])
+
+    # Rebuild the store from the last snapshot and the write-ahead log written since, returning how much was loaded
+    def recover(self, snapshot_filename, log_filename):
+        # Persistent engines have already reopened their own files
+        if not getattr(self.store, "persistent", False):
+            self.store.update(load_dict_from_file(snapshot_filename))
+
+        records = 0
+
+        # A rotated log is only left behind if the snapshot covering it did not finish
+        for filename in (f"{log_filename}.old", log_filename):
+            for record in read_log(filename):
+                self.apply_record(record)
+                records += 1
+
+        self.index = SortedKeys(self.store)
+
+        # Keys whose deadline passed while the replica was down are removed on the first tick
+        for key, deadline in self.deadlines.items():
+            self.expiry.schedule(key, deadline)
+
+        return len(self.index), records
+
+    # Write a snapshot of the store and discard the log it replaces
     def save(self, filename):
-        output_dict_to_file(self.store, filename)
+        with self.save_lock:
+            if self.wal is None:
+                output_dict_to_file(self.store, filename, self.index.keys())
+                return "Save successful"
+
+            persistent = getattr(self.store, "persistent", False)
+
+            # Writes made after the rotation go to the new log, so the snapshot plus the new log is complete
+            with self.wal.lock:
+                # The snapshot holds values only, so the new log also starts with the deadlines of the keys in it
+                self.wal.rotate([["clocks", dict(self.vector_clock)],
+                                 ["deadlines", dict(self.deadlines)]])
+
+                if persistent:
+                    self.store.freeze()
+                else:
+                    store = self.store.copy()
+                    keys = self.index.keys()
+
+            # A persistent engine only has to write out the memtable holding the writes in the rotated log
+            if persistent:
+                self.store.flush()
+            else:
+                output_dict_to_file(store, filename, keys)
+
+            self.wal.remove_rotated()
+
         return "Save successful"
 
 
@@ -73,145 +400,1082 @@ class EventualConsistencyKVStore(KeyValueStore):
     def __init__(self, replica):
         super().__init__()
         self.replica = replica
-        self.pending_updates = {address: []
-                                for address in self.replica.replica_addresses}
+        self.peers = [address for address in self.replica.replica_addresses
+                      if address != (self.replica.host, self.replica.port)]
+
+        # Gossip a peer misses is kept on disk and delivered when it is back, rather than waiting for anti-entropy
+        self.hints = HintedHandoff(self.replica, self.peers)
+
+        # Writes waiting to be gossiped, keyed by key so only the newest write to each key is sent.
+        # The batch is swapped out under pending_lock, so a write is never added to a batch that was already sent
+        self.pending_updates = {}
+        self.pending_bytes = 0
+        self.pending_lock = threading.Lock()
+
+        # Set to send a full batch early, or to restart the schedule when a write arrives after gossip has backed off
+        self.gossip_wakeup = threading.Event()
+        self.backed_off = False
+
+        # The newest write wins, so every key keeps the (timestamp, replica_id) of its last write
+        self.versions = {}
+        self.merkle_tree = MerkleTree(self.replica.merkle_depth)
 
         threading.Thread(target=self.gossip_thread).start()
+        threading.Thread(target=self.anti_entropy_thread, daemon=True).start()
 
-    def set(self, key, value):
-        super().set(key, value)
+    # The write is stamped, compared and applied under the key's lock like a gossiped update, so a newer update
+    # that arrives meanwhile, for example from a replica whose clock is ahead, is never overwritten
+    def set(self, key, value, ttl=None):
+        deadline = deadline_after(ttl)
 
-        # Queue new key-value pair to be sent to each replica
-        for address in self.replica.replica_addresses:
-            if address != (self.replica.host, self.replica.port):
-                self.pending_updates.setdefault(
-                    address, []).append((key, value))
+        with self.key_locks.lock(key):
+            version = (time.time(), self.replica.id)
+
+            if version > self.versions.get(key, (0, "")):
+                self.put(key, value, version, deadline)
+                self.queue_update(key, value, version, deadline)
 
         return "Key-value pair added"
 
-    # Gossip pending updates to each replica every gossip_interval seconds
+    # The operation reads and writes the key under its lock, so it is atomic with the other writes to it on this replica
+    def atomic(self, action, key, args):
+        with self.key_locks.lock(key):
+            current, deadline = self.current(key)
+            value, response = apply_operation(action, current, args)
+
+            if value is not None:
+                version = (time.time(), self.replica.id)
+                self.put(key, value, version, deadline)
+                self.queue_update(key, value, version, deadline)
+
+        return response
+
+    # Queue a write to be gossiped, replacing any older write to the same key that has not been sent yet
+    def queue_update(self, key, value, version, deadline=None):
+        if not self.peers:
+            return
+
+        with self.pending_lock:
+            pending = self.pending_updates.get(key)
+
+            if pending is None or version > pending[1]:
+                # A replaced write is no longer sent, so it no longer counts towards the batch
+                if pending is not None:
+                    self.pending_bytes -= self.update_size(key, pending[0])
+
+                self.pending_updates[key] = (value, version, deadline)
+                self.pending_bytes += self.update_size(key, value)
+
+            full = self.batch_full()
+
+        if full or self.backed_off:
+            self.gossip_wakeup.set()
+
+    def update_size(self, key, value):
+        return len(encode_field(key)) + len(encode_field(value))
+
+    def batch_full(self):
+        return len(self.pending_updates) >= self.replica.gossip_batch_size or \
+            self.pending_bytes >= self.replica.gossip_batch_bytes
+
+    # Write a key-value pair and keep its version and Merkle tree leaf up to date
+    def put(self, key, value, version=(0, ""), deadline=None):
+        with self.key_locks.lock(key):
+            old_value = self.store.get(key)
+
+            if old_value is not None:
+                self.merkle_tree.remove(key, old_value)
+
+            super().put(key, value, deadline)
+            self.versions[key] = version
+            self.merkle_tree.add(key, value)
+
+        self.notify_progress()
+
+    def remove(self, key):
+        with self.key_locks.lock(key):
+            old_value = self.store.get(key)
+
+            if old_value is not None:
+                self.merkle_tree.remove(key, old_value)
+
+            super().remove(key)
+
+    # Updates that arrive after their deadline are ignored, so an expired key no longer needs its version
+    def expire(self, key):
+        with self.key_locks.lock(key):
+            expired = super().expire(key)
+
+            if expired:
+                self.versions.pop(key, None)
+
+        return expired
+
+    # The version of the last write to key, which a replica has caught up with once its version of key is as new
+    def session_token(self, key):
+        timestamp, replica_id = self.versions.get(key, (0, ""))
+
+        return f"{timestamp!r}@{replica_id}" if replica_id else ""
+
+    def caught_up(self, key, token):
+        timestamp, _, replica_id = token.partition("@")
+
+        return self.versions.get(key, (0, "")) >= (float(timestamp), replica_id)
+
+    # The replica that made the write always has it
+    def session_source(self, token):
+        return self.replica.address_of(token.partition("@")[2])
+
+    # Apply updates formatted as key value timestamp replica_id deadline, keeping the newest write to each key
+    def update(self, updates):
+        self.apply_updates(updates)
+
+        return "Update successful"
+
+    # Apply gossiped writes. When each round only reaches some of the peers, the writes that were new here are passed on
+    def receive_gossip(self, updates):
+        applied = self.apply_updates(updates)
+
+        if 0 < self.replica.gossip_fanout < len(self.peers):
+            for key, value, version, deadline in applied:
+                self.queue_update(key, value, version, deadline)
+
+        return "Update successful"
+
+    # Copied entries carry their versions, so they only replace older writes like any other update
+    def snapshot_entry(self, key, value):
+        return self.format_update(key, value, self.versions.get(key, (0, "")), self.deadlines.get(key))
+
+    def load_snapshot(self, entries):
+        self.apply_updates(entries, record_lag=False)
+
+        return len(entries) // 5
+
+    # Return the updates that were newer than the stored version of their key. Updates whose deadline has passed are
+    # dropped, since the key has already expired everywhere else
+    def apply_updates(self, updates, record_lag=True):
+        applied = []
+        now = time.time()
+
+        for i in range(0, len(updates) - 4, 5):
+            key = updates[i]
+            version = (float(updates[i + 2]), updates[i + 3])
+            deadline = parse_deadline(updates[i + 4])
+
+            if deadline is not None and deadline <= now:
+                continue
+
+            # The version check and the write are one step, so an older concurrent update can never overwrite a newer one
+            with self.key_locks.lock(key):
+                if version > self.versions.get(key, (0, "")):
+                    self.put(key, updates[i + 1], version, deadline)
+                    applied.append((key, updates[i + 1], version, deadline))
+
+        # Versions are stamped with the time of the write, so this is how long writes took to get here
+        if record_lag:
+            now = time.time()
+
+            for _, _, version, _ in applied:
+                self.replica.metrics.observe("gossip_lag", now - version[0])
+
+        return applied
+
+    def stats(self):
+        stats = super().stats()
+
+        with self.pending_lock:
+            stats["replication"] = {"pending_updates": len(self.pending_updates),
+                                    "pending_bytes": self.pending_bytes,
+                                    "backed_off": self.backed_off}
+
+        stats["replication"]["hints"] = self.hints.stats()
+
+        return stats
+
+    def recover(self, snapshot_filename, log_filename):
+        recovered = super().recover(snapshot_filename, log_filename)
+
+        # Recovered keys have no version, so any write a peer has made to them wins
+        for key, value in self.store.items():
+            self.merkle_tree.add(key, value)
+
+        return recovered
+
+    # Gossip queued writes every gossip_interval seconds, sooner when a batch fills up, and backing off
+    # up to gossip_max_interval seconds while there is nothing to send
     def gossip_thread(self):
+        interval = self.replica.gossip_interval
+
         while True:
-            time.sleep(self.replica.gossip_interval)
-            self.send_updates()
+            woken = self.gossip_wakeup.wait(interval)
+            self.gossip_wakeup.clear()
+
+            # The first write after backing off is sent a normal interval later, unless its batch is already full
+            with self.pending_lock:
+                full = self.batch_full()
+
+            if woken and self.backed_off and not full:
+                self.backed_off = False
+                interval = self.replica.gossip_interval
+                continue
+
+            if self.send_updates():
+                interval = self.replica.gossip_interval
+            else:
+                interval = min(interval * 2, self.replica.gossip_max_interval)
 
-    # Send updates to each replica
+            self.backed_off = interval > self.replica.gossip_interval
+
+            # A write queued just before backed_off was set did not wake this thread, so do not wait long for it
+            if self.backed_off and self.pending_updates:
+                self.backed_off = False
+                interval = self.replica.gossip_interval
+
+    # Send the queued writes to every peer, or to gossip_fanout random peers, returning whether there were any
     def send_updates(self):
-        for target_replica, updates in self.pending_updates.items():
-            # If there are pending updates for the target_replica, send them
-            if updates:
-                data = "update " + \
-                    " ".join([f"{key} {value}" for key, value in updates])
-                send(target_replica, data)
+        # Take the queued writes and leave an empty batch for new writes in one step
+        with self.pending_lock:
+            updates = self.pending_updates
+            self.pending_updates = {}
+            self.pending_bytes = 0
+
+        if not updates:
+            return False
+
+        fields = [field for key, (value, version, deadline) in updates.items()
+                  for field in self.format_update(key, value, version, deadline)]
+        command = ["gossip"] + \
+            pack_fields(fields, self.replica.gossip_compress_bytes)
+
+        peers = self.peers
+
+        if 0 < self.replica.gossip_fanout < len(peers):
+            peers = random.sample(peers, self.replica.gossip_fanout)
+
+        for peer in peers:
+            self.hints.send(peer, command)
+
+        return True
+
+    # Unversioned keys are sent from replica "-", which beats the unversioned default so differing ranges still converge
+    def format_update(self, key, value, version, deadline=None):
+        timestamp, replica_id = version
+        return (key, value, repr(timestamp), replica_id or "-", format_deadline(deadline))
+
+    # Compare Merkle trees with a random replica every anti_entropy_interval seconds
+    def anti_entropy_thread(self):
+        while True:
+            time.sleep(self.replica.anti_entropy_interval)
+
+            peers = [address for address in self.replica.replica_addresses
+                     if address != (self.replica.host, self.replica.port)]
+
+            if peers:
+                self.synchronize(random.choice(peers))
+
+    # Walk down the Merkle trees of this replica and a peer, then exchange only the key ranges that differ
+    def synchronize(self, address):
+        nodes = [1]
+        buckets = []
+
+        while nodes:
+            remote_hashes = send_command(
+                address, ["merkle"] + [str(node) for node in nodes])
+
+            if len(remote_hashes) != len(nodes):
+                logging.error(
+                    f"{self.replica.id} anti-entropy with {address} failed: {remote_hashes[0]}")
+                return
+
+            local_hashes = self.merkle_tree.hashes(nodes)
+            differing = [node for node, local, remote in zip(
+                nodes, local_hashes, remote_hashes) if local != remote]
+
+            buckets += [node - self.merkle_tree.num_leaves
+                        for node in differing if self.merkle_tree.is_leaf(node)]
+            nodes = [child for node in differing if not self.merkle_tree.is_leaf(node)
+                     for child in (2 * node, 2 * node + 1)]
+
+        if not buckets:
+            return
+
+        logging.debug(
+            f"{self.replica.id} repairing {len(buckets)} key ranges with {address}")
+
+        # Pull the peer's writes in the differing ranges, then push ours
+        self.update(send_command(address, ["merkle_range"] +
+                    [str(bucket) for bucket in buckets]))
+
+        entries = self.merkle_range(buckets)
+
+        if entries:
+            send_command(address, ["update"] + entries)
+
+    # Return the hashes of the given Merkle tree nodes
+    def merkle_hashes(self, nodes):
+        nodes = [int(node) for node in nodes]
+
+        if not all(1 <= node < 2 * self.merkle_tree.num_leaves for node in nodes):
+            return "Invalid command"
+
+        return self.merkle_tree.hashes(nodes)
+
+    # Return the fields of every versioned write in the given key ranges, formatted as updates
+    def merkle_range(self, buckets):
+        entries = []
+
+        for bucket in buckets:
+            for key in self.merkle_tree.bucket_keys(int(bucket) % self.merkle_tree.num_leaves):
+                value = self.store.get(key)
+
+                # The key may have expired since it was listed
+                if value is not None:
+                    entries.extend(self.format_update(
+                        key, value, self.versions.get(key, (0, "")), self.deadlines.get(key)))
+
+        return entries
+
+
+# Count acknowledgements from replicas until enough of them have arrived
+class Quorum:
+    def __init__(self, required):
+        self.required = required
+        self.acknowledgements = 0
+        self.condition = threading.Condition()
+
+    def acknowledge(self):
+        with self.condition:
+            self.acknowledgements += 1
+
+            if self.acknowledgements >= self.required:
+                self.condition.notify_all()
 
-                # Clear pending updates
-                self.pending_updates[target_replica] = []
+    # Return whether the quorum was reached before the timeout
+    def wait(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.acknowledgements >= self.required, timeout)
 
 
 class LinearConsistencyKVStore(KeyValueStore):
+    blocking_commands = {"set", "mset", "incr", "cas", "append"}
+
     def __init__(self, replica):
         super().__init__()
         self.replica = replica
 
-    def set(self, key, value):
-        super().set(key, value)
+        # A write is applied locally and queued to every replica while holding its keys' locks, so all replicas
+        # apply the writes to each key in the same order while writes to other keys go ahead in parallel
+        self.peer_queues = {}
 
-        # Keep track of which replicas have acknowledged the update
-        acknowledgements = []
+        # Updates a replica misses are kept on disk and replayed to it in order, so it catches up once it is back
+        self.hints = HintedHandoff(self.replica, [address for address in self.replica.replica_addresses
+                                                  if address != (self.replica.host, self.replica.port)])
 
-        # Send new key-value pair to each replica
+        # Send to each replica from its own thread so a write waits for the slowest required replica, not the sum of all of them
         for address in self.replica.replica_addresses:
             if address != (self.replica.host, self.replica.port):
-                data = f"update {key} {value}"
-                acknowledgements.append(self.send_updates(address, data))
+                self.peer_queues[address] = queue.Queue()
+                threading.Thread(target=self.replication_thread,
+                                 args=(address,), daemon=True).start()
+
+        # The local write counts towards the quorum
+        write_quorum = self.replica.write_quorum
+        num_replicas = len(self.replica.replica_addresses)
+
+        # Any replica may be granted the lease next and answer reads from its own copy, so with leases a write
+        # is only acknowledged once every replica has it
+        if self.replica.leader_lease > 0 and write_quorum not in ("all", num_replicas):
+            logging.warning(
+                f"{self.replica.id} uses a write quorum of all replicas instead of {write_quorum}, since leader leases are on")
+            write_quorum = "all"
+
+        if write_quorum == "all":
+            write_quorum = num_replicas
+
+        self.required_acknowledgements = min(
+            max(int(write_quorum), 1), num_replicas) - 1
+
+        # With leader leases, one replica of the group holds a lease that a majority renews on every heartbeat,
+        # and serves every read and write while it holds it. A replica that grants the lease promises not to grant
+        # it to anyone else for lease_duration seconds, so there is never more than one holder
+        self.lease_duration = self.replica.leader_lease
+        self.leases = self.lease_duration > 0
+        self.heartbeat_interval = self.lease_duration / 3
+        self.lease_condition = threading.Condition()
 
-        # Wait for all replicas to acknowledge the update
-        for acknowledgement in acknowledgements:
-            acknowledgement.wait()
+        # The replica this one last granted the lease to and when that grant expires, and when this replica's own lease expires.
+        # Grants start out unexpired so replicas do not all ask for the lease at once when the group starts
+        self.granted_to = None
+        self.grant_expiry = time.monotonic()
+        self.lease_expiry = 0
+
+        if self.leases:
+            threading.Thread(target=self.lease_thread, daemon=True).start()
+
+    def set(self, key, value, ttl=None):
+        deadline = deadline_after(ttl)
+
+        # Replicas are sent the deadline rather than the ttl, so they all expire the key together
+        with self.key_locks.lock(key):
+            self.put(key, value, deadline)
+            quorum = self.replicate(
+                ["update", key, value, format_deadline(deadline)])
+
+        if not quorum.wait(self.replica.replication_timeout):
+            return "Write quorum not reached"
 
         return "Key-value pair added"
 
-    # Send updates to the target replica
-    def send_updates(self, target_replica, data):
-        acknowledge_event = threading.Event()
+    def mset(self, pairs):
+        with self.key_locks.lock_all([key for key, _ in pairs]):
+            for key, value in pairs:
+                super().set(key, value)
+
+            # Send every pair to each replica in a single update
+            quorum = self.replicate(
+                ["update"] + [field for key, value in pairs for field in (key, value, "")])
+
+        if not quorum.wait(self.replica.replication_timeout):
+            return "Write quorum not reached"
+
+        return "Key-value pairs added"
+
+    # The new value is replicated like a set, after reading the old one under the key's lock
+    def atomic(self, action, key, args):
+        with self.key_locks.lock(key):
+            current, deadline = self.current(key)
+            value, response = apply_operation(action, current, args)
+
+            if value is None:
+                return response
+
+            self.put(key, value, deadline)
+            quorum = self.replicate(
+                ["update", key, value, format_deadline(deadline)])
+
+        if not quorum.wait(self.replica.replication_timeout):
+            return "Write quorum not reached"
+
+        return response
+
+    def stats(self):
+        stats = super().stats()
+        stats["replication"] = {"queue_depths": {f"{host}:{port}": updates.qsize()
+                                                 for (host, port), updates in self.peer_queues.items()},
+                                "hints": self.hints.stats()}
+
+        if self.leases:
+            stats["replication"]["lease"] = {"granted_to": self.granted_to,
+                                             "held": self.holds_lease()}
+
+        return stats
+
+    def holds_lease(self):
+        return self.lease_expiry > time.monotonic()
+
+    # Return the address of the replica holding the lease, which may be this one, waiting up to timeout
+    # seconds for one to be chosen, or None if there is none
+    def leader(self, timeout):
+        with self.lease_condition:
+            if timeout:
+                self.lease_condition.wait_for(lambda: self.lease_holder() is not None, timeout)
+
+            return self.lease_holder()
+
+    def lease_holder(self):
+        if self.holds_lease():
+            return (self.replica.host, self.replica.port)
+
+        if self.granted_to not in (None, self.replica.id) and self.grant_expiry > time.monotonic():
+            return self.replica.address_of(self.granted_to)
+
+        return None
+
+    # Grant the lease to holder unless it was granted to another replica that may still hold it
+    def grant_lease(self, holder):
+        now = time.monotonic()
+
+        with self.lease_condition:
+            if self.granted_to not in (None, holder) and self.grant_expiry > now:
+                return f"Lease held by {self.granted_to}"
+
+            self.granted_to = holder
+            self.grant_expiry = now + self.lease_duration
+            self.lease_condition.notify_all()
+
+        return "Lease granted"
+
+    # Ask every replica of the group for the lease; it is held once a majority grants it, and lasts lease_duration
+    # seconds from when it was asked for, which is never later than any replica's grant expires
+    def renew_lease(self):
+        start = time.monotonic()
+
+        if self.grant_lease(self.replica.id) != "Lease granted":
+            return
+
+        responses = [send_command(address, ["lease", self.replica.id], timeout=self.heartbeat_interval)[0]
+                     for address in self.peer_queues]
+        grants = 1 + responses.count("Lease granted")
+
+        # Replicas that refused say who they granted the lease to
+        holders = [response.split()[-1] for response in responses
+                   if response.startswith("Lease held by ")]
+
+        with self.lease_condition:
+            if grants > len(self.replica.replica_addresses) // 2:
+                if not self.holds_lease():
+                    logging.info(f"{self.replica.id} acquired the leader lease")
+
+                self.lease_expiry = start + self.lease_duration
+                self.lease_condition.notify_all()
+            elif not self.holds_lease():
+                # Without a majority, withdraw the grant to itself and follow the replica the others granted it to,
+                # or ask again on the next heartbeat if there is none
+                if holders:
+                    self.granted_to = holders[0]
+                    self.grant_expiry = time.monotonic() + self.lease_duration
+                    self.lease_condition.notify_all()
+                else:
+                    self.granted_to = None
+                    self.grant_expiry = time.monotonic()
+
+    # Renew the lease every heartbeat while holding it. Otherwise ask for it once the last grant has expired,
+    # waiting a heartbeat longer for each replica ahead of this one in the group so they rarely compete for it
+    def lease_thread(self):
+        position = self.replica.replica_addresses.index(
+            (self.replica.host, self.replica.port))
+
+        while True:
+            with self.lease_condition:
+                ready = self.granted_to == self.replica.id or \
+                    self.grant_expiry + position * self.heartbeat_interval <= time.monotonic()
+
+            if ready:
+                self.renew_lease()
+
+            time.sleep(self.heartbeat_interval)
+
+    # Queue an update for each replica and return the quorum that its acknowledgements count towards
+    def replicate(self, command):
+        quorum = Quorum(self.required_acknowledgements)
+
+        for updates in self.peer_queues.values():
+            updates.put((command, quorum))
+
+        return quorum
+
+    # Send queued updates to one replica, batching any that queued up while the previous batch was in flight
+    def replication_thread(self, address):
+        updates = self.peer_queues[address]
+        hints = self.hints.queues[address]
 
-        # Set the acknowledge event when the acknowledgement is received
-        def callback():
-            simulate_latency()
-            acknowledge_event.set()
+        while True:
+            batch = [updates.get()]
+
+            while not updates.empty():
+                batch.append(updates.get_nowait())
+
+            # Updates wait behind the replica's hints, so it applies the writes to each key in order
+            responses = []
+
+            if not hints.pending():
+                responses = send_commands(address, [command for command, _ in batch],
+                                          timeout=self.replica.replication_timeout)
+                simulate_latency(self.replica.simulated_latency)
+
+            applied = 0
+
+            for (_, quorum), response in zip(batch, responses):
+                if response != ["Update successful"]:
+                    break
 
-        send(target_replica, data, callback=callback)
+                quorum.acknowledge()
+                applied += 1
 
-        return acknowledge_event
+            # The hint queue retries the rest with backoff; they no longer count towards the quorum of their write
+            for command, _ in batch[applied:]:
+                hints.add(command)
+
+
+# An atomic operation queued with a sequencer's writes, applied to the value left by the writes sequenced before it
+class Operation:
+    def __init__(self, action, key, args):
+        self.action = action
+        self.key = key
+        self.args = args
+        self.response = None
+
+    # Return the write the operation makes to store, formatted as key value deadline, or None if it makes none
+    def resolve(self, store):
+        current, deadline = store.current(self.key)
+        value, self.response = apply_operation(
+            self.action, current, self.args)
+
+        return None if value is None else (self.key, value, format_deadline(deadline))
 
 
 class SequentialConsistencyKVStore(KeyValueStore):
+    blocking_commands = {"set", "mset", "sequence", "forward", "incr", "cas", "append", "heartbeat"}
+
     def __init__(self, replica):
         super().__init__()
         self.replica = replica
+        self.is_sequencer = (
+            self.replica.host, self.replica.port) == self.replica.sequencer_address
 
-    def set(self, key, value):
-        if (self.replica.host, self.replica.port) == self.replica.sequencer_address:
-            # If this replica is the sequencer, set and broadcast the new key-value pair
-            super().set(key, value)
-            self.broadcast_update(key, value)
+        # Sequence number of the last batch applied to this store, and of the last batch a write forwarded from here went into
+        self.sequence_number = 0
+        self.forwarded_sequence = 0
+        self.sequence_lock = threading.Lock()
 
-            return "Key-value pair added"
+        batch_interval = self.replica.sequencer_batch_interval / 1000
+        batch_size = self.replica.sequencer_batch_size
+
+        if self.is_sequencer:
+            # Recent batches are kept so followers can ask for any they missed
+            self.history = {}
+            self.peer_queues = {}
+
+            for address in self.replica.replica_addresses:
+                if address != (self.replica.host, self.replica.port):
+                    self.peer_queues[address] = queue.Queue()
+                    threading.Thread(target=self.broadcast_thread,
+                                     args=(address,), daemon=True).start()
+
+            self.batcher = Batcher(self.sequence_batch,
+                                   batch_interval, batch_size)
+
+            threading.Thread(target=self.heartbeat_thread, daemon=True).start()
         else:
-            # If this replica is not the sequencer, send the new key-value pair to the sequencer
-            data = f"set {key} {value}"
-            send(self.replica.sequencer_address, data)
+            # Batches that arrived ahead of a missing one, by sequence number
+            self.buffered_batches = {}
+            self.batcher = Batcher(self.forward_batch,
+                                   batch_interval, batch_size)
+
+    # Writes are batched as key value deadline, so the sequencer and every follower give a key the same deadline
+    def set(self, key, value, ttl=None):
+        self.batcher.add([(key, value, format_deadline(deadline_after(ttl)))]).wait(
+            self.replica.replication_timeout)
 
+        if self.is_sequencer:
+            return "Key-value pair added"
+        else:
             return "Key-value pair forwarded to sequencer"
 
-    def broadcast_update(self, key, value):
-        # Send new key-value pair to each replica
-        for address in self.replica.replica_addresses:
-            if address != (self.replica.host, self.replica.port):
-                data = f"update {key} {value}"
-                send(address, data)
+    def mset(self, pairs):
+        self.batcher.add([(key, value, "") for key, value in pairs]).wait(
+            self.replica.replication_timeout)
+
+        if self.is_sequencer:
+            return "Key-value pairs added"
+        else:
+            return "Key-value pairs forwarded to sequencer"
+
+    # Operations only run on the sequencer, which sends followers the values they write. The batch is sequenced here,
+    # so the operation has either been applied or failed once it is flushed, and waiting for it never times out
+    def atomic(self, action, key, args):
+        if not self.is_sequencer:
+            return "Not the sequencer"
+
+        operation = Operation(action, key, args)
+        self.batcher.add([operation]).wait()
+
+        return operation.response or "Operation failed"
+
+    # Send writes received by a follower to the sequencer in one message
+    def forward_batch(self, writes):
+        response = send_command(self.replica.sequencer_address,
+                                ["forward"] + [field for write in writes for field in write])
+
+        # The sequencer answers with the sequence number of the batch each write went into
+        tokens = [int(token) for token in response[1:] if token.isdigit()]
+
+        if tokens:
+            with self.sequence_lock:
+                self.forwarded_sequence = max(
+                    self.forwarded_sequence, max(tokens))
+
+    def stats(self):
+        stats = super().stats()
+        stats["replication"] = {"sequence_number": self.sequence_number}
+
+        if self.is_sequencer:
+            stats["replication"]["queue_depths"] = {f"{host}:{port}": batches.qsize()
+                                                    for (host, port), batches in self.peer_queues.items()}
+        else:
+            stats["replication"]["buffered_batches"] = len(self.buffered_batches)
+
+        return stats
+
+    # Sequence writes forwarded by a follower, formatted as key value deadline, and answer with the sequence number
+    # of the batch they went into
+    def forward(self, fields):
+        if not self.is_sequencer:
+            return "Not the sequencer"
+
+        self.batcher.add(list(zip(fields[0::3], fields[1::3], fields[2::3]))).wait(
+            self.replica.replication_timeout)
+
+        return ["Key-value pairs added", self.session_token(None)]
+
+    # A replica has seen a write once it has applied the batch the sequencer put it in
+    def session_token(self, key):
+        return str(self.sequence_number if self.is_sequencer else self.forwarded_sequence)
+
+    def caught_up(self, key, token):
+        return self.sequence_number >= int(token)
+
+    def session_source(self, token):
+        return self.replica.sequencer_address
+
+    # The last batch applied, which is in every copied value
+    def snapshot_position(self):
+        with self.sequence_lock:
+            return str(self.sequence_number)
+
+    # Apply the batches after the copied position, in order; earlier ones are already in the copy
+    def finish_bootstrap(self, position):
+        with self.sequence_lock:
+            self.bootstrap_writes = None
+            self.sequence_number = max(self.sequence_number, int(position or 0))
+
+            if not self.is_sequencer:
+                self.buffered_batches = {sequence_number: batch for sequence_number, batch in self.buffered_batches.items()
+                                         if sequence_number > self.sequence_number}
+                self.apply_buffered_batches()
+
+        self.notify_progress()
+
+    # Stamp a batch of writes with the next sequence number, apply it and queue it once for each follower
+    def sequence_batch(self, writes):
+        with self.sequence_lock:
+            sequence_number = self.sequence_number + 1
+            fields = []
+
+            for write in writes:
+                if isinstance(write, Operation):
+                    write = write.resolve(self)
+
+                    if write is None:
+                        continue
+
+                key, value, deadline = write
+                self.put(key, value, parse_deadline(deadline))
+                fields.extend(write)
+
+            self.sequence_number = sequence_number
+            self.history[sequence_number] = fields
+            self.history.pop(sequence_number -
+                             self.replica.sequencer_history, None)
+
+            # Queued under the lock, so a heartbeat never reaches a follower ahead of the batch it announces
+            command = ["sequence", str(sequence_number)] + fields
+
+            for updates in self.peer_queues.values():
+                updates.put(command)
+
+        self.notify_progress()
+
+    # Send sequenced batches to one follower, in order
+    def broadcast_thread(self, address):
+        updates = self.peer_queues[address]
+
+        while True:
+            batch = [updates.get()]
+
+            while not updates.empty():
+                batch.append(updates.get_nowait())
+
+            # A follower that misses a batch asks for it again when the next batch or heartbeat arrives
+            send_commands(address, batch,
+                          timeout=self.replica.replication_timeout)
+
+    # Send the latest sequence number to every follower every sequencer_heartbeat_interval seconds, so a follower
+    # that missed the last batches notices even when no batch follows them
+    def heartbeat_thread(self):
+        while True:
+            time.sleep(self.replica.sequencer_heartbeat_interval)
+
+            with self.sequence_lock:
+                command = ["heartbeat", str(self.sequence_number)]
+
+                for updates in self.peer_queues.values():
+                    updates.put(command)
+
+    # Return the batches after start up to and including end, each as its sequence number, field count and fields
+    def retransmit(self, start, end):
+        if not self.is_sequencer:
+            return "Not the sequencer"
+
+        fields = []
+
+        with self.sequence_lock:
+            for sequence_number in range(start + 1, end + 1):
+                if sequence_number in self.history:
+                    batch = self.history[sequence_number]
+                    fields += [str(sequence_number), str(len(batch))] + batch
+
+        return fields
+
+    # Apply a batch from the sequencer once every earlier batch has been applied
+    def apply_sequence(self, sequence_number, updates):
+        with self.sequence_lock:
+            if sequence_number > self.sequence_number:
+                self.buffered_batches[sequence_number] = updates
+
+            # Batches wait until the copy of a peer's store has loaded, since they may be newer than its values
+            if self.bootstrap_writes is not None:
+                return "Update successful"
+
+            self.apply_buffered_batches()
+
+            # Batches are still waiting on a missing one, so ask the sequencer for everything before them
+            missing = None
+
+            if self.buffered_batches:
+                missing = (self.sequence_number, min(
+                    self.buffered_batches) - 1)
+
+        if missing:
+            self.request_batches(*missing)
+
+        return "Update successful"
+
+    # The sequencer's latest sequence number; any batch up to it that has not arrived was lost
+    def heartbeat(self, sequence_number):
+        with self.sequence_lock:
+            missing = None
+
+            if self.bootstrap_writes is None and sequence_number > self.sequence_number:
+                missing = (self.sequence_number, sequence_number)
+
+        if missing:
+            self.request_batches(*missing)
+
+        return "Update successful"
+
+    # Ask the sequencer for the batches after start up to and including end. If it no longer has the first of them,
+    # copy the store of a peer instead and continue from there
+    def request_batches(self, start, end):
+        logging.debug(
+            f"{self.replica.id} missing batches {start + 1} to {end}, requesting retransmission")
+        response = send_command(self.replica.sequencer_address,
+                                ["retransmit", str(start), str(end)])
+
+        # An error response is a single field, so it never parses as a batch; the next heartbeat asks again
+        if len(response) == 1:
+            logging.error(
+                f"{self.replica.id} retransmission of batches {start + 1} to {end} failed: {response[0]}")
+            return
+
+        with self.sequence_lock:
+            i = 0
+
+            while i + 1 < len(response):
+                sequence_number, count = int(response[i]), int(response[i + 1])
+
+                if sequence_number > self.sequence_number:
+                    self.buffered_batches[sequence_number] = response[i + 2:i + 2 + count]
+
+                i += 2 + count
+
+            self.apply_buffered_batches()
+
+            # Batches arriving while the store is copied are buffered until the copy has loaded
+            lost = self.sequence_number <= start and self.bootstrap_writes is None
+
+            if lost:
+                self.bootstrap_writes = set()
+
+        if lost:
+            logging.warning(
+                f"{self.replica.id} missed batches the sequencer no longer has, copying the store of a peer")
+            threading.Thread(target=self.replica.bootstrap, daemon=True).start()
+
+    def apply_buffered_batches(self):
+        while self.sequence_number + 1 in self.buffered_batches:
+            # The batch is applied before its number is, so a read waiting for it never sees it half applied
+            super().update(self.buffered_batches.pop(self.sequence_number + 1))
+            self.sequence_number += 1
+
+        self.notify_progress()
+
+
+# Encode a vector clock as replica_id:count pairs, leaving out replicas it has seen no writes from
+def format_vector_clock(vector_clock):
+    return ",".join([f"{replica_id}:{count}" for replica_id, count in vector_clock.items() if count])
+
+
+def parse_vector_clock(data):
+    vector_clock = {}
+
+    for entry in data.split(","):
+        replica_id, _, count = entry.rpartition(":")
+        vector_clock[replica_id] = int(count)
+
+    return vector_clock
 
 
 class CausalConsistencyKVStore(KeyValueStore):
     def __init__(self, replica):
         super().__init__()
         self.replica = replica
-        self.pending_updates = {address: []
-                                for address in self.replica.replica_addresses}
+        self.peers = [address for address in self.replica.replica_addresses
+                      if address != (self.replica.host, self.replica.port)]
 
-    def set(self, key, value, replica_id=None, vector_clock=None):
-        # If the replica_id and vector_clock are not provided, generate them
-        if replica_id is None and vector_clock is None:
-            replica_id = self.replica.id
-            self.vector_clock[replica_id] = self.vector_clock.get(
-                replica_id, 0) + 1
-            vector_clock = self.vector_clock[replica_id]
+        # Updates a peer could not be sent are kept on disk and sent, in order, before any newer ones
+        self.hints = HintedHandoff(self.replica, self.peers)
 
-        super().set(key, value, replica_id, vector_clock)
+        # Updates from other replicas whose dependencies have not been delivered yet
+        self.buffered_updates = []
+        self.clock_lock = threading.Lock()
 
-        # Queue new key-value pair to be sent to each replica
-        for address in self.replica.replica_addresses:
-            if address != (self.replica.host, self.replica.port):
-                self.pending_updates.setdefault(address, []).append(
-                    (key, value, replica_id, vector_clock))
+        # Writes are sent to the other replicas in batches, off the request path
+        self.batcher = Batcher(self.send_updates, self.replica.causal_batch_interval / 1000,
+                               self.replica.causal_batch_size)
 
-        self.send_updates()
-        return "Key-value pair added"
+    def set(self, key, value, ttl=None):
+        response = self.mset([(key, value)], deadline_after(ttl))
 
-    def send_updates(self):
-        for target_replica, updates in self.pending_updates.items():
-            # If there are pending updates for the target_replica, send them
-            if updates:
-                formatted_updates = []
-
-                # Format the updates to include the replica_id and vector_clock
-                for update in updates:
-                    key, value, replica_id, vector_clock = update
-                    formatted_updates.append(
-                        f"{key} {value} {replica_id} {vector_clock}")
-
-                data = "update " + " ".join(formatted_updates)
-                send(target_replica, data)
-
-                # Clear pending updates
-                self.pending_updates[target_replica] = []
+        return "Key-value pair added" if response == "Key-value pairs added" else response
+
+    def mset(self, pairs, deadline=None):
+        with self.clock_lock:
+            if self.bootstrap_writes is not None:
+                return "Replica is bootstrapping"
+
+            updates = [self.stamp_update(key, value, deadline)
+                       for key, value in pairs]
+
+            # Batches are flushed in the order they are queued, so each replica receives this replica's writes in clock order
+            self.batcher.add(updates)
+
+        return "Key-value pairs added"
+
+    # Every write made here is stamped under the clock lock, so the operation is atomic with them
+    def atomic(self, action, key, args):
+        with self.clock_lock:
+            if self.bootstrap_writes is not None:
+                return "Replica is bootstrapping"
+
+            current, deadline = self.current(key)
+            value, response = apply_operation(action, current, args)
+
+            if value is not None:
+                self.batcher.add([self.stamp_update(key, value, deadline)])
+
+        return response
+
+    # Set the key-value pair locally and return it with the vector clock of the write
+    def stamp_update(self, key, value, deadline=None):
+        self.set_clock(self.replica.id, self.vector_clock.get(
+            self.replica.id, 0) + 1)
+        self.put(key, value, deadline)
+
+        return (key, value, self.replica.id, format_vector_clock(self.vector_clock), format_deadline(deadline))
+
+    def stats(self):
+        stats = super().stats()
+
+        with self.clock_lock:
+            # Updates a replica could not be sent yet, and ones received before the writes they depend on
+            stats["replication"] = {"hints": self.hints.stats(),
+                                    "buffered_updates": len(self.buffered_updates),
+                                    "vector_clock": dict(self.vector_clock)}
+
+        return stats
+
+    # This replica's vector clock, which covers every write it has made or delivered, and the replica it came from
+    def session_token(self, key):
+        with self.clock_lock:
+            return f"{self.replica.id}@{format_vector_clock(self.vector_clock)}"
+
+    def caught_up(self, key, token):
+        vector_clock = token.partition("@")[2]
+
+        return not vector_clock or all(count <= self.vector_clock.get(replica_id, 0)
+                                       for replica_id, count in parse_vector_clock(vector_clock).items())
+
+    def session_source(self, token):
+        return self.replica.address_of(token.partition("@")[0])
+
+    # Apply updates formatted as key value replica_id vector_clock deadline once every write they depend on has been delivered
+    def update(self, updates):
+        with self.clock_lock:
+            for i in range(0, len(updates) - 4, 5):
+                self.buffered_updates.append((updates[i], updates[i + 1], updates[i + 2],
+                                              parse_vector_clock(updates[i + 3]),
+                                              parse_deadline(updates[i + 4])))
+
+            # Updates wait until the copy of a peer's store has loaded, since they may be newer than its values
+            if self.bootstrap_writes is None:
+                self.deliver_buffered_updates()
+
+        return "Update successful"
+
+    # A replaced replica starts counting its own writes from 0, which its peers would drop as already delivered, so it
+    # takes no writes until the copy has brought back its entry in the vector clock
+    def begin_bootstrap(self):
+        with self.clock_lock:
+            super().begin_bootstrap()
+
+    # The vector clock of the writes in every copied value
+    def snapshot_position(self):
+        with self.clock_lock:
+            return format_vector_clock(self.vector_clock)
+
+    # Count the copied writes as delivered, then deliver the updates that arrived during the copy and follow them
+    def finish_bootstrap(self, position):
+        with self.clock_lock:
+            self.bootstrap_writes = None
+
+            for replica_id, count in (parse_vector_clock(position) if position else {}).items():
+                if count > self.vector_clock.get(replica_id, 0):
+                    self.set_clock(replica_id, count)
+
+            self.deliver_buffered_updates()
+
+        self.notify_progress()
+
+    # An update from replica_id is deliverable when it is the next write from replica_id and
+    # every write it depends on from other replicas has already been delivered
+    def is_deliverable(self, replica_id, vector_clock):
+        for clock_id, count in vector_clock.items():
+            delivered = self.vector_clock.get(clock_id, 0)
+
+            if clock_id == replica_id and count != delivered + 1:
+                return False
+            if clock_id != replica_id and count > delivered:
+                return False
+
+        return True
+
+    def deliver_buffered_updates(self):
+        delivered = True
+
+        while delivered:
+            delivered = False
+            remaining = []
+
+            for key, value, replica_id, vector_clock, deadline in self.buffered_updates:
+                # Drop updates that have already been delivered
+                if vector_clock.get(replica_id, 0) <= self.vector_clock.get(replica_id, 0):
+                    continue
+
+                if self.is_deliverable(replica_id, vector_clock):
+                    self.put(key, value, deadline)
+                    self.set_clock(replica_id, vector_clock[replica_id])
+                    self.notify_progress()
+                    delivered = True
+                else:
+                    remaining.append(
+                        (key, value, replica_id, vector_clock, deadline))
+
+            self.buffered_updates = remaining
+
+    def send_updates(self, updates):
+        fields = [field for update in updates for field in update]
+
+        # Updates that could not be sent before go first, since the new ones depend on them
+        for target_replica in self.peers:
+            self.hints.send(target_replica, ["update"] + fields)
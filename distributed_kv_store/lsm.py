@@ -0,0 +1,435 @@
+import bisect
+import hashlib
+import heapq
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+from collections.abc import Mapping, MutableMapping
+
+# A record is the key and value lengths followed by the key and value; deleted keys have no value
+RECORD = struct.Struct("!II")
+TOMBSTONE_LENGTH = 0xFFFFFFFF
+
+# The table ends with the offsets of its index and bloom filter and its number of records
+FOOTER = struct.Struct("!QQQ")
+INDEX_ENTRY = struct.Struct("!IQ")
+BLOOM_HEADER = struct.Struct("!II")
+
+# Every INDEX_INTERVAL-th key is kept in memory, so a lookup reads at most one block of that many records
+INDEX_INTERVAL = 16
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+# A deleted key is stored as None until compaction into the oldest table drops it
+TOMBSTONE = None
+MISSING = object()
+
+
+def encode_text(text):
+    return text.encode("utf-8", "surrogateescape")
+
+
+def decode_text(data):
+    return str(data, "utf-8", "surrogateescape")
+
+
+# Positions of a key's bits in a bloom filter of num_bits bits, by double hashing one digest
+def bloom_positions(key, num_bits):
+    digest = hashlib.blake2b(encode_text(key), digest_size=16).digest()
+    h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+
+    return [(h1 + i * h2) % num_bits for i in range(BLOOM_HASHES)]
+
+
+# Return the records in a block of a table as (key, value) pairs
+def parse_records(data):
+    records = []
+    offset = 0
+
+    while offset < len(data):
+        key_length, value_length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        key = decode_text(data[offset:offset + key_length])
+        offset += key_length
+
+        if value_length == TOMBSTONE_LENGTH:
+            records.append((key, TOMBSTONE))
+        else:
+            records.append(
+                (key, decode_text(data[offset:offset + value_length])))
+            offset += value_length
+
+    return records
+
+
+# Write sorted (key, value) pairs to an immutable table file, returning False if there were none
+def write_table(filename, items):
+    index = []
+    keys = []
+    offset = 0
+
+    with open(filename, "wb") as f:
+        for key, value in items:
+            if len(keys) % INDEX_INTERVAL == 0:
+                index.append((key, offset))
+
+            encoded_key = encode_text(key)
+
+            if value is TOMBSTONE:
+                record = RECORD.pack(len(encoded_key), TOMBSTONE_LENGTH) + encoded_key
+            else:
+                encoded_value = encode_text(value)
+                record = RECORD.pack(len(encoded_key), len(encoded_value)) + \
+                    encoded_key + encoded_value
+
+            f.write(record)
+            keys.append(key)
+            offset += len(record)
+
+        if not keys:
+            f.close()
+            os.remove(filename)
+            return False
+
+        index_offset = offset
+
+        for key, key_offset in index:
+            encoded_key = encode_text(key)
+            f.write(INDEX_ENTRY.pack(len(encoded_key), key_offset) + encoded_key)
+            offset += INDEX_ENTRY.size + len(encoded_key)
+
+        # The filter lets a lookup skip the table without reading it when the key is not in it
+        num_bits = max(len(keys) * BLOOM_BITS_PER_KEY, 64)
+        bits = bytearray((num_bits + 7) // 8)
+
+        for key in keys:
+            for position in bloom_positions(key, num_bits):
+                bits[position >> 3] |= 1 << (position & 7)
+
+        f.write(BLOOM_HEADER.pack(num_bits, len(bits)) + bits)
+        f.write(FOOTER.pack(index_offset, offset, len(keys)))
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    return True
+
+
+# An immutable sorted table file, with its sparse index and bloom filter held in memory
+class SSTable:
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = os.path.basename(filename)
+        self.file = open(filename, "rb", buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        index_offset, bloom_offset, self.count = FOOTER.unpack(
+            self.read(self.size - FOOTER.size, FOOTER.size))
+
+        self.index_keys = []
+        self.index_offsets = []
+        data = self.read(index_offset, bloom_offset - index_offset)
+        offset = 0
+
+        while offset < len(data):
+            key_length, key_offset = INDEX_ENTRY.unpack_from(data, offset)
+            offset += INDEX_ENTRY.size
+            self.index_keys.append(decode_text(data[offset:offset + key_length]))
+            self.index_offsets.append(key_offset)
+            offset += key_length
+
+        # The last block ends where the index starts
+        self.index_offsets.append(index_offset)
+
+        self.num_bits, bloom_length = BLOOM_HEADER.unpack(
+            self.read(bloom_offset, BLOOM_HEADER.size))
+        self.bloom = self.read(bloom_offset + BLOOM_HEADER.size, bloom_length)
+
+    def read(self, offset, length):
+        return os.pread(self.file.fileno(), length, offset)
+
+    def might_contain(self, key):
+        return all(self.bloom[position >> 3] & (1 << (position & 7))
+                   for position in bloom_positions(key, self.num_bits))
+
+    def block(self, i):
+        return parse_records(self.read(self.index_offsets[i],
+                                       self.index_offsets[i + 1] - self.index_offsets[i]))
+
+    # Return the value of key, TOMBSTONE if it was deleted or MISSING if the table has no record of it
+    def get(self, key):
+        if not self.might_contain(key):
+            return MISSING
+
+        i = bisect.bisect_right(self.index_keys, key) - 1
+
+        if i < 0:
+            return MISSING
+
+        for record_key, value in self.block(i):
+            if record_key == key:
+                return value
+
+        return MISSING
+
+    # Return every record in key order, reading one block at a time
+    def items(self):
+        for i in range(len(self.index_keys)):
+            yield from self.block(i)
+
+
+def ranked(items, rank):
+    for key, value in items:
+        yield key, rank, value
+
+
+# Merge sorted sources, newest first, into one sorted stream where each key has its newest value
+def merge(sources):
+    last = MISSING
+
+    for key, _, value in heapq.merge(*[ranked(items, rank) for rank, items in enumerate(sources)]):
+        if key != last:
+            last = key
+            yield key, value
+
+
+# Read-only view of memtables and tables, newest first
+class LSMView(Mapping):
+    def __init__(self, memtables, tables):
+        self.memtables = memtables
+        self.tables = tables
+
+    def __getitem__(self, key):
+        value = MISSING
+
+        for memtable in self.memtables:
+            value = memtable.get(key, MISSING)
+
+            if value is not MISSING:
+                break
+        else:
+            for table in self.tables:
+                value = table.get(key)
+
+                if value is not MISSING:
+                    break
+
+        if value is MISSING or value is TOMBSTONE:
+            raise KeyError(key)
+
+        return value
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def items(self):
+        sources = [sorted(memtable.items()) for memtable in self.memtables] + \
+            [table.items() for table in self.tables]
+
+        return ((key, value) for key, value in merge(sources) if value is not TOMBSTONE)
+
+
+# Log-structured merge engine: writes go to an in-memory memtable that is written out as an immutable sorted
+# table once it reaches memtable_size bytes, and tables of similar size are merged in the background.
+# Unflushed writes are covered by the replica's write-ahead log, so snapshots only need to flush the memtable
+class LSMEngine(MutableMapping):
+    persistent = True
+
+    def __init__(self, directory, memtable_size, compaction_trigger, recover):
+        self.directory = directory
+        self.manifest_filename = f"{directory}/MANIFEST"
+        self.memtable_size = memtable_size
+        self.compaction_trigger = compaction_trigger
+
+        self.memtable = {}
+        self.memtable_bytes = 0
+
+        # Memtables waiting to be written out and the tables that hold everything else, newest first
+        self.frozen = []
+        self.tables = []
+        self.next_table = 0
+
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.work = threading.Event()
+
+        os.makedirs(directory, exist_ok=True)
+        self.open(recover)
+
+        threading.Thread(target=self.compaction_thread, daemon=True).start()
+
+    # Open the tables listed in the manifest and delete any other files, such as a table left by an unfinished compaction
+    def open(self, recover):
+        names = []
+
+        if recover and os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, "r", encoding="utf-8") as f:
+                names = json.load(f)
+
+        for name in os.listdir(self.directory):
+            if name not in names and name != "MANIFEST":
+                os.remove(f"{self.directory}/{name}")
+
+        self.tables = [SSTable(f"{self.directory}/{name}") for name in names]
+        self.next_table = max([int(name.split(".")[0])
+                              for name in names], default=-1) + 1
+
+        if not recover:
+            self.write_manifest()
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.write(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+
+            self.write(key, TOMBSTONE)
+
+    # Iteration sorts the memtable, so it works on a copy that writes cannot change underneath it
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return len(self.copy())
+
+    def items(self):
+        return self.copy().items()
+
+    def stats(self):
+        with self.lock:
+            return {"memtable_bytes": self.memtable_bytes, "frozen_memtables": len(self.frozen),
+                    "tables": len(self.tables), "table_bytes": sum(table.size for table in self.tables)}
+
+    def copy(self):
+        with self.lock:
+            return LSMView([dict(self.memtable)] + self.frozen, list(self.tables))
+
+    def view(self):
+        with self.lock:
+            return LSMView([self.memtable] + self.frozen, list(self.tables))
+
+    def write(self, key, value):
+        self.memtable[key] = value
+        self.memtable_bytes += sys.getsizeof(key) + sys.getsizeof(value)
+
+        if self.memtable_bytes >= self.memtable_size:
+            self.freeze()
+            self.work.set()
+
+    # Stop writing to the current memtable so it can be written out
+    def freeze(self):
+        with self.lock:
+            if self.memtable:
+                self.frozen.insert(0, self.memtable)
+                self.memtable = {}
+                self.memtable_bytes = 0
+
+    # Write every frozen memtable to a table, oldest first
+    def flush(self):
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    if not self.frozen:
+                        break
+
+                    memtable = self.frozen[-1]
+
+                table = self.new_table(sorted(memtable.items()))
+
+                with self.lock:
+                    if table:
+                        self.tables.insert(0, table)
+
+                    self.frozen.pop()
+                    self.write_manifest()
+
+        if len(self.tables) >= self.compaction_trigger:
+            self.work.set()
+
+    # Merge the newest run of compaction_trigger tables of similar size, or every table once there are
+    # twice as many as that, so a lookup never has to check more than a bounded number of tables
+    def compact(self):
+        with self.lock:
+            tables = list(self.tables)
+
+        run = None
+
+        for start in range(len(tables) - self.compaction_trigger + 1):
+            candidates = tables[start:start + self.compaction_trigger]
+            sizes = [table.size for table in candidates]
+
+            if max(sizes) <= min(sizes) * self.compaction_trigger:
+                run = candidates
+                break
+
+        if run is None and len(tables) >= 2 * self.compaction_trigger:
+            run = tables
+
+        if run is None:
+            return
+
+        # Deleted keys can only be dropped when nothing older than the merged tables could still hold them
+        items = merge([table.items() for table in run])
+
+        if run[-1] is tables[-1]:
+            items = ((key, value) for key, value in items if value is not TOMBSTONE)
+
+        table = self.new_table(items)
+
+        with self.lock:
+            position = self.tables.index(run[0])
+            self.tables[position:position + len(run)] = [table] if table else []
+            self.write_manifest()
+
+        for old_table in run:
+            os.remove(old_table.filename)
+
+        logging.debug(
+            f"Compacted {len(run)} tables in {self.directory} into {table.name if table else 'nothing'}")
+
+    def new_table(self, items):
+        with self.lock:
+            filename = f"{self.directory}/{self.next_table:06d}.sst"
+            self.next_table += 1
+
+        return SSTable(filename) if write_table(filename, items) else None
+
+    # The manifest lists the live tables, newest first, and is replaced atomically so a crash never loses a table
+    def write_manifest(self):
+        temp_filename = f"{self.manifest_filename}.tmp"
+
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            json.dump([table.name for table in self.tables], f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_filename, self.manifest_filename)
+
+    def compaction_thread(self):
+        while True:
+            self.work.wait()
+            self.work.clear()
+
+            try:
+                self.flush()
+
+                while len(self.tables) >= self.compaction_trigger:
+                    count = len(self.tables)
+                    self.compact()
+
+                    if len(self.tables) == count:
+                        break
+            except OSError as e:
+                logging.error(f"Error compacting {self.directory}: {e}")
@@ -0,0 +1,64 @@
+import hashlib
+import threading
+
+from .utils import digest
+
+
+# Binary Merkle tree over the key space, split into 2^depth ranges by key digest
+class MerkleTree:
+    def __init__(self, depth):
+        self.num_leaves = 1 << depth
+
+        # Each leaf hash is the XOR of its entries' digests, so writes update it in O(1)
+        self.leaves = [0] * self.num_leaves
+        self.keys = [set() for _ in range(self.num_leaves)]
+
+        # Node i has children 2i and 2i + 1, the root is node 1 and leaves start at num_leaves
+        self.nodes = None
+        self.lock = threading.Lock()
+
+    def bucket(self, key):
+        return digest(key) % self.num_leaves
+
+    def add(self, key, value):
+        bucket = self.bucket(key)
+
+        with self.lock:
+            self.leaves[bucket] ^= digest(f"{key}\0{value}")
+            self.keys[bucket].add(key)
+            self.nodes = None
+
+    def remove(self, key, value):
+        bucket = self.bucket(key)
+
+        with self.lock:
+            self.leaves[bucket] ^= digest(f"{key}\0{value}")
+            self.keys[bucket].discard(key)
+            self.nodes = None
+
+    def build(self):
+        nodes = [b""] * (2 * self.num_leaves)
+
+        for i, leaf in enumerate(self.leaves):
+            nodes[self.num_leaves + i] = leaf.to_bytes(8, "big")
+
+        for i in range(self.num_leaves - 1, 0, -1):
+            nodes[i] = hashlib.blake2b(
+                nodes[2 * i] + nodes[2 * i + 1], digest_size=8).digest()
+
+        return nodes
+
+    # Return the hex hashes of the given nodes, rebuilding the inner nodes only if a write has changed them
+    def hashes(self, indices):
+        with self.lock:
+            if self.nodes is None:
+                self.nodes = self.build()
+
+            return [self.nodes[i].hex() for i in indices]
+
+    def is_leaf(self, index):
+        return index >= self.num_leaves
+
+    def bucket_keys(self, bucket):
+        with self.lock:
+            return list(self.keys[bucket])
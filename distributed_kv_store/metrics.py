@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+
+from .protocol import COMMANDS
+
+# Latencies are counted in buckets 2% wide, so percentiles are within 2% of the exact value whatever the range
+BUCKET_GROWTH = 1.02
+SMALLEST_LATENCY = 1e-7
+
+
+# Counts of latencies in seconds by logarithmic bucket; histograms from several processes can be merged by adding counts
+class LatencyHistogram:
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+
+    def record(self, latency):
+        bucket = int(math.log(max(latency, SMALLEST_LATENCY) /
+                     SMALLEST_LATENCY, BUCKET_GROWTH))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def count(self):
+        return sum(self.counts.values())
+
+    # Return the latency in seconds that fraction of the recorded latencies are at or below, from the top of its bucket
+    def percentile(self, fraction):
+        target = max(math.ceil(fraction * self.count()), 1)
+        seen = 0
+
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+
+            if seen >= target:
+                return SMALLEST_LATENCY * BUCKET_GROWTH ** (bucket + 1)
+
+        return 0.0
+
+    def summary(self):
+        return {"count": self.count(),
+                "p50_ms": round(self.percentile(0.5) * 1000, 3),
+                "p99_ms": round(self.percentile(0.99) * 1000, 3),
+                "p999_ms": round(self.percentile(0.999) * 1000, 3),
+                "max_ms": round(self.percentile(1.0) * 1000, 3)}
+
+
+# Counters and latency histograms of a replica. Recording is a few dictionary updates under an uncontended lock,
+# so metrics are always collected and only summarized when asked for
+class Metrics:
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, latency):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+
+            self.histograms[name].record(latency)
+
+    # Count a command and the bytes it arrived in and record how long it took; unknown commands share one name
+    # so clients cannot add entries without limit
+    def record_command(self, name, latency, bytes_in):
+        name = name if name in COMMANDS else "invalid"
+
+        with self.lock:
+            self.counters["bytes_in"] = self.counters.get("bytes_in", 0) + bytes_in
+
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+
+            self.histograms[name].record(latency)
+
+    def snapshot(self):
+        with self.lock:
+            return {"uptime_s": round(time.time() - self.start_time, 3),
+                    "counters": dict(self.counters),
+                    "latency": {name: histogram.summary() for name, histogram in self.histograms.items()}}
@@ -0,0 +1,156 @@
+import logging
+import struct
+import zlib
+
+from .utils import connection_error, exchange
+
+# A binary message starts with MAGIC, which can never start a UTF-8 text command,
+# followed by an opcode (0 for responses), the number of fields and each field prefixed by its length
+MAGIC = 0xB7
+HEADER = struct.Struct("!BBI")
+FIELD = struct.Struct("!I")
+
+RESPONSE = 0
+COMMANDS = ["get", "set", "mget", "mset", "update", "save", "merkle",
+            "merkle_range", "sequence", "retransmit", "scan", "prefix", "range", "gossip", "lease", "stats",
+            "snapshot", "forward", "incr", "cas", "append", "heartbeat"]
+OPCODES = {command: opcode for opcode, command in enumerate(COMMANDS, 1)}
+
+# Responses to an mset that wrote every pair; anything else is an error
+MSET_SUCCESS = ("Key-value pairs added", "Key-value pairs forwarded to sequencer")
+
+
+# Return the first response of an mset split across replicas that is an error, or the first one if they all succeeded
+def combine_mset_responses(responses):
+    return next((response for response in responses if response not in MSET_SUCCESS),
+                responses[0] if responses else None)
+
+
+def is_binary(message):
+    return len(message) > 0 and message[0] == MAGIC
+
+
+# Return the command name of a message in either protocol without decoding the rest of it
+def command_name(message):
+    if is_binary(message):
+        opcode = message[1] if len(message) > 1 else RESPONSE
+        return COMMANDS[opcode - 1] if 0 < opcode <= len(COMMANDS) else None
+
+    return bytes(message[:16]).split(b" ", 1)[0].decode("utf-8", "replace")
+
+
+# Return how many fields follow the command name, without decoding them
+def argument_count(message):
+    if is_binary(message):
+        return HEADER.unpack_from(message)[2] if len(message) >= HEADER.size else 0
+
+    return len(bytes(message).split()) - 1
+
+
+# Values are kept as str; bytes that are not valid UTF-8 round trip through surrogate escapes
+def encode_field(field):
+    if isinstance(field, (bytes, bytearray, memoryview)):
+        return bytes(field)
+
+    return str(field).encode("utf-8", "surrogateescape")
+
+
+def decode_field(field):
+    return str(field, "utf-8", "surrogateescape")
+
+
+def encode(opcode, fields):
+    parts = [HEADER.pack(MAGIC, opcode, len(fields))]
+
+    for field in fields:
+        data = encode_field(field)
+        parts.append(FIELD.pack(len(data)))
+        parts.append(data)
+
+    return b"".join(parts)
+
+
+# Split a binary message into its opcode and fields; the fields are memoryview slices of message, not copies
+def decode(message):
+    view = memoryview(message)
+    magic, opcode, count = HEADER.unpack_from(view)
+
+    if magic != MAGIC:
+        raise ValueError("Not a binary message")
+
+    offset = HEADER.size
+    fields = []
+
+    for _ in range(count):
+        (length,) = FIELD.unpack_from(view, offset)
+        offset += FIELD.size
+
+        if offset + length > len(view):
+            raise ValueError("Truncated field")
+
+        fields.append(view[offset:offset + length])
+        offset += length
+
+    return opcode, fields
+
+
+# Encode a command given as [name, arg, ...]
+def encode_command(fields):
+    return encode(OPCODES[fields[0]], fields[1:])
+
+
+# Return a binary command as [name, arg, ...]
+def decode_command(message):
+    opcode, fields = decode(message)
+
+    if not 0 < opcode <= len(COMMANDS):
+        raise ValueError(f"Unknown opcode {opcode}")
+
+    return [COMMANDS[opcode - 1]] + [decode_field(field) for field in fields]
+
+
+def encode_response(fields):
+    return encode(RESPONSE, fields)
+
+
+def decode_response(message):
+    _, fields = decode(message)
+    return [decode_field(field) for field in fields]
+
+
+# Pack fields as "raw" followed by the fields, or as "zlib" and one compressed field once they reach threshold bytes
+def pack_fields(fields, threshold):
+    encoded = [encode_field(field) for field in fields]
+
+    if sum(len(field) for field in encoded) < threshold:
+        return ["raw"] + fields
+
+    return ["zlib", zlib.compress(encode(RESPONSE, encoded))]
+
+
+def unpack_fields(fields):
+    if fields[0] == "zlib":
+        return decode_response(zlib.decompress(encode_field(fields[1])))
+
+    return fields[1:]
+
+
+# Send a command given as [name, arg, ...] in the binary protocol and return the fields of the response
+def send_command(address, fields, timeout=5):
+    return send_commands(address, [fields], timeout)[0]
+
+
+# Pipeline several binary commands over one connection and return the fields of each response
+def send_commands(address, commands, timeout=5):
+    if not commands:
+        return []
+
+    try:
+        replies = exchange(address, [encode_command(fields)
+                                     for fields in commands], timeout)
+        return [decode_response(reply) for reply in replies]
+    except (ValueError, struct.error) as e:
+        logging.error(f"Invalid response from {address}: {e}")
+        return [[f"Invalid response: {e}"]] * len(commands)
+    except Exception as e:
+        return [[connection_error(address, e)]] * len(commands)
@@ -1,26 +1,127 @@
+import asyncio
+import json
 import logging
+import multiprocessing
+import queue
+import random
 import socket
+import struct
 import threading
+import time
 
-from .utils import load_config, send
+from .utils import digest, load_config, read_message, recv_message, send, frame
+from .protocol import argument_count, combine_mset_responses, command_name, decode_command, encode_response, is_binary, send_command, unpack_fields
+from .metrics import Metrics
+from .sharding import ShardMap
+from .storage import create_engine
+from .wal import WriteAheadLog, remove_log
 from .kvstore import CausalConsistencyKVStore, KeyValueStore, EventualConsistencyKVStore, LinearConsistencyKVStore, SequentialConsistencyKVStore
 
 config, config_settings = load_config()
 
+# Commands that read a key and write a new value based on it in one step
+ATOMIC_COMMANDS = ("incr", "cas", "append")
+
 
 class Replica:
-    def __init__(self, id, host, port, consistency_scheme, replica_addresses, sequencer_address):
+    def __init__(self, id, host, port, consistency_scheme, replica_addresses, sequencer_address, worker=0, workers=None):
         self.id = id
         self.host = host
-        self.port = port
         self.consistency_scheme = consistency_scheme
-        self.replica_addresses = replica_addresses
-        self.sequencer_address = sequencer_address
+
+        # A replica can be served by several worker processes that share its port, each owning the keys that hash to it.
+        # Each worker also listens on a port of its own, and the consistency scheme runs between the workers with
+        # the same index on each replica, so the port that identifies this worker to the others is that one
+        self.workers = workers or config_settings["replica"].get(
+            "server_workers", 1)
+        self.worker = worker
+        self.worker_port_offset = config_settings["replica"].get(
+            "worker_port_offset", 1000)
+        self.public_port = port
+        self.port = self.worker_address((host, port))[1]
+
+        # Command counts and latencies, reported by the stats command
+        self.metrics = Metrics()
+
+        # Keys are split between groups of replicas; the consistency scheme only runs between the replicas of this group
+        self.shard_map = ShardMap(replica_addresses,
+                                  config_settings["replica"].get(
+                                      "replication_factor", len(replica_addresses)),
+                                  config_settings["replica"].get("virtual_nodes", 64))
+        self.group = self.shard_map.group_of((host, port))
+        self.cluster_addresses = [self.worker_address(address)
+                                  for address in replica_addresses]
+        self.replica_addresses = [self.worker_address(address)
+                                  for address in self.shard_map.groups[self.group]]
+
+        # Every group needs its own sequencer, so groups without the chosen one use their first replica
+        if sequencer_address in self.shard_map.groups[self.group]:
+            self.sequencer_address = self.worker_address(sequencer_address)
+        else:
+            self.sequencer_address = self.replica_addresses[0]
 
         self.gossip_interval = config_settings["replica"]["gossip_interval"]
+        self.gossip_max_interval = config_settings["replica"].get(
+            "gossip_max_interval", 30)
+        self.gossip_batch_size = config_settings["replica"].get(
+            "gossip_batch_size", 1000)
+        self.gossip_batch_bytes = config_settings["replica"].get(
+            "gossip_batch_bytes", 65536)
+        self.gossip_fanout = config_settings["replica"].get(
+            "gossip_fanout", 0)
+        self.gossip_compress_bytes = config_settings["replica"].get(
+            "gossip_compress_bytes", 1024)
+        self.anti_entropy_interval = config_settings["replica"].get(
+            "anti_entropy_interval", 10)
+        self.merkle_depth = config_settings["replica"].get("merkle_depth", 10)
+        self.write_quorum = config_settings["replica"].get(
+            "write_quorum", "all")
+        self.replication_timeout = config_settings["replica"].get(
+            "replication_timeout", 5)
+        self.simulated_latency = config_settings["replica"].get(
+            "simulated_latency", 3)
+        self.sequencer_batch_interval = config_settings["replica"].get(
+            "sequencer_batch_interval", 5)
+        self.sequencer_batch_size = config_settings["replica"].get(
+            "sequencer_batch_size", 1000)
+        self.sequencer_history = config_settings["replica"].get(
+            "sequencer_history", 1000)
+        self.sequencer_heartbeat_interval = config_settings["replica"].get(
+            "sequencer_heartbeat_interval", 1)
+        self.causal_batch_interval = config_settings["replica"].get(
+            "causal_batch_interval", 5)
+        self.causal_batch_size = config_settings["replica"].get(
+            "causal_batch_size", 1000)
         self.output_location = config_settings["replica"]["output_location"]
         self.output_suffix = config_settings["replica"]["output_suffix"]
-        self.save_location = f"{self.output_location}/{self.id}_{self.output_suffix}"
+        file_prefix = self.id if self.workers == 1 else f"{self.id}_worker_{worker}"
+        self.save_location = f"{self.output_location}/{file_prefix}_{self.output_suffix}"
+        self.log_location = f"{self.output_location}/{file_prefix}_wal.log"
+        self.storage_location = f"{self.output_location}/{file_prefix}"
+        self.snapshot_interval = config_settings["replica"].get(
+            "snapshot_interval", 5)
+        self.server_mode = config_settings["replica"].get(
+            "server_mode", "threaded")
+        self.executor_workers = config_settings["replica"].get(
+            "executor_workers", 8)
+        self.scan_page_size = config_settings["replica"].get(
+            "scan_page_size", 1000)
+        self.session_wait = config_settings["replica"].get(
+            "session_wait", 0.5)
+        self.leader_lease = config_settings["replica"].get(
+            "leader_lease", 0)
+        self.recover_on_startup = config_settings["replica"].get(
+            "recover_on_startup", False)
+        self.hint_max_bytes = config_settings["replica"].get(
+            "hint_max_bytes", 64 * 1024 * 1024)
+        self.hint_retry_interval = config_settings["replica"].get(
+            "hint_retry_interval", 0.5)
+        self.hint_max_retry_interval = config_settings["replica"].get(
+            "hint_max_retry_interval", 30)
+        self.bootstrap_on_startup = config_settings["replica"].get(
+            "bootstrap_on_startup", False)
+        self.bootstrap_chunk_size = config_settings["replica"].get(
+            "bootstrap_chunk_size", 1000)
 
         # Initialize the chosen consistency scheme
         if consistency_scheme == "eventual":
@@ -34,55 +135,594 @@ class Replica:
         else:
             self.kv_store = KeyValueStore()
 
+        self.kv_store.store = create_engine(
+            config_settings["replica"], self.storage_location, self.recover_on_startup)
+
+        # Reload the previous state, or start from an empty store and log
+        if self.recover_on_startup:
+            start_time = time.perf_counter()
+            keys, records = self.kv_store.recover(
+                self.save_location, self.log_location)
+
+            logging.info(
+                f"{self.id} recovered {keys} keys and replayed {records} log records in {time.perf_counter() - start_time:.3f}s")
+        else:
+            remove_log(self.log_location)
+
+        self.kv_store.wal = WriteAheadLog(self.log_location,
+                                          config_settings["replica"].get(
+                                              "wal_sync_interval", 10),
+                                          config_settings["replica"].get("wal_sync_records", 100))
+
+        threading.Thread(target=self.snapshot_thread, daemon=True).start()
+
         # Create socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
 
+        # Queue connections in the backlog until the server loop starts accepting them
+        self.socket.listen()
+        self.sockets = [self.socket]
+
+        # Every worker accepts clients on the replica's port, and the kernel spreads connections between them
+        if self.workers > 1:
+            public_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            public_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            public_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            public_socket.bind((self.host, self.public_port))
+            public_socket.listen()
+            self.sockets.append(public_socket)
+
         logging.debug(
             f"{self.id} initialized at {self.host}:{self.port}")
 
-    # Handle commands from clients
+    # Answer a message and record how long it took under the name of its command
+    def handle_message(self, message, addr):
+        start_time = time.perf_counter()
+        response = self.answer_message(message, addr)
+        self.metrics.record_command(command_name(message),
+                                    time.perf_counter() - start_time, len(message))
+
+        return response
+
+    # Answer a message in the protocol it was sent in; binary messages carry fields that may contain spaces.
+    # Logging every message is only worth formatting it when debug logging is on
+    def answer_message(self, message, addr):
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        if is_binary(message):
+            try:
+                cmd = decode_command(message)
+            except (ValueError, struct.error):
+                return encode_response(["Invalid command"])
+
+            if debug:
+                logging.debug(f"{self.id} received {cmd} from {addr}")
+
+            response = self.handle_command(cmd)
+
+            return encode_response([response] if isinstance(response, str) else response)
+
+        data = message.decode("utf-8", "surrogateescape")
+
+        if debug:
+            logging.debug(f"{self.id} received \"{data}\" from {addr}")
+
+        response = self.handle_command(data)
+
+        # Session tokens are only sent in the binary protocol, so text writes keep their one-line response
+        if isinstance(response, list) and command_name(message) in ("set", "mset"):
+            return response[0]
+
+        # Text clients get multi-value responses one value per line
+        return response if isinstance(response, str) else "\n".join(response)
+
+    # Handle commands from clients, given as a text command or a list of fields
     def handle_command(self, command):
-        cmd = command.split()
+        cmd = command.split() if isinstance(command, str) else command
+
+        # Text commands cannot carry an empty field, so "-" stands for an open start or end of a scan
+        if isinstance(command, str) and len(cmd) > 2 and cmd[0] == "scan":
+            cmd[1:3] = ["" if bound == "-" else bound for bound in cmd[1:3]]
+
+        try:
+            return self.execute_command(cmd)
+        except (IndexError, ValueError):
+            return "Invalid command"
+
+    def execute_command(self, cmd):
         cmd_action = cmd[0]
 
+        # Keys owned by another group are handled by one of its replicas
+        if cmd_action in ("get", "set") + ATOMIC_COMMANDS and len(cmd) > 1:
+            owner = self.route(cmd[1])
+
+            if owner is not None:
+                response = send_command(owner, cmd)
+
+                # Sets are answered with their session token as well
+                return response if cmd_action == "set" else response[0]
+
+        # With leader leases, linear reads and writes are served by the lease holder, so reads need no round trip to other replicas
+        if cmd_action in ("get", "set", "mget", "mset") and self.consistency_scheme == "linear" and self.kv_store.leases:
+            leader = self.kv_store.leader(self.blocking_timeout())
+
+            if leader is None:
+                return "No leader lease"
+
+            if leader != (self.host, self.port):
+                response = send_command(leader, cmd)
+                return response[0] if cmd_action == "get" else response
+
         if cmd_action == "get":
+            # get key [token]
+            if len(cmd) > 2 and cmd[2]:
+                return self.session_get(cmd[1], cmd[2])
+
             return self.kv_store.get(cmd[1])
         elif cmd_action == "set":
-            response = self.kv_store.set(cmd[1], cmd[2])
-            self.kv_store.save(self.save_location)
+            # set key value [ttl], where the key expires ttl seconds after it is written
+            ttl = float(cmd[3]) if len(cmd) > 3 and cmd[3] else None
+            response = self.kv_store.set(cmd[1], cmd[2], ttl=ttl)
+            token = self.kv_store.session_token(cmd[1])
+
+            return [response, token] if token else response
+        elif cmd_action in ATOMIC_COMMANDS:
+            return self.atomic(cmd)
+        elif cmd_action == "mget":
+            # One value per key, in the order the keys were requested
+            return self.mget(cmd[1:])
+        elif cmd_action == "mset":
+            if len(cmd) < 3 or len(cmd) % 2 == 0:
+                return "Invalid command"
 
-            return response
+            return self.mset(list(zip(cmd[1::2], cmd[2::2])))
+        elif cmd_action == "scan":
+            # scan start end limit [cursor], where an empty end has no upper bound
+            return self.scan(cmd[4] if len(cmd) > 4 else cmd[1], cmd[2], int(cmd[3]))
+        elif cmd_action == "prefix":
+            # prefix p limit [cursor]
+            return self.scan(cmd[3] if len(cmd) > 3 else cmd[1], "", int(cmd[2]), cmd[1])
+        elif cmd_action == "range":
+            cursor, pairs = self.kv_store.scan(cmd[1], cmd[2], int(cmd[3]),
+                                               cmd[4] if len(cmd) > 4 else "")
+            return [cursor] + [field for pair in pairs for field in pair]
         # elif cmd_action == "delete":
         #     response = self.kv_store.delete(cmd[1])
         #     self.kv_store.save(self.save_location)
 
         #     return response
+        elif cmd_action == "lease" and self.consistency_scheme == "linear":
+            return self.kv_store.grant_lease(cmd[1])
+        elif cmd_action == "gossip" and self.consistency_scheme == "eventual":
+            return self.kv_store.receive_gossip(unpack_fields(cmd[1:]))
+        elif cmd_action == "merkle" and self.consistency_scheme == "eventual":
+            return self.kv_store.merkle_hashes(cmd[1:])
+        elif cmd_action == "merkle_range" and self.consistency_scheme == "eventual":
+            return self.kv_store.merkle_range(cmd[1:])
+        elif cmd_action == "sequence" and self.consistency_scheme == "sequential":
+            return self.kv_store.apply_sequence(int(cmd[1]), cmd[2:])
+        elif cmd_action == "forward" and self.consistency_scheme == "sequential":
+            return self.kv_store.forward(cmd[1:])
+        elif cmd_action == "retransmit" and self.consistency_scheme == "sequential":
+            return self.kv_store.retransmit(int(cmd[1]), int(cmd[2]))
+        elif cmd_action == "heartbeat" and self.consistency_scheme == "sequential":
+            return self.kv_store.heartbeat(int(cmd[1]))
+        elif cmd_action == "snapshot":
+            # snapshot cursor limit
+            return self.kv_store.snapshot(cmd[1], int(cmd[2]))
         elif cmd_action == "save":
             return self.kv_store.save(self.save_location)
+        elif cmd_action == "stats":
+            return self.stats()
         elif cmd_action == "update":
-            response = self.kv_store.update(cmd[1:])
-            self.kv_store.save(self.save_location)
-
-            return response
+            return self.kv_store.update(cmd[1:])
         else:
             return "Invalid command"
 
+    # Run an atomic operation on the replica of the group that runs every operation, so none of them can miss the write
+    # of another: the sequencer with sequential consistency, the lease holder with linear consistency and leader leases,
+    # and otherwise the first replica of the group that is up. With eventual and causal consistency, sets made on other
+    # replicas at the same time still win or lose against the operation's write as usual
+    def atomic(self, cmd):
+        # incr key [amount], cas key expected new, append key suffix
+        if cmd[0] == "incr":
+            args = [str(int(cmd[2]) if len(cmd) > 2 else 1)]
+        elif cmd[0] == "cas":
+            args = [cmd[2], cmd[3]]
+        else:
+            args = [cmd[2]]
+
+        if self.consistency_scheme == "sequential":
+            coordinators = [self.sequencer_address]
+        elif self.consistency_scheme == "linear" and self.kv_store.leases:
+            leader = self.kv_store.leader(self.blocking_timeout())
+
+            if leader is None:
+                return "No leader lease"
+
+            coordinators = [leader]
+        else:
+            coordinators = self.replica_addresses
+
+        for coordinator in coordinators:
+            if coordinator == (self.host, self.port):
+                return self.kv_store.atomic(cmd[0], cmd[1], args)
+
+            response = send_command(coordinator, [cmd[0], cmd[1]] + args)[0]
+
+            # Only a replica that refused the connection cannot have run the operation, so only then is the next one tried
+            if "Connection refused" not in response:
+                return response
+
+        return response
+
+    # Return the address of a replica in the group that owns key, or of the worker of this replica that owns it,
+    # or None if this worker owns it
+    def route(self, key):
+        group = self.shard_map.group_index(key)
+
+        if group != self.group:
+            return random.choice(self.shard_map.groups[group])
+
+        worker = self.worker_of(key)
+
+        if worker != self.worker:
+            return self.worker_address((self.host, self.public_port), worker)
+
+        return None
+
+    # The worker of every replica that owns key; all replicas run the same number of workers
+    def worker_of(self, key):
+        return digest(key) % self.workers if self.workers > 1 else 0
+
+    # The address a worker of the replica at address listens on for other replicas and workers
+    def worker_address(self, address, worker=None):
+        if self.workers == 1:
+            return address
+
+        worker = self.worker if worker is None else worker
+
+        return (address[0], address[1] + self.worker_port_offset * (worker + 1))
+
+    # Split keys (or key-value pairs) by where they are handled, keeping their order: None for this worker,
+    # otherwise a replica of the group that owns them or the worker of this replica that owns them
+    def partition(self, items, key=lambda item: item):
+        parts = {}
+
+        for group, group_items in self.shard_map.split(items, key).items():
+            if group != self.group:
+                parts[random.choice(self.shard_map.groups[group])] = group_items
+                continue
+
+            for item in group_items:
+                parts.setdefault(self.route(key(item)), []).append(item)
+
+        return parts
+
+    # Read keys from this worker and fetch the rest from where they are handled, one message per group or worker
+    def mget(self, keys):
+        values = {}
+
+        for address, part_keys in self.partition(keys).items():
+            if address is None:
+                part_values = self.kv_store.mget(part_keys)
+            else:
+                part_values = send_command(address, ["mget"] + part_keys)
+
+                if len(part_values) != len(part_keys):
+                    part_values = [part_values[0]] * len(part_keys)
+
+            values.update(zip(part_keys, part_values))
+
+        return [values[key] for key in keys]
+
+    # Write pairs to this worker and send the rest to where they are handled, one message per group or worker.
+    # The others are written from their own threads, so the write waits for the slowest of them rather than each in turn
+    def mset(self, pairs):
+        responses = []
+        tokens = {}
+        part_responses = {}
+        threads = []
+
+        parts = self.partition(pairs, key=lambda pair: pair[0])
+
+        for address, part_pairs in parts.items():
+            if address is not None:
+                thread = threading.Thread(target=self.send_pairs,
+                                          args=(address, part_pairs, part_responses))
+                thread.start()
+                threads.append(thread)
+
+        if None in parts:
+            responses.append(self.kv_store.mset(parts[None]))
+            tokens.update([(key, self.kv_store.session_token(key))
+                           for key, _ in parts[None]])
+
+        for thread in threads:
+            thread.join()
+
+        for part_pairs, part_response in part_responses.values():
+            responses.append(part_response[0])
+            tokens.update(zip([key for key, _ in part_pairs], part_response[1:]))
+
+        # A failure of any part fails the whole write
+        response = combine_mset_responses(responses)
+
+        # Tokens come from where each key is handled, so there is one per pair, in order
+        if any(tokens.values()):
+            return [response] + [tokens.get(key, "") for key, _ in pairs]
+
+        return response
+
+    def send_pairs(self, address, pairs, responses):
+        responses[address] = (pairs, send_command(address,
+                                                  ["mset"] + [field for pair in pairs for field in pair]))
+
+    # Read key once this replica has applied every write the session token covers, waiting up to
+    # session_wait seconds before reading from a replica that is sure to have them instead
+    def session_get(self, key, token):
+        if self.kv_store.wait_for_session(key, token, self.session_wait):
+            return self.kv_store.get(key)
+
+        source = self.kv_store.session_source(token)
+
+        if source is None or source == (self.host, self.port):
+            return self.kv_store.get(key)
+
+        logging.debug(
+            f"{self.id} has not caught up with session token {token}, reading {key} from {source}")
+
+        return send_command(source, ["get", key, token])[0]
+
+    # Return the replica's metrics, replication state and storage size as one JSON document
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats["replica"] = self.id
+        stats["consistency_scheme"] = self.consistency_scheme
+        stats.update(self.kv_store.stats())
+
+        return json.dumps(stats)
+
+    # Replica ids are numbered in the order of the cluster's addresses
+    def address_of(self, replica_id):
+        return self.cluster_addresses[int(replica_id.rsplit("_", 1)[1])]
+
+    # Return one page of pairs in key order from every group and worker, as the key the next page starts at followed by the pairs
+    def scan(self, start, end, limit, prefix=""):
+        limit = max(min(limit, self.scan_page_size), 1)
+        pairs = []
+        cursors = []
+
+        # Every worker of one replica of each group holds its own part of the group's keys
+        sources = [(group, worker) for group in range(len(self.shard_map.groups))
+                   for worker in range(self.workers)]
+
+        for group, worker in sources:
+            if group == self.group and worker == self.worker:
+                cursor, group_pairs = self.kv_store.scan(start, end, limit, prefix)
+            else:
+                replica = (self.host, self.public_port) if group == self.group else \
+                    random.choice(self.shard_map.groups[group])
+                response = send_command(self.worker_address(replica, worker),
+                                        ["range", start, end, str(limit), prefix])
+
+                # A page is a cursor and pairs, so an even number of fields is an error
+                if len(response) % 2 == 0:
+                    return response
+
+                cursor, group_pairs = response[0], list(
+                    zip(response[1::2], response[2::2]))
+
+            if cursor:
+                cursors.append(cursor)
+
+            pairs += group_pairs
+
+        pairs.sort()
+
+        # The page ends where the first group has more keys, or after limit pairs
+        if len(pairs) > limit:
+            cursors.append(pairs[limit][0])
+
+        cursor = min(cursors, default="")
+
+        if cursor:
+            pairs = [pair for pair in pairs if pair[0] < cursor]
+
+        return [cursor] + [field for pair in pairs for field in pair]
+
+    # Copy the store of a peer in the group chunk by chunk, then continue replicating from where the copy was taken.
+    # Writes and replication are applied while it loads, and copied values never replace them. Returns whether a copy finished
+    def bootstrap(self):
+        peers = [address for address in self.replica_addresses
+                 if address != (self.host, self.port)]
+        random.shuffle(peers)
+
+        if not peers:
+            return False
+
+        start_time = time.perf_counter()
+        self.kv_store.begin_bootstrap()
+
+        # A peer that fails part way is replaced by the next one, whose copy starts over
+        for address in peers:
+            copied = self.copy_snapshot(address)
+
+            if copied is not None:
+                position, keys = copied
+                self.kv_store.finish_bootstrap(position)
+
+                logging.info(
+                    f"{self.id} copied {keys} keys from {address[0]}:{address[1]} in {time.perf_counter() - start_time:.3f}s")
+
+                return True
+
+        self.kv_store.finish_bootstrap("")
+        logging.error(f"{self.id} could not copy the store of any peer")
+
+        return False
+
+    # Load every chunk of a peer's store, returning the position the copy was taken at and how many keys it held,
+    # or None if the peer stopped answering
+    def copy_snapshot(self, address):
+        cursor = ""
+        position = None
+        keys = 0
+
+        while True:
+            response = send_command(address, ["snapshot", cursor, str(self.bootstrap_chunk_size)],
+                                    timeout=self.replication_timeout)
+
+            # A chunk is a cursor and a position followed by entries, so a single field is an error
+            if len(response) < 2:
+                logging.error(
+                    f"{self.id} failed to copy the store of {address[0]}:{address[1]}: {response[0]}")
+                return None
+
+            if position is None:
+                position = response[1]
+
+            keys += self.kv_store.load_snapshot(response[2:])
+            cursor = response[0]
+
+            if not cursor:
+                return position, keys
+
+    # How long a command may wait for the rest of the group: not at all on the event loop, which the lease holder
+    # answers reads on, in case the lease lapsed after the command was judged not to block
+    def blocking_timeout(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.replication_timeout
+
+        return 0
+
+    # Commands that wait on other replicas must not run on the event loop
+    def is_blocking(self, message):
+        cmd_action = command_name(message)
+
+        if cmd_action in self.kv_store.blocking_commands:
+            return True
+
+        # Atomic operations may run on another replica of the group
+        if cmd_action in ATOMIC_COMMANDS:
+            return True
+
+        # A read with a session token may have to wait for this replica to catch up
+        if cmd_action == "get" and argument_count(message) > 1:
+            return True
+
+        # Only the holder of a leader lease answers linear reads without waiting on another replica
+        if cmd_action in ("get", "mget") and self.consistency_scheme == "linear" and \
+                self.kv_store.leases and not self.kv_store.holds_lease():
+            return True
+
+        # Keys may belong to another group or worker
+        return (self.shard_map.is_sharded() or self.workers > 1) and \
+            cmd_action in ("get", "set", "mget", "mset", "scan", "prefix")
+
+    # Periodically write a snapshot of the store so the write-ahead log stays short
+    def snapshot_thread(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+
+            # Skip the snapshot if nothing has been written since the last one
+            if self.kv_store.wal.records:
+                try:
+                    self.kv_store.save(self.save_location)
+                except OSError as e:
+                    logging.error(f"{self.id} failed to write snapshot: {e}")
+
+    # Serve requests on a connection until the sender closes it
     def handle_client(self, conn, addr):
         with conn:
-            data = conn.recv(1024).decode()
+            while True:
+                try:
+                    message = recv_message(conn)
+                except OSError as e:
+                    logging.debug(f"{self.id} lost connection to {addr}: {e}")
+                    break
+
+                if message is None:
+                    break
+
+                response = frame(self.handle_message(message, addr))
+                self.metrics.count("bytes_out", len(response))
+                conn.sendall(response)
+
+    # Serve many requests on one connection without blocking the event loop
+    async def handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                message = await read_message(reader)
+
+                if message is None:
+                    break
+
+                # Commands that wait on other replicas run on the executor
+                if self.is_blocking(message):
+                    future = loop.create_future()
+                    self.work_queue.put((loop, future, message, addr))
+                    response = await future
+                else:
+                    response = self.handle_message(message, addr)
 
-            if data:
-                logging.debug(f"{self.id} received \"{data}\" from {addr}")
-                response = self.handle_command(data)
-                # print(response)
-                conn.sendall(response.encode())
+                response = frame(response)
+                self.metrics.count("bytes_out", len(response))
+                writer.write(response)
+                await writer.drain()
+        except ConnectionError as e:
+            logging.debug(f"{self.id} lost connection to {addr}: {e}")
+        finally:
+            writer.close()
+
+    # Run blocking commands on a fixed set of worker threads and hand the result back to the event loop
+    def command_worker(self):
+        while True:
+            loop, future, message, addr = self.work_queue.get()
+
+            try:
+                response = self.handle_message(message, addr)
+            except Exception as e:
+                loop.call_soon_threadsafe(future.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(future.set_result, response)
+
+    async def serve(self):
+        # concurrent.futures executors refuse work once the main thread exits, so use plain threads
+        self.work_queue = queue.Queue()
+
+        for _ in range(self.executor_workers):
+            threading.Thread(target=self.command_worker, daemon=True).start()
+
+        servers = [await asyncio.start_server(self.handle_client_async, sock=sock)
+                   for sock in self.sockets]
+        logging.info(
+            f"{self.id} listening on {self.describe_ports()} (asyncio)")
+
+        await asyncio.gather(*[server.serve_forever() for server in servers])
 
     def listen(self):
-        with self.socket as sock:
-            sock.listen()
-            logging.info(f"{self.id} listening on {self.host}:{self.port}")
+        if self.server_mode == "asyncio":
+            asyncio.run(self.serve())
+            return
+
+        logging.info(f"{self.id} listening on {self.describe_ports()}")
+
+        for sock in self.sockets[1:]:
+            threading.Thread(target=self.accept_connections,
+                             args=(sock,), daemon=True).start()
+
+        self.accept_connections(self.socket)
 
+    def accept_connections(self, sock):
+        with sock:
             while True:
                 conn, addr = sock.accept()
 
@@ -91,7 +731,17 @@ class Replica:
                     target=self.handle_client, args=(conn, addr))
                 thread.start()
 
+    def describe_ports(self):
+        if self.workers == 1:
+            return f"{self.host}:{self.port}"
+
+        return f"{self.host}:{self.public_port} as worker {self.worker} of {self.workers} ({self.host}:{self.port})"
+
     def run(self):
+        # Copy a peer's store while serving, so replication to this replica is not held up meanwhile
+        if self.bootstrap_on_startup:
+            threading.Thread(target=self.bootstrap, daemon=True).start()
+
         # Listen for client commands
         self.listen()
 
@@ -104,3 +754,24 @@ class Replica:
 
     def start(self):
         self.run()
+
+
+# Start a replica as workers processes that share its port, each owning the keys that hash to it, and return them.
+# Workers are spawned rather than forked, since a fork would copy the locks other threads of this process hold
+def start_replica_workers(id, host, port, consistency_scheme, replica_addresses, sequencer_address, workers):
+    context = multiprocessing.get_context("spawn")
+    processes = []
+
+    for worker in range(workers):
+        process = context.Process(target=run_replica_worker,
+                                  args=(id, host, port, consistency_scheme, replica_addresses,
+                                        sequencer_address, worker, workers))
+        process.start()
+        processes.append(process)
+
+    return processes
+
+
+def run_replica_worker(id, host, port, consistency_scheme, replica_addresses, sequencer_address, worker, workers):
+    Replica(id, host, port, consistency_scheme, replica_addresses,
+            sequencer_address, worker, workers).start()
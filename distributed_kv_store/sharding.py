@@ -0,0 +1,58 @@
+import bisect
+
+from .utils import digest
+
+
+# Consistent hash ring that maps each key to the replica group that stores it
+class ShardMap:
+    def __init__(self, replica_addresses, replication_factor, virtual_nodes):
+        replication_factor = min(
+            max(int(replication_factor), 1), len(replica_addresses))
+
+        # Every replication_factor consecutive replicas form a group holding a full copy of its shard
+        self.groups = [replica_addresses[i:i + replication_factor]
+                       for i in range(0, len(replica_addresses), replication_factor)]
+
+        # Each group is placed on the ring many times so keys spread evenly and adding a group moves few of them
+        ring = sorted((digest(f"{group[0][0]}:{group[0][1]}#{node}"), index)
+                      for index, group in enumerate(self.groups) for node in range(virtual_nodes))
+
+        self.ring_hashes = [ring_hash for ring_hash, _ in ring]
+        self.ring_groups = [index for _, index in ring]
+
+    def is_sharded(self):
+        return len(self.groups) > 1
+
+    # Return the index of the group that owns key, the first one clockwise of its hash
+    def group_index(self, key):
+        position = bisect.bisect(self.ring_hashes, digest(key))
+        return self.ring_groups[position % len(self.ring_hashes)]
+
+    def owners(self, key):
+        return self.groups[self.group_index(key)]
+
+    def group_of(self, address):
+        for index, group in enumerate(self.groups):
+            if address in group:
+                return index
+
+        return None
+
+    # Split keys (or key-value pairs) by the index of the group that owns them, keeping their order
+    def split(self, items, key=lambda item: item):
+        groups = {}
+
+        for item in items:
+            groups.setdefault(self.group_index(key(item)), []).append(item)
+
+        return groups
+
+
+# Build the shard map for the replicas listed in the config file
+def shard_map_from_config(config_settings):
+    replica_settings = config_settings["replica"]
+    replica_addresses = [(replica_settings["ip"], replica_settings["port"] + i)
+                         for i in range(config_settings["num_replicas"])]
+
+    return ShardMap(replica_addresses, replica_settings.get("replication_factor", len(replica_addresses)),
+                    replica_settings.get("virtual_nodes", 64))
@@ -0,0 +1,208 @@
+import collections
+import os
+import struct
+import sys
+import threading
+from collections.abc import Mapping, MutableMapping
+
+from .lsm import LSMEngine
+
+# A spilled record is the key and value lengths followed by the key and value
+RECORD = struct.Struct("!II")
+
+# Rewrite the segment file once this many bytes in it belong to overwritten or deleted keys
+COMPACTION_THRESHOLD = 1 << 20
+
+
+# Keys and values are Python strings, so count what the objects cost rather than just their text
+def entry_size(key, value):
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+def encode_text(text):
+    return text.encode("utf-8", "surrogateescape")
+
+
+# Append-only file of key-value records evicted from memory
+class Segment:
+    def __init__(self, filename):
+        self.filename = filename
+
+        # Unbuffered so a record can be read back with pread as soon as it has been appended
+        self.file = open(filename, "w+b", buffering=0)
+        self.size = 0
+
+    # Append a record and return the (offset, length) of its value and the size of the whole record
+    def append(self, key, value):
+        key, value = encode_text(key), encode_text(value)
+        self.file.write(RECORD.pack(len(key), len(value)) + key + value)
+
+        offset = self.size + RECORD.size + len(key)
+        self.size += RECORD.size + len(key) + len(value)
+
+        return offset, len(value), RECORD.size + len(key) + len(value)
+
+    def read(self, offset, length):
+        return str(os.pread(self.file.fileno(), length, offset), "utf-8", "surrogateescape")
+
+
+# A storage engine is a MutableMapping of str keys to str values with a copy() that returns a consistent
+# read-only Mapping for snapshots. A plain dict is the in-memory engine. Engines with persistent set keep
+# their own files under location and reopen them when recovering, instead of being snapshotted
+def create_engine(settings, location, recover):
+    storage_engine = settings.get("storage_engine", "memory")
+
+    if storage_engine == "lru":
+        return LRUEngine(settings.get("memory_budget", 64 << 20), f"{location}_spill.dat")
+    elif storage_engine == "lsm":
+        return LSMEngine(f"{location}_lsm", settings.get("memtable_size", 4 << 20),
+                         settings.get("compaction_trigger", 4), recover)
+    else:
+        return {}
+
+
+# Keeps at most memory_budget bytes of recently used entries in memory and spills the rest to a segment file,
+# reading them back on access
+class LRUEngine(MutableMapping):
+    def __init__(self, memory_budget, spill_filename):
+        self.memory_budget = memory_budget
+        self.spill_filename = spill_filename
+
+        # Entries in memory, least recently used first
+        self.hot = collections.OrderedDict()
+        self.memory_usage = 0
+
+        # Spilled keys map to where their value is in the segment; a key that is also in memory
+        # was read back without being changed, so evicting it again does not need another write
+        self.spilled = {}
+        self.segment = Segment(spill_filename)
+        self.garbage = 0
+
+        self.length = 0
+        self.lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.hot:
+                self.hot.move_to_end(key)
+                return self.hot[key]
+
+            offset, length, _ = self.spilled[key]
+            value = self.segment.read(offset, length)
+            self.load(key, value)
+
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if not self.discard(key):
+                self.length += 1
+
+            self.load(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if not self.discard(key):
+                raise KeyError(key)
+
+            self.length -= 1
+
+    # Membership and iteration never read values from disk or change which entries stay in memory
+    def __contains__(self, key):
+        return key in self.hot or key in self.spilled
+
+    def __iter__(self):
+        with self.lock:
+            keys = list(self.hot) + \
+                [key for key in self.spilled if key not in self.hot]
+
+        return iter(keys)
+
+    def __len__(self):
+        return self.length
+
+    # Return every entry without loading spilled ones back into memory
+    def items(self):
+        for key in self:
+            with self.lock:
+                if key in self.hot:
+                    yield key, self.hot[key]
+                elif key in self.spilled:
+                    offset, length, _ = self.spilled[key]
+                    yield key, self.segment.read(offset, length)
+
+    def stats(self):
+        with self.lock:
+            return {"memory_bytes": self.memory_usage, "spilled_keys": len(self.spilled),
+                    "segment_bytes": self.segment.size}
+
+    def copy(self):
+        with self.lock:
+            return EngineSnapshot(dict(self.hot), dict(self.spilled), self.segment)
+
+    # Remove key from memory and disk, returning whether it was stored
+    def discard(self, key):
+        stored = False
+
+        if key in self.hot:
+            self.memory_usage -= entry_size(key, self.hot.pop(key))
+            stored = True
+
+        if key in self.spilled:
+            self.garbage += self.spilled.pop(key)[2]
+            stored = True
+
+        return stored
+
+    def load(self, key, value):
+        self.hot[key] = value
+        self.memory_usage += entry_size(key, value)
+        self.evict()
+
+    # Move least recently used entries to the segment file until the ones in memory fit in the budget
+    def evict(self):
+        while self.memory_usage > self.memory_budget and len(self.hot) > 1:
+            key, value = self.hot.popitem(last=False)
+            self.memory_usage -= entry_size(key, value)
+
+            if key not in self.spilled:
+                self.spilled[key] = self.segment.append(key, value)
+
+        if self.garbage > max(COMPACTION_THRESHOLD, self.segment.size // 2):
+            self.compact()
+
+    # Copy the live records to a new segment file; snapshots taken earlier keep reading the old one
+    def compact(self):
+        segment = Segment(f"{self.spill_filename}.compact")
+        spilled = {}
+
+        for key, (offset, length, _) in self.spilled.items():
+            spilled[key] = segment.append(
+                key, self.segment.read(offset, length))
+
+        os.replace(segment.filename, self.spill_filename)
+        segment.filename = self.spill_filename
+
+        self.segment, self.spilled, self.garbage = segment, spilled, 0
+
+
+# Read-only view of an LRUEngine at the time it was copied
+class EngineSnapshot(Mapping):
+    def __init__(self, hot, spilled, segment):
+        self.hot = hot
+        self.spilled = spilled
+        self.segment = segment
+
+    def __getitem__(self, key):
+        if key in self.hot:
+            return self.hot[key]
+
+        offset, length, _ = self.spilled[key]
+        return self.segment.read(offset, length)
+
+    def __iter__(self):
+        yield from self.hot
+        yield from (key for key in self.spilled if key not in self.hot)
+
+    def __len__(self):
+        return len(self.hot) + sum(1 for key in self.spilled if key not in self.hot)
@@ -1,10 +1,23 @@
+import asyncio
+import codecs
+import contextlib
+import hashlib
 import logging
+import mmap
+import os
 import random
+import re
 import socket
+import struct
+import threading
 import time
 import yaml
 
 
+# Every message is prefixed with its length as a 4 byte unsigned integer
+HEADER = struct.Struct("!I")
+
+
 # Return the config settings in config.yml
 def load_config():
     with open("config/config.yml", "r") as f:
@@ -12,47 +25,315 @@ def load_config():
         config_settings = config["settings"]
         return config, config_settings
 
-# Send data to an address and return the response
-def send(address, data, callback=None, timeout=5):
-    host, port = address
-    response = None
+# Prefix data with its length so it can be sent as a single message
+def frame(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8", "surrogateescape")
+
+    return HEADER.pack(len(data)) + data
+
+# Send a length-prefixed message over a connected socket
+def send_message(sock, data):
+    sock.sendall(frame(data))
+
+# Read exactly size bytes from a socket, or None if the connection closes first
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+
+    while received < size:
+        count = sock.recv_into(view[received:])
+
+        if count == 0:
+            return None
+
+        received += count
+
+    return bytes(buffer)
+
+# Read a length-prefixed message from a socket, or None if the connection closed
+def recv_message(sock):
+    header = recv_exactly(sock, HEADER.size)
+
+    if header is None:
+        return None
+
+    (length,) = HEADER.unpack(header)
+    return recv_exactly(sock, length)
+
+# Read a length-prefixed message from an asyncio stream, or None if the connection closed
+async def read_message(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+        (length,) = HEADER.unpack(header)
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+# Keep idle connections open so repeated messages to a replica reuse one socket
+class ConnectionPool:
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    # Return an idle connection to address if there is one, otherwise open a new one
+    def acquire(self, address, timeout):
+        with self.lock:
+            connections = self.idle.get(address)
+
+            if connections:
+                sock = connections.pop()
+                sock.settimeout(timeout)
+                return sock, True
+
+        sock = socket.create_connection(address, timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return sock, False
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.settimeout(timeout)
+    # Hand a healthy connection back to the pool
+    def release(self, address, sock):
+        with self.lock:
+            connections = self.idle.setdefault(address, [])
+
+            if len(connections) < self.max_idle:
+                connections.append(sock)
+                return
+
+        sock.close()
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for sock in connections:
+                    sock.close()
+
+            self.idle = {}
+
+
+connection_pool = ConnectionPool()
+
+# Forked processes must not share pooled sockets with their parent
+os.register_at_fork(after_in_child=connection_pool.close_all)
+
+# Send framed messages over one pooled connection in a single write and return the raw replies in order
+def exchange(address, messages, timeout=5):
+    # A pooled connection may have been closed by the peer, so retry once on a fresh one
+    for attempt in range(2):
+        sock = None
+        reused = False
 
         try:
-            sock.connect(address)
-            sock.send(data.encode())
-            response = sock.recv(1024).decode()
+            sock, reused = connection_pool.acquire(address, timeout)
+            sock.sendall(b"".join([frame(message) for message in messages]))
+            replies = []
+
+            for _ in messages:
+                reply = recv_message(sock)
+
+                if reply is None:
+                    raise ConnectionError("connection closed by peer")
+
+                replies.append(reply)
 
-            if callback:
-                callback()
-        except socket.timeout:
-            response = f"Connection to {host}:{port} timed out"
+            connection_pool.release(address, sock)
 
-            logging.error(response)
-            print(response)
+            return replies
         except Exception as e:
-            response = f"Error connecting to {host}:{port}: {e}"
+            if sock is not None:
+                sock.close()
 
-            logging.error(response)
-            print(response)
+            if isinstance(e, socket.timeout) or not reused or attempt:
+                raise
+
+
+# Log and return the response for a message that could not be delivered to address
+def connection_error(address, error):
+    host, port = address
+
+    if isinstance(error, socket.timeout):
+        response = f"Connection to {host}:{port} timed out"
+    else:
+        response = f"Error connecting to {host}:{port}: {error}"
+
+    logging.error(response)
+    print(response)
 
     return response
 
+# Send data to an address and return the response
+def send(address, data, callback=None, timeout=5):
+    try:
+        reply = exchange(address, [data], timeout)[0]
+    except Exception as e:
+        return connection_error(address, e)
+
+    if callback:
+        callback()
+
+    return reply.decode("utf-8", "surrogateescape")
+
+
+# Send several messages over one connection in a single write and return their responses in order
+def send_batch(address, messages, timeout=5):
+    if not messages:
+        return []
+
+    try:
+        replies = exchange(address, messages, timeout)
+    except Exception as e:
+        return [connection_error(address, e)] * len(messages)
+
+    return [reply.decode("utf-8", "surrogateescape") for reply in replies]
+
+
+# A fixed set of locks shared out between keys by hash, so writes to different keys rarely wait for each other
+class StripedLock:
+    def __init__(self, stripes):
+        # Reentrant so a write can call other writes to the same key while holding its lock
+        self.locks = [threading.RLock() for _ in range(stripes)]
+
+    def lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    # Hold the locks of several keys, taken in stripe order so two writers can never deadlock
+    @contextlib.contextmanager
+    def lock_all(self, keys):
+        stripes = sorted({hash(key) % len(self.locks) for key in keys})
+
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.locks[stripe].release()
+
+
+# Collect items from many threads and hand them to flush in batches of up to max_items, waiting at most interval seconds for a batch to fill
+class Batcher:
+    def __init__(self, flush, interval, max_items):
+        self.flush = flush
+        self.interval = interval
+        self.max_items = max_items
+
+        self.items = []
+        self.flushed = threading.Event()
+        self.condition = threading.Condition()
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Queue items and return an event that is set once the batch containing them has been flushed
+    def add(self, items):
+        with self.condition:
+            self.items.extend(items)
+            flushed = self.flushed
+
+            if len(self.items) == len(items) or len(self.items) >= self.max_items:
+                self.condition.notify()
+
+        return flushed
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.items)
+                self.condition.wait_for(lambda: len(
+                    self.items) >= self.max_items, self.interval)
+
+                items, flushed = self.items, self.flushed
+                self.items, self.flushed = [], threading.Event()
+
+            try:
+                self.flush(items)
+            except Exception as e:
+                logging.error(f"Error flushing batch: {e}")
+
+            flushed.set()
+
+
 # Return client commands from file
 def read_commands_from_file(file_name):
     with open(file_name, "r") as f:
         commands = [line.strip().split() for line in f.readlines()]
         return commands
 
-# Write output to file
-def output_dict_to_file(dictionary, file_name):
-    dictionary = dict(sorted(dictionary.items()))
+# Keys and values may contain spaces and newlines now that the binary protocol can carry them,
+# so they are escaped in snapshot files (values only need newlines escaped since the key ends at the first space)
+KEY_ESCAPES = {"\\": "\\\\", "\n": "\\n", " ": "\\s"}
+VALUE_ESCAPES = {"\\": "\\\\", "\n": "\\n"}
+UNESCAPES = {"\\": "\\", "n": "\n", "s": " "}
+ESCAPE_PATTERN = re.compile(r"\\([\\ns])")
+
+
+def escape_field(field, escapes):
+    field = str(field)
+
+    if not any(c in field for c in escapes):
+        return field
+
+    return "".join(escapes.get(c, c) for c in field)
+
+
+def unescape_field(field):
+    if "\\" not in field:
+        return field
+
+    return ESCAPE_PATTERN.sub(lambda match: UNESCAPES[match.group(1)], field)
+
+
+# Write output to file, in the order of keys if it is given and in sorted order otherwise
+def output_dict_to_file(dictionary, file_name, keys=None):
+    temp_file_name = f"{file_name}.tmp"
+
+    # Write to a temporary file first so a crash never leaves a partial snapshot behind
+    with open(temp_file_name, "w", encoding="utf-8", errors="surrogateescape") as f:
+        # Each value is looked up as it is written, so spilled values stay on disk
+        for key in sorted(dictionary) if keys is None else keys:
+            value = dictionary.get(key)
+
+            # Keys deleted since the index was copied are skipped
+            if value is not None:
+                f.write(f"{escape_field(key, KEY_ESCAPES)} {escape_field(value, VALUE_ESCAPES)}\n")
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_file_name, file_name)
+
+
+# Read a file written by output_dict_to_file back into a dictionary
+def load_dict_from_file(file_name):
+    if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+        return {}
+
+    # Decode straight out of the memory-mapped file instead of reading it line by line
+    with open(file_name, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text, _ = codecs.utf_8_decode(mm, "surrogateescape", True)
+
+    # With exactly one space per line and nothing escaped every field can be split in a single pass and paired up
+    if text.endswith("\n") and text.count(" ") == text.count("\n") and "\\" not in text:
+        fields = iter(text.replace("\n", " ").split(" "))
+        return dict(zip(fields, fields))
+
+    dictionary = {}
+
+    for line in text.split("\n"):
+        if line:
+            key, _, value = line.partition(" ")
+            dictionary[unescape_field(key)] = unescape_field(value)
+
+    return dictionary
+
 
-    with open(file_name, "w") as f:
-        for key, value in dictionary.items():
-            f.write(f"{key} {value}\n")
+# Return a stable 64 bit digest of a string (unlike hash(), it is the same on every replica)
+def digest(data):
+    return int.from_bytes(hashlib.blake2b(data.encode("utf-8", "surrogateescape"), digest_size=8).digest(), "big")
 
 
 # Get replica address from replica id
@@ -64,6 +345,6 @@ def get_replica_address(replica_id, replica_settings):
 
 
 # Simulate network latency by sleeping for a random amount of time
-def simulate_latency():
-    sleep_time = random.uniform(0, 3)
+def simulate_latency(max_latency=3):
+    sleep_time = random.uniform(0, max_latency)
     time.sleep(sleep_time)
@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Append-only log of every write to a replica's store, synced to disk in groups
+class WriteAheadLog:
+    def __init__(self, filename, sync_interval, sync_records):
+        self.filename = filename
+        self.rotated_filename = f"{filename}.old"
+
+        # Sync at least every sync_interval milliseconds or every sync_records records
+        self.sync_interval = sync_interval / 1000
+        self.sync_records = sync_records
+        self.unsynced_records = 0
+
+        # Records appended since the log was last rotated
+        self.records = 0
+
+        self.lock = threading.RLock()
+        self.file = open(self.filename, "a", encoding="utf-8")
+
+        threading.Thread(target=self.sync_thread, daemon=True).start()
+
+    def append(self, record):
+        line = json.dumps(record) + "\n"
+
+        with self.lock:
+            self.file.write(line)
+            self.unsynced_records += 1
+            self.records += 1
+
+            if self.unsynced_records >= self.sync_records:
+                self.sync()
+
+    # Flush buffered records and fsync them in a single group commit
+    def sync(self):
+        with self.lock:
+            if self.unsynced_records:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced_records = 0
+
+    def sync_thread(self):
+        while True:
+            time.sleep(self.sync_interval)
+
+            try:
+                self.sync()
+            except (OSError, ValueError) as e:
+                logging.error(f"Error syncing {self.filename}: {e}")
+
+    # Start a new log beginning with the checkpoint records, keeping the previous one until a snapshot covering it has been written
+    def rotate(self, checkpoints):
+        with self.lock:
+            self.sync()
+            self.file.close()
+            os.replace(self.filename, self.rotated_filename)
+
+            self.file = open(self.filename, "a", encoding="utf-8")
+            self.file.write("".join([json.dumps(checkpoint) + "\n" for checkpoint in checkpoints]))
+            self.unsynced_records = len(checkpoints)
+            self.records = 0
+
+    def remove_rotated(self):
+        if os.path.exists(self.rotated_filename):
+            os.remove(self.rotated_filename)
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+
+# Return the records in a log file, in the order they were written
+def read_log(filename):
+    if not os.path.exists(filename):
+        return
+
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave the last record partially written
+                logging.warning(f"Skipping incomplete record in {filename}")
+                return
+
+
+# Delete a log and any rotated log left behind by an unfinished snapshot
+def remove_log(filename):
+    for name in (filename, f"{filename}.old"):
+        if os.path.exists(name):
+            os.remove(name)
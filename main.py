@@ -4,7 +4,7 @@ import random
 import socket
 import threading
 
-from distributed_kv_store import Client, Replica, load_config, send
+from distributed_kv_store import Client, Replica, load_config, send, send_message, recv_message, start_replica_workers
 
 config, config_settings = load_config()
 
@@ -30,6 +30,7 @@ class Main:
         self.host = config_settings["main"]["ip"]
         self.port = config_settings["main"]["port"]
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
 
         self.client_addresses = []
@@ -75,7 +76,13 @@ class Main:
 
         while cmd != "ready":
             conn, addr = self.sock.accept()
-            cmd = conn.recv(1024).decode()
+
+            with conn:
+                message = recv_message(conn)
+                cmd = message.decode() if message else ""
+
+                if cmd == "ready":
+                    send_message(conn, "ok")
 
     # Start replica processes and store their ip and port
     def start_replicas(self):
@@ -88,6 +95,12 @@ class Main:
             replica_ip = replica_settings["ip"]
             replica_port = replica_settings["port"] + i
 
+            # Serve the replica from several processes so it can use more than one core
+            if replica_settings.get("server_workers", 1) > 1:
+                start_replica_workers(replica_id, replica_ip, replica_port, self.consistency_scheme, self.replica_addresses,
+                                      self.sequencer_address, replica_settings["server_workers"])
+                continue
+
             # Start replica process
             replica = Replica(replica_id, replica_ip,
                               replica_port, self.consistency_scheme, self.replica_addresses, self.sequencer_address)
@@ -1,10 +1,20 @@
 import logging
+import os
 import random
+import shutil
+import socket
 import threading
 import time
 
-from distributed_kv_store.replica import Replica
+from distributed_kv_store import replica as replica_module
+from distributed_kv_store.client import Pipeline
+from distributed_kv_store.hints import HintQueue
+from distributed_kv_store.kvstore import KeyValueStore
+from distributed_kv_store.replica import Replica, start_replica_workers
+from distributed_kv_store.lsm import LSMEngine
+from distributed_kv_store.storage import LRUEngine
 from distributed_kv_store.utils import load_config
+from distributed_kv_store.wal import WriteAheadLog, remove_log
 
 config, config_settings = load_config()
 
@@ -23,6 +33,22 @@ def start_replica(id, host, port, consistency_scheme, replica_addresses, sequenc
     return replica
 
 
+# Wait until every address accepts connections
+def wait_for_ports(addresses, timeout=30):
+    deadline = time.time() + timeout
+
+    for address in addresses:
+        while True:
+            try:
+                socket.create_connection(address, timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+
+                time.sleep(0.1)
+
+
 def test_eventual_consistency():
     logging.info("Starting eventual consistency test...")
     replica_addresses = [("localhost", 9500),
@@ -155,28 +181,1185 @@ def test_causal_consistency():
     replica2 = start_replica("replica_2", "localhost",
                              9511, "causal", replica_addresses, None)
 
-    # Set a = 5 (at timestamp 5)
-    replica0.kv_store.set("a", "5", "replica_1", 5)
+    # Set a = 5 and then a = 1 on replica0
+    replica0.kv_store.set("a", "5")
+    replica0.kv_store.set("a", "1")
 
-    # Setting a = 1 (at timestamp 1) should not work because the timestamp is less than the previous timestamp
-    replica0.kv_store.set("a", "1", "replica_1", 1)
+    # Allow the writes to propagate
+    time.sleep(1)
 
-    # Therefore, the replicas should all have a = 5
+    # The replicas should all have the later write, a = 1
     replica0_value = replica0.kv_store.get("a")
     replica1_value = replica1.kv_store.get("a")
     replica2_value = replica2.kv_store.get("a")
 
     logging.debug(
-        f"[replica0] a = {replica0_value}, expected: 5\n[replica1] a = {replica1_value}, expected: 5\n[replica2] a = {replica2_value}, expected: 5")
+        f"[replica0] a = {replica0_value}, expected: 1\n[replica1] a = {replica1_value}, expected: 1\n[replica2] a = {replica2_value}, expected: 1")
+
+    assert replica0_value == "1", "replica0: causal consistency failed"
+    assert replica1_value == "1", "replica1: causal consistency failed"
+    assert replica2_value == "1", "replica2: causal consistency failed"
+
+    # Replica1 sets b = 2 after seeing both of replica0's writes, so b depends on them
+    replica1.kv_store.set("b", "2")
+    time.sleep(1)
+
+    # Replica_1's next write, c = 3, depends on three writes from replica_2 that replica0 has not received yet,
+    # so replica0 must hold it back
+    replica0.kv_store.update(["c", "3", "replica_1", "replica_1:2,replica_2:3", ""])
+    replica0_value = replica0.kv_store.get("c")
+
+    logging.debug(
+        f"[replica0] c = {replica0_value}, expected: Key does not exist")
+
+    assert replica0_value == "Key does not exist", "replica0: causal consistency failed"
+
+    # Once replica_2's writes arrive, the held back write to c is delivered too
+    replica0.kv_store.update(["d", "1", "replica_2", "replica_2:1", "",
+                              "d", "2", "replica_2", "replica_2:2", "",
+                              "d", "3", "replica_2", "replica_2:3", ""])
+
+    replica0_values = replica0.kv_store.mget(["b", "c", "d"])
+
+    logging.debug(
+        f"[replica0] b, c, d = {replica0_values}, expected: ['2', '3', '3']")
 
-    assert replica0_value == "5", "replica0: causal consistency failed"
-    assert replica1_value == "5", "replica1: causal consistency failed"
-    assert replica2_value == "5", "replica2: causal consistency failed"
+    assert replica0_values == ["2", "3", "3"], "replica0: causal consistency failed"
 
     logging.info("Causal consistency test passed\n")
     print("Causal consistency test passed\n")
 
 
+def test_batched_commands():
+    logging.info("Starting batched commands test...")
+
+    replica_addresses = [("localhost", 9512),
+                         ("localhost", 9513), ("localhost", 9514)]
+
+    replica0 = start_replica("replica_0", "localhost",
+                             9512, "linear", replica_addresses, None)
+    replica1 = start_replica("replica_1", "localhost",
+                             9513, "linear", replica_addresses, None)
+    replica2 = start_replica("replica_2", "localhost",
+                             9514, "linear", replica_addresses, None)
+
+    # Set a = 1 and b = 2 in one message, then read them back in the same pipeline
+    responses = Pipeline(replica_addresses[0]).mset(
+        {"a": "1", "b": "2"}).get("a").mget(["a", "b", "c"]).execute()
+
+    logging.debug(f"[replica0] responses = {responses}")
+
+    assert responses[0] == "Key-value pairs added", "replica0: mset failed"
+    assert responses[1] == "1", "replica0: pipelined get failed"
+    assert responses[2] == ["1", "2", "Key does not exist"], "replica0: mget failed"
+
+    # Linear consistency waits for every replica, so all the replicas should have both pairs
+    replica1_values = replica1.kv_store.mget(["a", "b"])
+    replica2_values = replica2.kv_store.mget(["a", "b"])
+
+    logging.debug(
+        f"[replica1] a, b = {replica1_values}, expected: ['1', '2']\n[replica2] a, b = {replica2_values}, expected: ['1', '2']")
+
+    assert replica1_values == ["1", "2"], "replica1: mset replication failed"
+    assert replica2_values == ["1", "2"], "replica2: mset replication failed"
+
+    logging.info("Batched commands test passed\n")
+    print("Batched commands test passed\n")
+
+
+def test_anti_entropy():
+    logging.info("Starting anti-entropy test...")
+
+    replica_addresses = [("localhost", 9515),
+                         ("localhost", 9516), ("localhost", 9517)]
+
+    replica0 = start_replica("replica_0", "localhost",
+                             9515, "eventual", replica_addresses, None)
+    replica1 = start_replica("replica_1", "localhost",
+                             9516, "eventual", replica_addresses, None)
+    replica2 = start_replica("replica_2", "localhost",
+                             9517, "eventual", replica_addresses, None)
+
+    # Set a = 1 and b = 2, then drop the queued gossip as if sending it had failed
+    replica0.kv_store.mset([("a", "1"), ("b", "2")])
+    replica0.kv_store.pending_updates = {}
+
+    # Replica1 has a newer write to b and a key replica0 has never seen
+    time.sleep(0.01)
+    replica1.kv_store.set("b", "3")
+    replica1.kv_store.set("c", "4")
+    replica1.kv_store.pending_updates = {}
+
+    # Synchronizing replica0 with replica1 should leave both with the newest value of every key
+    replica0.kv_store.synchronize(replica_addresses[1])
+
+    replica0_values = replica0.kv_store.mget(["a", "b", "c"])
+    replica1_values = replica1.kv_store.mget(["a", "b", "c"])
+    replica2_values = replica2.kv_store.mget(["a", "b", "c"])
+
+    logging.debug(
+        f"[replica0] a, b, c = {replica0_values}, expected: ['1', '3', '4']\n[replica1] a, b, c = {replica1_values}, expected: ['1', '3', '4']\n[replica2] a, b, c = {replica2_values}, expected: no keys")
+
+    assert replica0_values == ["1", "3", "4"], "replica0: anti-entropy failed"
+    assert replica1_values == ["1", "3", "4"], "replica1: anti-entropy failed"
+    assert replica2_values == ["Key does not exist"] * \
+        3, "replica2: anti-entropy failed"
+    assert replica0.kv_store.merkle_tree.hashes([1]) == replica1.kv_store.merkle_tree.hashes(
+        [1]), "Merkle roots differ after anti-entropy"
+
+    logging.info("Anti-entropy test passed\n")
+    print("Anti-entropy test passed\n")
+
+
+def test_binary_protocol():
+    logging.info("Starting binary protocol test...")
+
+    replica_addresses = [("localhost", 9518),
+                         ("localhost", 9519), ("localhost", 9520)]
+
+    replica0 = start_replica("replica_0", "localhost",
+                             9518, "linear", replica_addresses, None)
+    replica1 = start_replica("replica_1", "localhost",
+                             9519, "linear", replica_addresses, None)
+    replica2 = start_replica("replica_2", "localhost",
+                             9520, "linear", replica_addresses, None)
+
+    # Values with spaces, newlines and bytes that are not UTF-8 can only be sent in the binary protocol
+    value = "hello world\nsecond line " + b"\xff\xfe".decode("utf-8", "surrogateescape")
+
+    responses = Pipeline(replica_addresses[0], "binary").set(
+        "greeting", value).get("greeting").execute()
+
+    logging.debug(f"[replica0] responses = {responses}")
+
+    assert responses[0] == "Key-value pair added", "replica0: binary set failed"
+    assert responses[1] == value, "replica0: binary get failed"
+
+    # Replication between replicas also uses the binary protocol, so the value should arrive intact
+    replica2_value = replica2.kv_store.get("greeting")
+
+    logging.debug(f"[replica2] greeting = {replica2_value!r}, expected: {value!r}")
+
+    assert replica2_value == value, "replica2: binary replication failed"
+
+    # Text commands are still accepted on the same port
+    responses = Pipeline(replica_addresses[1], "text").set(
+        "a", "1").get("a").execute()
+
+    logging.debug(f"[replica1] responses = {responses}")
+
+    assert responses == ["Key-value pair added", "1"], "replica1: text protocol failed"
+
+    logging.info("Binary protocol test passed\n")
+    print("Binary protocol test passed\n")
+
+
+def test_lru_engine():
+    logging.info("Starting LRU engine test...")
+
+    replica_addresses = [("localhost", 9521),
+                         ("localhost", 9522), ("localhost", 9523)]
+
+    replica0 = start_replica("replica_0", "localhost",
+                             9521, "linear", replica_addresses, None)
+    replica1 = start_replica("replica_1", "localhost",
+                             9522, "linear", replica_addresses, None)
+    replica2 = start_replica("replica_2", "localhost",
+                             9523, "linear", replica_addresses, None)
+
+    # Give replica0 room for only a few entries so most of them are spilled to disk
+    replica0.kv_store.store = LRUEngine(1000, "results/replica_0_test_spill.dat")
+
+    pairs = {f"key{i}": f"value{i}" for i in range(50)}
+    response = Pipeline(replica_addresses[0]).mset(pairs).execute()[0]
+
+    assert response == "Key-value pairs added", "replica0: mset failed"
+
+    store = replica0.kv_store.store
+
+    logging.debug(
+        f"[replica0] memory usage = {store.memory_usage}, in memory = {len(store.hot)}, spilled = {len(store.spilled)}")
+
+    assert store.memory_usage <= 1000, "replica0: memory budget exceeded"
+    assert store.spilled, "replica0: nothing was spilled"
+
+    # Spilled values are read back from disk
+    values = Pipeline(replica_addresses[0]).mget(list(pairs)).execute()[0]
+
+    assert values == list(pairs.values()), "replica0: spilled values were not read back"
+
+    logging.info("LRU engine test passed\n")
+    print("LRU engine test passed\n")
+
+
+def test_lsm_engine():
+    logging.info("Starting LSM engine test...")
+
+    replica_addresses = [("localhost", 9524),
+                         ("localhost", 9525), ("localhost", 9526)]
+
+    replica0 = start_replica("replica_0", "localhost",
+                             9524, "linear", replica_addresses, None)
+    replica1 = start_replica("replica_1", "localhost",
+                             9525, "linear", replica_addresses, None)
+    replica2 = start_replica("replica_2", "localhost",
+                             9526, "linear", replica_addresses, None)
+
+    # A small memtable makes replica0 write several tables, which are then merged in the background
+    replica0.kv_store.store = LSMEngine(
+        "results/replica_0_test_lsm", 500, 2, False)
+
+    for i in range(0, 60, 10):
+        pairs = {f"key{j}": f"value{j}" for j in range(i, i + 10)}
+        response = Pipeline(replica_addresses[0]).mset(pairs).execute()[0]
+
+        assert response == "Key-value pairs added", "replica0: mset failed"
+
+    # Overwrite and read back keys that have been written out to tables
+    Pipeline(replica_addresses[0]).set("key0", "new value").execute()
+    replica0.kv_store.save(replica0.save_location)
+
+    keys = [f"key{i}" for i in range(60)]
+    expected = ["new value"] + [f"value{i}" for i in range(1, 60)]
+    values = Pipeline(replica_addresses[0]).mget(keys).execute()[0]
+
+    logging.debug(
+        f"[replica0] tables = {[table.name for table in replica0.kv_store.store.tables]}")
+
+    assert replica0.kv_store.store.tables, "replica0: no tables were written"
+    assert values == expected, "replica0: values were not read back from tables"
+
+    logging.info("LSM engine test passed\n")
+    print("LSM engine test passed\n")
+
+
+def test_scan():
+    logging.info("Starting scan test...")
+
+    # Six replicas form two groups, so a scan has to collect keys from both of them
+    replica_addresses = [("localhost", port) for port in range(9527, 9533)]
+    replicas = [start_replica(f"replica_{i}", "localhost", port, "linear", replica_addresses, None)
+                for i, (_, port) in enumerate(replica_addresses)]
+
+    pairs = {f"key{i:02d}": f"value{i}" for i in range(25)}
+    pairs["other"] = "value"
+    response = Pipeline(replica_addresses[0]).mset(pairs).execute()[0]
+
+    assert response == "Key-value pairs added", "replica0: mset failed"
+
+    # Read key05 up to key20 in pages of 4, following the cursor
+    scanned = []
+    cursor = None
+
+    while True:
+        cursor, page = Pipeline(replica_addresses[3]).scan(
+            "key05", "key20", 4, cursor).execute()[0]
+
+        assert len(page) <= 4, "replica3: page longer than the limit"
+
+        scanned += page
+
+        if not cursor:
+            break
+
+    logging.debug(f"[replica3] scanned = {scanned}")
+
+    assert scanned == [(f"key{i:02d}", f"value{i}") for i in range(5, 20)], "replica3: scan failed"
+
+    cursor, page = Pipeline(replica_addresses[1]).prefix("key1", 100).execute()[0]
+
+    logging.debug(f"[replica1] prefix key1 = {page}")
+
+    assert cursor == "" and page == [(f"key{i}", f"value{i}") for i in range(10, 20)], "replica1: prefix failed"
+
+    # An open end is sent as "-" over the text protocol
+    cursor, page = Pipeline(replica_addresses[2], "text").scan("key20", "", 100).execute()[0]
+
+    logging.debug(f"[replica2] text scan from key20 = {page}")
+
+    assert cursor == "" and page == [(f"key{i}", f"value{i}") for i in range(20, 25)] + [("other", "value")], \
+        "replica2: text scan with an open end failed"
+
+    logging.info("Scan test passed\n")
+    print("Scan test passed\n")
+
+
+def test_concurrent_writes():
+    logging.info("Starting concurrent writes test...")
+
+    replica_addresses = [("localhost", 9533),
+                         ("localhost", 9534), ("localhost", 9535)]
+
+    replica0 = start_replica("replica_0", "localhost",
+                             9533, "eventual", replica_addresses, None)
+    replica1 = start_replica("replica_1", "localhost",
+                             9534, "eventual", replica_addresses, None)
+    replica2 = start_replica("replica_2", "localhost",
+                             9535, "eventual", replica_addresses, None)
+
+    # Many clients write to the same few keys on replica0 at once, while gossip sends them on
+    def write(client):
+        for i in range(50):
+            Pipeline(replica_addresses[0]).mset(
+                {f"key{j}": f"{client}-{i}" for j in range(5)}).execute()
+
+    threads = [threading.Thread(target=write, args=(client,))
+               for client in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    time.sleep(config_settings["replica"]["gossip_interval"] + 1)
+
+    keys = [f"key{j}" for j in range(5)]
+    values = [replica.kv_store.mget(keys)
+              for replica in (replica0, replica1, replica2)]
+    roots = [replica.kv_store.merkle_tree.hashes([1])
+             for replica in (replica0, replica1, replica2)]
+
+    logging.debug(f"values = {values}\nMerkle roots = {roots}")
+
+    # No write was lost between the replicas, and each Merkle tree still matches its store
+    assert values[0] == values[1] == values[2], "replicas did not converge"
+    assert roots[0] == roots[1] == roots[2], "Merkle trees do not match"
+
+    # A local write does not overwrite a newer update from a replica whose clock is ahead
+    replica0.kv_store.update(["skewed", "remote", repr(time.time() + 60), "replica_1", ""])
+    replica0.kv_store.set("skewed", "local")
+    value = replica0.kv_store.get("skewed")
+
+    logging.debug(f"[replica0] skewed = {value}, expected: remote")
+
+    assert value == "remote", "replica0: local write overwrote a newer update"
+
+    logging.info("Concurrent writes test passed\n")
+    print("Concurrent writes test passed\n")
+
+
+def test_session_tokens():
+    logging.info("Starting session tokens test...")
+
+    eventual_addresses = [("localhost", 9536),
+                          ("localhost", 9537), ("localhost", 9538)]
+    sequential_addresses = [("localhost", 9539),
+                            ("localhost", 9540), ("localhost", 9541)]
+
+    for i, (_, port) in enumerate(eventual_addresses):
+        start_replica(f"replica_{i}", "localhost", port,
+                      "eventual", eventual_addresses, None)
+
+    for i, (_, port) in enumerate(sequential_addresses):
+        start_replica(f"replica_{i}", "localhost", port, "sequential",
+                      sequential_addresses, sequential_addresses[0])
+
+    # Gossip has not reached replica1 yet, so a read with the session token is answered from the replica that made the write
+    pipeline = Pipeline(eventual_addresses[0]).set("a", "1")
+    pipeline.execute()
+    token = pipeline.tokens.get("a")
+
+    plain_value = Pipeline(eventual_addresses[1]).get("a").execute()[0]
+    session_value = Pipeline(eventual_addresses[1]).get("a", token).execute()[0]
+
+    logging.debug(
+        f"[replica1] a = {plain_value} without and {session_value} with session token {token}")
+
+    assert token, "replica0: set returned no session token"
+    assert plain_value == "Key does not exist", "replica1: read without a session token waited"
+    assert session_value == "1", "replica1: read your writes failed"
+
+    # A write forwarded to the sequencer is visible on every follower that is given its token
+    pipeline = Pipeline(sequential_addresses[1]).set("b", "2")
+    pipeline.execute()
+    token = pipeline.tokens.get("b")
+    session_value = Pipeline(sequential_addresses[2]).get("b", token).execute()[0]
+
+    logging.debug(f"[replica2] b = {session_value} with session token {token}")
+
+    assert token and int(token) > 0, "replica1: forwarded set returned no sequence number"
+    assert session_value == "2", "replica2: read your writes failed"
+
+    logging.info("Session tokens test passed\n")
+    print("Session tokens test passed\n")
+
+
+def test_leader_lease():
+    logging.info("Starting leader lease test...")
+
+    replica_addresses = [("localhost", 9542),
+                         ("localhost", 9543), ("localhost", 9544)]
+    replicas = [start_replica(f"replica_{i}", "localhost", port, "linear", replica_addresses, None)
+                for i, (_, port) in enumerate(replica_addresses)]
+
+    # A write sent to a follower is forwarded to the lease holder, and a read from another follower is answered by it
+    response = Pipeline(replica_addresses[2]).set("a", "1").execute()[0]
+    value = Pipeline(replica_addresses[1]).get("a").execute()[0]
+    holders = [replica.id for replica in replicas if replica.kv_store.holds_lease()]
+
+    logging.debug(
+        f"[replica1] a = {value}, expected: 1; lease holders: {holders}, expected one")
+
+    assert response == "Key-value pair added", "replica2: write was not forwarded to the leader"
+    assert value == "1", "replica1: read from the leader failed"
+    assert len(holders) == 1, "leader lease: expected exactly one lease holder"
+    assert all(replica.kv_store.granted_to == holders[0] for replica in replicas), \
+        "leader lease: replicas granted the lease to different replicas"
+
+    # With leases every replica has an acknowledged write, so whichever is granted the lease next can serve it
+    assert all(replica.kv_store.get("a") == "1" for replica in replicas), \
+        "leader lease: an acknowledged write is missing from a replica"
+
+    logging.info("Leader lease test passed\n")
+    print("Leader lease test passed\n")
+
+
+def test_stats():
+    logging.info("Starting stats test...")
+
+    replica_addresses = [("localhost", 9545),
+                         ("localhost", 9546), ("localhost", 9547)]
+
+    for i, (_, port) in enumerate(replica_addresses):
+        start_replica(f"replica_{i}", "localhost", port,
+                      "sequential", replica_addresses, replica_addresses[0])
+
+    Pipeline(replica_addresses[0]).set("a", "1").get("a").get("b").execute()
+    stats = Pipeline(replica_addresses[0]).stats().execute()[0]
+
+    logging.debug(f"[replica0] stats = {stats}")
+
+    assert stats["latency"]["set"]["count"] == 1, "replica0: set was not counted"
+    assert stats["latency"]["get"]["count"] == 2, "replica0: gets were not counted"
+    assert stats["counters"]["bytes_in"] > 0 and stats["counters"]["bytes_out"] > 0, \
+        "replica0: bytes were not counted"
+    assert stats["storage"]["keys"] == 1, "replica0: storage size is wrong"
+    assert set(stats["replication"]["queue_depths"]) == {"localhost:9546", "localhost:9547"}, \
+        "replica0: replication queues are missing"
+
+    logging.info("Stats test passed\n")
+    print("Stats test passed\n")
+
+
+def test_server_workers():
+    logging.info("Starting server workers test...")
+
+    # Each replica is served by two processes sharing its port, each owning the keys that hash to it
+    replica_addresses = [("localhost", 9548),
+                         ("localhost", 9549), ("localhost", 9550)]
+    processes = []
+
+    for i, (_, port) in enumerate(replica_addresses):
+        processes += start_replica_workers(f"replica_{i}", "localhost", port, "linear",
+                                           replica_addresses, None, 2)
+
+    try:
+        # Every worker listens on the replica's port and on a port of its own
+        wait_for_ports(replica_addresses + [("localhost", port + 1000 * (worker + 1))
+                                            for _, port in replica_addresses for worker in range(2)])
+
+        pairs = {f"key{i:02d}": f"value{i}" for i in range(20)}
+        response = Pipeline(replica_addresses[0]).mset(pairs).execute()[0]
+        values = Pipeline(replica_addresses[1]).mget(list(pairs)).execute()[0]
+        _, scanned = Pipeline(replica_addresses[2]).scan("", "", 100).execute()[0]
+
+        # Workers listen for each other on the replica's port plus 1000 for each worker
+        worker_keys = [Pipeline(("localhost", 9548 + 1000 * (worker + 1))).stats().execute()[0]["storage"]["keys"]
+                       for worker in range(2)]
+
+        logging.debug(
+            f"[replica1] values = {values}\n[replica0] keys per worker = {worker_keys}")
+
+        assert response == "Key-value pairs added", "replica0: mset failed"
+        assert values == list(pairs.values()), "replica1: mget across workers failed"
+        assert scanned == sorted(pairs.items()), "replica2: scan across workers failed"
+        assert all(worker_keys) and sum(worker_keys) == len(pairs), \
+            "replica0: keys were not split between the workers"
+    finally:
+        for process in processes:
+            process.terminate()
+
+    logging.info("Server workers test passed\n")
+    print("Server workers test passed\n")
+
+
+def test_hinted_handoff():
+    logging.info("Starting hinted handoff test...")
+
+    replica_addresses = [("localhost", 9551),
+                         ("localhost", 9552), ("localhost", 9553)]
+
+    # Replica2 is down while replica0 writes a and b
+    replica0 = start_replica("replica_0", "localhost",
+                             9551, "causal", replica_addresses, None)
+    start_replica("replica_1", "localhost", 9552,
+                  "causal", replica_addresses, None)
+
+    replica0.kv_store.set("a", "1")
+    replica0.kv_store.set("b", "2")
+    time.sleep(0.1)
+
+    hints = replica0.kv_store.hints.stats()["localhost:9553"]
+
+    # Once replica2 starts, replica0 replays the writes it missed on its next retry
+    replica2 = start_replica("replica_2", "localhost",
+                             9553, "causal", replica_addresses, None)
+    time.sleep(2)
+
+    values = replica2.kv_store.mget(["a", "b"])
+    delivered = replica0.kv_store.hints.stats()["localhost:9553"]
+
+    logging.debug(
+        f"[replica0] hints for replica2 = {hints}, after restart: {delivered}\n[replica2] a, b = {values}, expected: ['1', '2']")
+
+    assert hints["pending_bytes"] > 0, "replica0: missed writes were not kept as hints"
+    assert values == ["1", "2"], "replica2: hinted writes were not delivered"
+    assert delivered["pending_bytes"] == 0 and delivered["delivered"] > 0, \
+        "replica0: hints were not emptied after delivery"
+
+    logging.info("Hinted handoff test passed\n")
+    print("Hinted handoff test passed\n")
+
+
+def test_snapshot_bootstrap():
+    logging.info("Starting snapshot bootstrap test...")
+
+    replica_addresses = [("localhost", 9554),
+                         ("localhost", 9555), ("localhost", 9556)]
+
+    # Replica2 joins after replica0 and replica1 have written every key
+    replica0 = start_replica("replica_0", "localhost", 9554,
+                             "sequential", replica_addresses, replica_addresses[0])
+    start_replica("replica_1", "localhost", 9555,
+                  "sequential", replica_addresses, replica_addresses[0])
+
+    pairs = {f"key{i:02d}": f"value{i}" for i in range(30)}
+    Pipeline(replica_addresses[0]).mset(pairs).execute()
+
+    replica2 = start_replica("replica_2", "localhost", 9556,
+                             "sequential", replica_addresses, replica_addresses[0])
+
+    # Copy the store in several chunks, then follow the batches written after it
+    replica2.bootstrap_chunk_size = 7
+    copied = replica2.bootstrap()
+
+    replica0.kv_store.set("late", "1")
+    time.sleep(0.5)
+
+    values = replica2.kv_store.mget(list(pairs) + ["late"])
+
+    logging.debug(
+        f"[replica2] values = {values}, sequence number = {replica2.kv_store.sequence_number}, expected: {replica0.kv_store.sequence_number}")
+
+    assert copied, "replica2: bootstrap failed"
+    assert values == list(pairs.values()) + ["1"], "replica2: store was not copied"
+    assert replica2.kv_store.sequence_number == replica0.kv_store.sequence_number, \
+        "replica2: did not continue from the copied sequence number"
+
+    # A causal replica that is replaced comes back empty and counts its own writes from 0 again
+    addresses = [("localhost", 9579), ("localhost", 9580), ("localhost", 9581)]
+    replicas = [start_replica(f"replica_{i}", "localhost", port, "causal", addresses, None)
+                for i, (_, port) in enumerate(addresses)]
+
+    replicas[2].kv_store.set("a", "1")
+    replicas[2].kv_store.set("b", "1")
+    time.sleep(0.5)
+
+    replicas[2].kv_store.store.clear()
+    replicas[2].kv_store.vector_clock = {replica_id: 0 for replica_id in replicas[2].kv_store.vector_clock}
+
+    # It takes no writes until the copy has restored its own clock entry, so its next write is not dropped as already delivered
+    replicas[2].kv_store.begin_bootstrap()
+    refused = Pipeline(addresses[2]).set("c", "1").execute()[0]
+    copied = replicas[2].bootstrap()
+    response = Pipeline(addresses[2]).set("c", "2").execute()[0]
+    time.sleep(0.5)
+
+    values = replicas[2].kv_store.mget(["a", "b", "c"])
+    delivered = replicas[0].kv_store.get("c")
+
+    logging.debug(
+        f"[causal replica2] a, b, c = {values}, expected: ['1', '1', '2']\n[causal replica0] c = {delivered}, expected: 2")
+
+    assert refused == "Replica is bootstrapping", "causal replica2: took a write during the copy"
+    assert copied and response == "Key-value pair added", "causal replica2: bootstrap failed"
+    assert values == ["1", "1", "2"], "causal replica2: store was not copied"
+    assert delivered == "2", "causal replica0: write made after the copy was dropped"
+
+    # An eventual write made while the copy runs is newer than the copied value, so it is kept
+    addresses = [("localhost", 9582), ("localhost", 9583), ("localhost", 9584)]
+    replicas = [start_replica(f"replica_{i}", "localhost", port, "eventual", addresses, None)
+                for i, (_, port) in enumerate(addresses[:2])]
+
+    Pipeline(addresses[0]).mset({"a": "1", "b": "1"}).execute()
+    time.sleep(config_settings["replica"]["gossip_interval"] + 0.5)
+
+    replicas.append(start_replica("replica_2", "localhost", 9584, "eventual", addresses, None))
+    replicas[2].kv_store.set("a", "2")
+    copied = replicas[2].bootstrap()
+
+    values = replicas[2].kv_store.mget(["a", "b"])
+
+    logging.debug(f"[eventual replica2] a, b = {values}, expected: ['2', '1']")
+
+    assert copied, "eventual replica2: bootstrap failed"
+    assert values == ["2", "1"], "eventual replica2: store was not copied"
+
+    logging.info("Snapshot bootstrap test passed\n")
+    print("Snapshot bootstrap test passed\n")
+
+
+def test_key_expiry():
+    logging.info("Starting key expiry test...")
+
+    replica_addresses = [("localhost", 9557),
+                         ("localhost", 9558), ("localhost", 9559)]
+
+    # Replica0 is the sequencer, so the write reaches it through replica1
+    replica0 = start_replica("replica_0", "localhost", 9557,
+                             "sequential", replica_addresses, replica_addresses[0])
+    replica1 = start_replica("replica_1", "localhost", 9558,
+                             "sequential", replica_addresses, replica_addresses[0])
+    replica2 = start_replica("replica_2", "localhost", 9559,
+                             "sequential", replica_addresses, replica_addresses[0])
+
+    responses = Pipeline(replica_addresses[1]).set("a", "1", 1).set("b", "2").execute()
+    time.sleep(0.2)
+
+    values = [replica.kv_store.get("a") for replica in (replica0, replica1, replica2)]
+    deadlines = {replica.kv_store.deadlines.get("a") for replica in (replica0, replica1, replica2)}
+
+    # Every replica removes a within a tick of the deadline it was replicated with
+    time.sleep(1.5)
+
+    expired = [replica.kv_store.get("a") for replica in (replica0, replica1, replica2)]
+    remaining = [replica.kv_store.get("b") for replica in (replica0, replica1, replica2)]
+
+    logging.debug(
+        f"[replicas] a = {values}, after the ttl: {expired}, expected: Key does not exist\n[replicas] b = {remaining}, expected: 2")
+
+    assert responses[0] == "Key-value pair forwarded to sequencer", "replica1: set with ttl failed"
+    assert values == ["1"] * 3, "replicas: key with ttl was not replicated"
+    assert len(deadlines) == 1, "replicas: deadlines differ"
+    assert expired == ["Key does not exist"] * 3, "replicas: key did not expire"
+    assert remaining == ["2"] * 3, "replicas: key without ttl expired"
+    assert all("a" not in replica.kv_store.store and not replica.kv_store.deadlines
+               for replica in (replica0, replica1, replica2)), "replicas: expired key was not removed"
+
+    # Every other scheme replicates the deadline with the write too. Gossip only reaches the other replicas
+    # gossip_interval seconds later, and a linear write is only acknowledged after the simulated latency,
+    # so the key has to outlive that
+    ttls = {"eventual": config_settings["replica"]["gossip_interval"] + 1,
+            "causal": 1,
+            "linear": config_settings["replica"]["simulated_latency"] + 2}
+
+    for scheme, port in (("eventual", 9567), ("causal", 9570), ("linear", 9573)):
+        addresses = [("localhost", port + i) for i in range(3)]
+        replicas = [start_replica(f"replica_{i}", "localhost", port, scheme, addresses, None)
+                    for i, (_, port) in enumerate(addresses)]
+
+        start_time = time.time()
+        response = Pipeline(addresses[0]).set("a", "1", ttls[scheme]).execute()[0]
+        time.sleep(max(start_time + ttls[scheme] - 0.5 - time.time(), 0))
+
+        values = [replica.kv_store.get("a") for replica in replicas]
+        time.sleep(max(start_time + ttls[scheme] + 1.5 - time.time(), 0))
+
+        expired = [replica.kv_store.get("a") for replica in replicas]
+
+        logging.debug(
+            f"[{scheme} replicas] a = {values}, after the ttl: {expired}, expected: Key does not exist")
+
+        assert response == "Key-value pair added", f"{scheme} replica0: set with ttl failed"
+        assert values == ["1"] * 3, f"{scheme} replicas: key with ttl was not replicated"
+        assert expired == ["Key does not exist"] * 3, f"{scheme} replicas: key did not expire"
+
+        # An expired key drops its version, and gossip of a write whose deadline has passed is ignored
+        if scheme == "eventual":
+            replicas[1].kv_store.update(["a", "1", repr(time.time() - 10), "replica_0", repr(time.time() - 5)])
+
+            assert all("a" not in replica.kv_store.versions for replica in replicas), \
+                "eventual replicas: expired key kept its version"
+            assert replicas[1].kv_store.get("a") == "Key does not exist", \
+                "eventual replica1: expired update was applied"
+
+    # Deadlines come back from the snapshot's deadlines checkpoint and from the log written after it
+    store = KeyValueStore()
+    remove_log("results/expiry_test_wal.log")
+    store.wal = WriteAheadLog("results/expiry_test_wal.log", 10, 100)
+
+    store.put("b", "2", time.time() + 60)
+    store.save("results/expiry_test_kvstore.txt")
+    store.put("c", "3", time.time() + 60)
+    store.put("d", "4", time.time() + 0.3)
+
+    deadlines = dict(store.deadlines)
+    store.wal.close()
+    store.wal = None
+
+    # D's deadline passes while the store is down, so it is removed on the first tick after recovery
+    time.sleep(0.5)
+
+    recovered = KeyValueStore()
+    recovered.recover("results/expiry_test_kvstore.txt", "results/expiry_test_wal.log")
+    values = recovered.mget(["b", "c", "d"])
+    time.sleep(0.3)
+
+    logging.debug(
+        f"[recovered] b, c, d = {values}, expected: ['2', '3', 'Key does not exist']\n[recovered] deadlines = {recovered.deadlines}")
+
+    assert values == ["2", "3", "Key does not exist"], "recovered store: keys were not recovered"
+    assert recovered.deadlines == {key: deadlines[key] for key in ("b", "c")}, \
+        "recovered store: deadlines were not recovered"
+    assert "d" not in recovered.store, "recovered store: key past its deadline was not removed"
+
+    logging.info("Key expiry test passed\n")
+    print("Key expiry test passed\n")
+
+
+def test_atomic_operations():
+    logging.info("Starting atomic operations test...")
+
+    replica_addresses = [("localhost", 9560),
+                         ("localhost", 9561), ("localhost", 9562)]
+
+    replicas = [start_replica(f"replica_{i}", "localhost", port, "sequential",
+                              replica_addresses, replica_addresses[0])
+                for i, (_, port) in enumerate(replica_addresses)]
+
+    # Increments sent to every replica at once are all applied by the sequencer, so none of them is lost
+    def increment(address):
+        for _ in range(10):
+            Pipeline(address).incr("counter").execute()
+
+    threads = [threading.Thread(target=increment, args=(address,))
+               for address in replica_addresses for _ in range(2)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    responses = Pipeline(replica_addresses[1]).set("a", "1").cas("a", "1", "2").cas("a", "1", "3") \
+        .append("a", "bc").incr("a").execute()
+    time.sleep(0.2)
+
+    counters = [replica.kv_store.get("counter") for replica in replicas]
+    values = [replica.kv_store.get("a") for replica in replicas]
+
+    logging.debug(
+        f"[replicas] counter = {counters}, expected: 60\n[replica1] responses = {responses}\n[replicas] a = {values}, expected: 2bc")
+
+    assert counters == ["60"] * 3, "replicas: increments were lost"
+    assert responses[1:] == ["Value swapped", "Value did not match", "3", "Value is not an integer"], \
+        "replica1: atomic operations failed"
+    assert values == ["2bc"] * 3, "replicas: atomic writes were not replicated"
+
+    # With the other schemes the first replica of the group runs every operation, and the next one takes over while it is down
+    settings = replica_module.config_settings["replica"]
+    saved = dict(settings)
+    settings.update(leader_lease=0, simulated_latency=0, write_quorum=2, replication_timeout=1)
+
+    try:
+        for scheme, port in (("eventual", 9588), ("causal", 9591), ("linear", 9594)):
+            addresses = [("localhost", port + i) for i in range(3)]
+            replicas = [start_replica(f"replica_{i}", "localhost", port, scheme, addresses, None)
+                        for i, (_, port) in enumerate(addresses[1:], 1)]
+
+            threads = [threading.Thread(target=increment, args=(address,))
+                       for address in addresses[1:] for _ in range(2)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            counter = replicas[0].kv_store.get("counter")
+
+            logging.debug(f"[{scheme} replica1] counter = {counter}, expected: 40")
+
+            assert counter == "40", f"{scheme} replica1: increments were lost while replica0 was down"
+    finally:
+        settings.clear()
+        settings.update(saved)
+
+    logging.info("Atomic operations test passed\n")
+    print("Atomic operations test passed\n")
+
+
+def test_sharding():
+    logging.info("Starting sharding test...")
+
+    replica_addresses = [("localhost", 9563), ("localhost", 9564),
+                         ("localhost", 9565), ("localhost", 9566)]
+    settings = replica_module.config_settings["replica"]
+    saved = dict(settings)
+
+    # Two groups of two replicas, each storing the keys that hash to it
+    settings.update(replication_factor=2, leader_lease=0, simulated_latency=0)
+
+    try:
+        replicas = [start_replica(f"replica_{i}", "localhost", port, "linear", replica_addresses, None)
+                    for i, (_, port) in enumerate(replica_addresses)]
+    finally:
+        settings.clear()
+        settings.update(saved)
+
+    shard_map = replicas[0].shard_map
+    keys = [f"key{i}" for i in range(20)]
+    groups = [[key for key in keys if shard_map.group_index(key) == group] for group in range(2)]
+
+    # Replica0 forwards writes and reads of the other group's keys, and splits multi-key commands between the groups
+    Pipeline(replica_addresses[0]).set(groups[1][0], "routed").execute()
+    value = Pipeline(replica_addresses[0]).get(groups[1][0]).execute()[0]
+    response = Pipeline(replica_addresses[0]).mset({key: key.upper() for key in keys}).execute()[0]
+    values = Pipeline(replica_addresses[3]).mget(keys).execute()[0]
+
+    stored = [sorted(replica.kv_store.store) for replica in replicas]
+
+    logging.debug(
+        f"[replica0] {groups[1][0]} = {value}, mset = {response}\n[replica3] values = {values}\n[replicas] keys = {stored}")
+
+    assert value == "routed", "replica0: routed set or get failed"
+    assert response == "Key-value pairs added", "replica0: mset failed"
+    assert values == [key.upper() for key in keys], "replica3: mget across groups failed"
+    assert all(shard_map.group_index(key) == i // 2 for i, replica_keys in enumerate(stored) for key in replica_keys), \
+        "replicas: keys were stored outside their group"
+
+    # A write that fails in one group fails the whole mset, even though the part written here succeeded
+    for replica in replicas[2:]:
+        replica.kv_store.mset = lambda pairs: "Write quorum not reached"
+
+    response = Pipeline(replica_addresses[0]).mset({groups[0][0]: "1", groups[1][0]: "2"}).execute()[0]
+
+    logging.debug(f"[replica0] partially failed mset = {response}")
+
+    assert response == "Write quorum not reached", "replica0: failure of another group was not reported"
+
+    logging.info("Sharding test passed\n")
+    print("Sharding test passed\n")
+
+
+def test_sequencer_heartbeat():
+    logging.info("Starting sequencer heartbeat test...")
+
+    replica_addresses = [("localhost", 9576),
+                         ("localhost", 9577), ("localhost", 9578)]
+
+    replica0 = start_replica("replica_0", "localhost", 9576,
+                             "sequential", replica_addresses, replica_addresses[0])
+    replica1 = start_replica("replica_1", "localhost", 9577,
+                             "sequential", replica_addresses, replica_addresses[0])
+    replica2 = start_replica("replica_2", "localhost", 9578,
+                             "sequential", replica_addresses, replica_addresses[0])
+
+    # Replica2 drops every batch and heartbeat while keys are written, as if they were lost on the way
+    def write_dropped(keys):
+        replica2.kv_store.apply_sequence = lambda sequence_number, updates: "Update successful"
+        replica2.kv_store.heartbeat = lambda sequence_number: "Update successful"
+
+        for key in keys:
+            replica0.kv_store.set(key, "1")
+
+        time.sleep(0.2)
+        del replica2.kv_store.apply_sequence
+        del replica2.kv_store.heartbeat
+
+    # No batch follows the lost ones, so replica2 only notices them on the next heartbeat
+    write_dropped(["a", "b", "c"])
+    missed = replica2.kv_store.mget(["a", "b", "c"])
+    time.sleep(config_settings["replica"]["sequencer_heartbeat_interval"] + 0.5)
+
+    values = replica2.kv_store.mget(["a", "b", "c"])
+
+    logging.debug(
+        f"[replica2] a, b, c = {missed}, after a heartbeat: {values}, expected: ['1', '1', '1']")
+
+    assert missed == ["Key does not exist"] * 3, "replica2: batches were not dropped"
+    assert values == ["1"] * 3, "replica2: lost batches were not retransmitted"
+
+    # Once the sequencer has dropped the lost batches from its history, replica2 copies a peer's store instead
+    replica0.sequencer_history = 2
+    write_dropped(["d", "e", "f", "g", "h"])
+    time.sleep(config_settings["replica"]["sequencer_heartbeat_interval"] + 1.5)
+
+    values = replica2.kv_store.mget(["d", "e", "f", "g", "h"])
+
+    logging.debug(
+        f"[replica2] d to h = {values}, sequence number = {replica2.kv_store.sequence_number}, expected: {replica0.kv_store.sequence_number}")
+
+    assert values == ["1"] * 5, "replica2: did not copy the store after the history was gone"
+    assert replica2.kv_store.sequence_number == replica0.kv_store.sequence_number, \
+        "replica2: did not continue from the copied sequence number"
+    assert replica1.handle_command(["retransmit", "0", "1"]) == "Not the sequencer", \
+        "replica1: follower answered a retransmission"
+
+    logging.info("Sequencer heartbeat test passed\n")
+    print("Sequencer heartbeat test passed\n")
+
+
+def test_write_quorum():
+    logging.info("Starting write quorum test...")
+
+    replica_addresses = [("localhost", 9585),
+                         ("localhost", 9586), ("localhost", 9587)]
+    settings = replica_module.config_settings["replica"]
+    saved = dict(settings)
+
+    # Writes complete once two of the three replicas have them, and give up on the rest after a second
+    settings.update(write_quorum=2, leader_lease=0, simulated_latency=0, replication_timeout=1)
+
+    try:
+        # Replica2 is down while replica0 writes a and b
+        replica0 = start_replica("replica_0", "localhost", 9585,
+                                 "linear", replica_addresses, None)
+        start_replica("replica_1", "localhost", 9586,
+                      "linear", replica_addresses, None)
+
+        response = Pipeline(replica_addresses[0]).set("a", "1").execute()[0]
+
+        # Waiting for every replica, as with write_quorum: all, fails once the replication timeout has passed
+        replica0.kv_store.required_acknowledgements = 2
+        start_time = time.time()
+        failed = Pipeline(replica_addresses[0]).set("b", "2").execute()[0]
+        elapsed = time.time() - start_time
+
+        hints = replica0.kv_store.hints.stats()["localhost:9587"]
+
+        # Once replica2 starts, replica0 replays the writes it missed, and later writes follow them
+        replica2 = start_replica("replica_2", "localhost", 9587,
+                                 "linear", replica_addresses, None)
+        time.sleep(3)
+
+        recovered = Pipeline(replica_addresses[0]).set("c", "3").execute()[0]
+    finally:
+        settings.clear()
+        settings.update(saved)
+
+    values = replica2.kv_store.mget(["a", "b", "c"])
+    delivered = replica0.kv_store.hints.stats()["localhost:9587"]
+
+    logging.debug(
+        f"[replica0] a = {response}, b = {failed} after {elapsed:.2f}s, c = {recovered}\n[replica0] hints for replica2 = {hints}, after restart: {delivered}\n[replica2] a, b, c = {values}, expected: ['1', '2', '3']")
+
+    assert response == "Key-value pair added", "replica0: write quorum of two was not reached"
+    assert failed == "Write quorum not reached" and 1 <= elapsed < 3, "replica0: write did not time out"
+    assert hints["pending_bytes"] > 0, "replica0: missed writes were not kept as hints"
+    assert recovered == "Key-value pair added", "replica0: write after replica2 was back failed"
+    assert values == ["1", "2", "3"], "replica2: missed writes were not replayed"
+    assert delivered["pending_bytes"] == 0, "replica0: hints were not emptied after delivery"
+
+    logging.info("Write quorum test passed\n")
+    print("Write quorum test passed\n")
+
+
+def test_recovery():
+    logging.info("Starting recovery test...")
+
+    replica_addresses = [("localhost", 9597),
+                         ("localhost", 9598), ("localhost", 9599)]
+    settings = replica_module.config_settings["replica"]
+    saved = dict(settings)
+
+    # The replicas keep their files apart from the other tests', so the restarted replica only finds its own
+    shutil.rmtree("results/recovery_test", ignore_errors=True)
+    shutil.rmtree("results/recovery_test_restarted", ignore_errors=True)
+    os.makedirs("results/recovery_test")
+    settings.update(output_location="results/recovery_test")
+
+    try:
+        replicas = [start_replica(f"replica_{i}", "localhost", port, "causal", replica_addresses, None)
+                    for i, (_, port) in enumerate(replica_addresses)]
+
+        # Replica2 takes a snapshot after a, b and c, and d is only in the log written after it
+        replicas[0].kv_store.mset([("a", "1"), ("b", "2")])
+        replicas[1].kv_store.set("c", "3")
+        time.sleep(0.5)
+
+        replicas[2].kv_store.save(replicas[2].save_location)
+        replicas[0].kv_store.set("d", "4")
+        time.sleep(0.5)
+
+        # Replica2 crashes: its files are copied as they are on disk, and a new replica_2 starts from them
+        replicas[2].kv_store.wal.sync()
+        shutil.copytree("results/recovery_test", "results/recovery_test_restarted")
+        settings.update(output_location="results/recovery_test_restarted", recover_on_startup=True)
+
+        restarted = Replica("replica_2", "localhost", 9600, "causal",
+                            replica_addresses[:2] + [("localhost", 9600)], None)
+    finally:
+        settings.clear()
+        settings.update(saved)
+
+    values = restarted.kv_store.mget(["a", "b", "c", "d"])
+    vector_clock = {replica_id: count for replica_id, count in restarted.kv_store.vector_clock.items() if count}
+
+    logging.debug(
+        f"[restarted replica2] a, b, c, d = {values}, expected: ['1', '2', '3', '4']\n[restarted replica2] vector clock = {vector_clock}, expected: {{'replica_0': 3, 'replica_1': 1}}")
+
+    assert values == ["1", "2", "3", "4"], "replica2: keys were not recovered"
+    assert vector_clock == {"replica_0": 3, "replica_1": 1}, "replica2: vector clock was not recovered"
+
+    logging.info("Recovery test passed\n")
+    print("Recovery test passed\n")
+
+
+def test_gossip():
+    logging.info("Starting gossip test...")
+
+    replica_addresses = [("localhost", 9601),
+                         ("localhost", 9602), ("localhost", 9603)]
+    settings = replica_module.config_settings["replica"]
+    saved = dict(settings)
+
+    # Small batches, compression from 200 bytes, and each batch sent to one of the two peers
+    settings.update(gossip_interval=0.5, gossip_max_interval=2, gossip_batch_size=5,
+                    gossip_compress_bytes=200, gossip_fanout=1)
+
+    try:
+        replicas = [start_replica(f"replica_{i}", "localhost", port, "eventual", replica_addresses, None)
+                    for i, (_, port) in enumerate(replica_addresses)]
+    finally:
+        settings.clear()
+        settings.update(saved)
+
+    # Record the peer and packing of every batch each replica sends
+    sent = {}
+
+    def record(replica):
+        send = replica.kv_store.hints.send
+        sent[replica.id] = []
+        replica.kv_store.hints.send = lambda address, command: \
+            sent[replica.id].append((address, command[1])) or send(address, command)
+
+    for replica in replicas:
+        record(replica)
+
+    # Only the newest write to a key waits to be sent, and only it counts towards the batch size
+    for i in range(3):
+        replicas[0].kv_store.set("a", f"v{i}")
+
+    with replicas[0].kv_store.pending_lock:
+        pending = (len(replicas[0].kv_store.pending_updates), replicas[0].kv_store.pending_bytes)
+
+    # A full batch is sent at once, to one peer
+    for i in range(4):
+        replicas[0].kv_store.set(f"k{i}", "1")
+
+    time.sleep(0.2)
+    flushed = list(sent["replica_0"])
+
+    # Batches are compressed by their encoded size, which is over 200 bytes here although the fields are shorter
+    replicas[0].kv_store.set("b", "é" * 90)
+    time.sleep(1)
+    compressed = sent["replica_0"][len(flushed):]
+
+    # With nothing left to send, gossip backs off, and the next write restarts it
+    time.sleep(1.5)
+    backed_off = replicas[0].kv_store.stats()["replication"]["backed_off"]
+
+    replicas[0].kv_store.set("c", "1")
+    time.sleep(config_settings["replica"]["gossip_interval"])
+
+    # The peer that received the first batch passed its writes on to one peer of its own
+    receiver = replicas[replica_addresses.index(flushed[0][0])] if flushed else replicas[0]
+    values = receiver.kv_store.mget(["a", "k3"])
+
+    logging.debug(
+        f"[replica0] pending = {pending}, expected: (1, 3)\n[replicas] sent = {sent}\n[replica0] backed off = {backed_off}\n[{receiver.id}] a, k3 = {values}, expected: ['v2', '1']")
+
+    assert pending == (1, 3), "replica0: writes to the same key were not coalesced"
+    assert len(flushed) == 1 and flushed[0][1] == "raw", "replica0: full batch was not sent early to one peer"
+    assert [packing for _, packing in compressed] == ["zlib"], "replica0: batch was not compressed"
+    assert backed_off, "replica0: gossip did not back off"
+    assert len(sent["replica_0"]) == 3, "replica0: write after backing off was not sent"
+    assert values == ["v2", "1"], f"{receiver.id}: gossip was not applied"
+    assert sent[receiver.id] and sent[receiver.id][0][1] == "raw", f"{receiver.id}: new writes were not passed on"
+
+    logging.info("Gossip test passed\n")
+    print("Gossip test passed\n")
+
+
+def test_hint_delivery():
+    logging.info("Starting hint delivery test...")
+
+    replica_addresses = [("localhost", 9604),
+                         ("localhost", 9605), ("localhost", 9606)]
+    settings = replica_module.config_settings["replica"]
+    saved = dict(settings)
+
+    shutil.rmtree("results/hints_test", ignore_errors=True)
+    shutil.rmtree("results/hints_test_restarted", ignore_errors=True)
+    os.makedirs("results/hints_test")
+
+    # Gossip every half second, and retry hints after 0.1 seconds, doubling up to 0.8 seconds
+    settings.update(output_location="results/hints_test", gossip_interval=0.5,
+                    hint_retry_interval=0.1, hint_max_retry_interval=0.8)
+
+    try:
+        # Replica2 is down while replica0 gossips a
+        replica0 = start_replica("replica_0", "localhost", 9604,
+                                 "eventual", replica_addresses, None)
+        start_replica("replica_1", "localhost", 9605,
+                      "eventual", replica_addresses, None)
+
+        # Record every attempt replica0 makes to deliver its hints for replica2
+        attempts = []
+        hints = replica0.kv_store.hints.queues[("localhost", 9606)]
+        deliver = hints.deliver
+        hints.deliver = lambda messages: attempts.append(time.time()) or deliver(messages)
+
+        replica0.kv_store.set("a", "1")
+        time.sleep(2.5)
+
+        pending = hints.stats()
+
+        # Replica0 restarts from its files, and the hints it had not delivered are replayed once replica2 is up
+        shutil.copytree("results/hints_test", "results/hints_test_restarted")
+        settings.update(output_location="results/hints_test_restarted", recover_on_startup=True)
+
+        restarted = Replica("replica_0", "localhost", 9607, "eventual",
+                            [("localhost", 9607)] + replica_addresses[1:], None)
+
+        settings.update(output_location="results/hints_test", recover_on_startup=False)
+        replica2 = start_replica("replica_2", "localhost", 9606,
+                                 "eventual", replica_addresses, None)
+        time.sleep(2)
+    finally:
+        settings.clear()
+        settings.update(saved)
+
+    value = replica2.kv_store.get("a")
+    delivered = restarted.kv_store.hints.stats()["localhost:9606"]
+    gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+
+    logging.debug(
+        f"[replica0] hints for replica2 = {pending}, attempt gaps = {gaps}\n[restarted replica0] hints for replica2 = {delivered}\n[replica2] a = {value}, expected: 1")
+
+    assert pending["pending_bytes"] > 0, "replica0: missed gossip was not kept as a hint"
+    assert 3 <= len(attempts) <= 8 and gaps[-1] >= 0.6, "replica0: hint delivery did not back off"
+    assert value == "1", "replica2: hinted gossip was not delivered"
+    assert delivered["pending_bytes"] == 0 and delivered["delivered"] > 0, \
+        "restarted replica0: recovered hints were not replayed"
+
+    # A hint queue never grows beyond hint_max_bytes, dropping and counting the commands that do not fit
+    queue = HintQueue("results/hints_test/full.hints", ("localhost", 9608), 100, 60, 60, False)
+    added = [queue.add(["update", f"key{i}", "x" * 20, ""]) for i in range(10)]
+    stats = queue.stats()
+
+    logging.debug(f"[hint queue] added = {added}, stats = {stats}")
+
+    assert added[0] and not added[-1], "hint queue: commands were not dropped once it was full"
+    assert stats["dropped"] == added.count(False) and stats["pending_bytes"] <= 100, \
+        "hint queue: grew beyond its maximum size"
+
+    logging.info("Hint delivery test passed\n")
+    print("Hint delivery test passed\n")
+
+
 def run_tests():
     print("\nRunning tests...\n  - View logs in ./logs/test.log\n")
 
@@ -184,8 +1367,30 @@ def run_tests():
     test_linear_consistency()
     test_sequential_consistency()
     test_causal_consistency()
+    test_batched_commands()
+    test_anti_entropy()
+    test_binary_protocol()
+    test_lru_engine()
+    test_lsm_engine()
+    test_scan()
+    test_concurrent_writes()
+    test_session_tokens()
+    test_leader_lease()
+    test_stats()
+    test_server_workers()
+    test_sharding()
+    test_hinted_handoff()
+    test_snapshot_bootstrap()
+    test_key_expiry()
+    test_atomic_operations()
+    test_sequencer_heartbeat()
+    test_write_quorum()
+    test_recovery()
+    test_gossip()
+    test_hint_delivery()
 
     print("All tests passed")
 
 
-run_tests()
+if __name__ == "__main__":
+    run_tests()